@@ -1,29 +1,36 @@
 import functools
-import json
 import os
 import sys
 from pathlib import Path
+from typing import Optional
 
-import boto3
 import keyring
-from PyQt5 import QtWidgets, QtCore
+from PyQt5 import QtCore
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QIcon
-from PyQt5.QtWidgets import QApplication, QMainWindow, QTreeWidget, QTreeWidgetItem, QVBoxLayout, QWidget, QStyle, \
+from PyQt5.QtWidgets import QApplication, QMainWindow, QTreeView, QVBoxLayout, QWidget, QStyle, \
     QAction, QComboBox, QMenu, QInputDialog, \
-    QMessageBox, QFileDialog, QSizePolicy
+    QMessageBox, QFileDialog, QSizePolicy, QAbstractItemView, QDialog
 from slugify import slugify
 
 from finch.about import AboutWindow
 from finch.acl import ACLWindow
-from finch.common import ObjectType, s3_session, apply_theme, center_window, CONFIG_PATH, StringUtils, resource_path, \
-    TimeIntervalInputDialog
+from finch.cache import ListingCache
+from finch.common import ObjectType, s3_session, apply_theme, center_window, CONFIG_PATH, resource_path, \
+    TimeIntervalInputDialog, StringUtils, S3ClientPool, set_column_widths
 from finch.cors import CORSWindow
 from finch.credentials import CredentialsManager, ManageCredentialsWindow
 from finch.download import MultiDownloadProgressDialog
 from finch.error import show_error_dialog
-from finch.filelist import S3FileListFetchThread
+from finch.filelist import S3ObjectTreeModel, TreePrefetcher
+from finch.inventory import InventoryLocations, detect_inventory_location, load_manifest
+from finch.listing import delete_prefix
+from finch.scheduler import transfer_scheduler
+from finch.searchindex import SearchIndex
+from finch.sizes import PrefixSizeAggregator
+from finch.transfer import TransferSettingsDialog, TransferSettingsStore
 from finch.upload import UploadDialog
+from finch.widgets.flatview import FlatViewWidget
 from finch.widgets.search import SearchWidget
 
 
@@ -34,11 +41,11 @@ class MainWindow(QMainWindow):
         self.credentials_manager = None
         self.credential_selector = None
         self.manage_credential_window = None
-        self.download_dialog = None
+        # Upload and download dialogs, their transfers share the transfer scheduler and run at the same time
+        self.transfer_dialogs = []
         self.create_credential_window = None
         self.file_toolbar = None
         self.about_window = None
-        self.upload_dialog = None
 
         self.credential_toolbar = self.addToolBar("Credentials")
         self.credential_toolbar.setToolButtonStyle(QtCore.Qt.ToolButtonTextUnderIcon)
@@ -50,6 +57,13 @@ class MainWindow(QMainWindow):
 
         self.credential_toolbar.addAction(edit_credential_action)
 
+        self.transfer_settings_action = QAction(self)
+        self.transfer_settings_action.setText("&Transfer Settings")
+        self.transfer_settings_action.setIcon(QIcon(resource_path('img/settings.svg')))
+        self.transfer_settings_action.triggered.connect(self.show_transfer_settings_dialog)
+        self.transfer_settings_action.setDisabled(True)
+        self.credential_toolbar.addAction(self.transfer_settings_action)
+
         self.about_toolbar = self.addToolBar("About")
         self.about_toolbar.setToolButtonStyle(QtCore.Qt.ToolButtonTextUnderIcon)
         empty = QWidget()
@@ -61,8 +75,14 @@ class MainWindow(QMainWindow):
         self.about_toolbar.addWidget(empty)
         self.about_toolbar.addAction(show_about_action)
 
-        self.s3_file_list_fetch_thread = None
-        self.tree_widget = None
+        self.tree_view = None
+        self.tree_model = None
+        self.tree_prefetcher = None
+        self.listing_cache = None
+        self.size_aggregator = None
+        self.search_index = None
+        self.inventory_locations = None
+        self.flat_view_widget = None
         self.icon_type = {
             ObjectType.FILE: self.style().standardIcon(QStyle.SP_FileIcon),
             ObjectType.FOLDER: self.style().standardIcon(QStyle.SP_DirIcon),
@@ -96,10 +116,10 @@ class MainWindow(QMainWindow):
         self.credential_selector.setCurrentIndex(selected_index)
         self.layout.insertWidget(0, self.credential_selector)
         self.credential_selector.currentIndexChanged.connect(self.show_s3_files)
-        self.refresh_ui()
+        self.reload_ui()
 
     def handle_selection(self, selected, deselected):
-        selected_items = self.tree_widget.selectedItems()
+        selected_items = self.get_selected_indexes()
         if not selected_items:
             # No selection - disable relevant actions
             for idx, action in enumerate(self.file_toolbar.actions()):
@@ -110,9 +130,9 @@ class MainWindow(QMainWindow):
             return
 
         # Check if all selected items are files
-        all_files = all(item.text(1) == ObjectType.FILE for item in selected_items)
+        all_files = all(index.data(S3ObjectTreeModel.ObjectTypeRole) == ObjectType.FILE for index in selected_items)
         single_selection = len(selected_items) == 1
-        first_type = selected_items[0].text(1)
+        first_type = selected_items[0].data(S3ObjectTreeModel.ObjectTypeRole)
 
         for idx, action in enumerate(self.file_toolbar.actions()):
             if all_files:
@@ -122,14 +142,14 @@ class MainWindow(QMainWindow):
                 else:
                     action.setDisabled(True)
             elif single_selection and first_type in [ObjectType.BUCKET, ObjectType.FOLDER]:
-                # Enable create and delete for buckets/folders
-                if idx in [0, 1, 2, 4]:
+                # Enable create, delete and download for buckets/folders
+                if idx in [0, 1, 2, 3, 4]:
                     action.setDisabled(False)
                 else:
                     action.setDisabled(True)
             else:
-                # Mixed selection or multiple buckets/folders
-                if idx in [0, 2, 3]:
+                # Mixed selection or multiple buckets/folders, they can only be downloaded
+                if idx in [0, 2]:
                     action.setDisabled(True)
                 else:
                     action.setDisabled(False)
@@ -139,19 +159,27 @@ class MainWindow(QMainWindow):
             try:
                 cred_name = self.credential_selector.itemText(cred_index)
                 cred = self.credentials_manager.get_credential(cred_name)
-                s3_session.resource = boto3.resource('s3',
-                                                     endpoint_url=cred['endpoint'],
-                                                     aws_access_key_id=cred['access_key'],
-                                                     aws_secret_access_key=keyring.get_password(
-                                                         f'{slugify(cred["name"])}@finch',
-                                                         cred['access_key']
-                                                     ),
-                                                     region_name=cred['region']
-                                                     )
+                if s3_session.clients is not None:
+                    s3_session.clients.close()
+                s3_session.transfer_settings = TransferSettingsStore().get(cred['name'], cred['endpoint'])
+                s3_session.clients = S3ClientPool(endpoint_url=cred['endpoint'],
+                                                  access_key=cred['access_key'],
+                                                  secret_key=keyring.get_password(
+                                                      f'{slugify(cred["name"])}@finch',
+                                                      cred['access_key']
+                                                  ),
+                                                  region_name=cred['region'],
+                                                  max_pool_connections=(
+                                                      s3_session.transfer_settings.max_pool_connections))
+                transfer_scheduler.set_limits(s3_session.transfer_settings.max_files,
+                                              s3_session.transfer_settings.max_pool_connections)
+                self.transfer_settings_action.setDisabled(False)
+                s3_session.resource = s3_session.clients.resource()
                 self.removeToolBar(self.about_toolbar)
                 self.removeToolBar(self.file_toolbar)
                 self.file_toolbar = self.addToolBar("File")
-                self.tree_widget_wrapper_lay.removeWidget(self.tree_widget)
+                self.close_flat_view()
+                self.tree_widget_wrapper_lay.removeWidget(self.tree_view)
                 upload_file_action = QAction(self)
                 upload_file_action.setText("&Upload")
                 upload_file_action.setIcon(QIcon(resource_path('img/upload.svg')))
@@ -172,7 +200,7 @@ class MainWindow(QMainWindow):
                 download_action = QAction(self)
                 download_action.setText("&Download")
                 download_action.setIcon(QIcon(resource_path('img/download.svg')))
-                download_action.triggered.connect(self.download_files)
+                download_action.triggered.connect(functools.partial(self.download_files, False))
                 download_action.setDisabled(True)
 
                 refresh_action = QAction(self)
@@ -204,46 +232,82 @@ class MainWindow(QMainWindow):
                 self.about_toolbar.addWidget(empty)
                 self.about_toolbar.addAction(show_about_action)
 
-                self.tree_widget = QTreeWidget()
-                self.tree_widget.setContextMenuPolicy(Qt.CustomContextMenu)
-                self.tree_widget.customContextMenuRequested.connect(self.open_context_menu)
-                self.tree_widget.setSortingEnabled(True)
-                self.tree_widget.sortByColumn(0, Qt.AscendingOrder)
-                self.tree_widget.setSelectionMode(QTreeWidget.ExtendedSelection)
-                header = self.tree_widget.header()
-                header.setSectionResizeMode(QtWidgets.QHeaderView.ResizeToContents)
-                header.setStretchLastSection(False)
-                header.setSectionResizeMode(0, QtWidgets.QHeaderView.Stretch)
-                self.tree_widget.setColumnCount(4)
-                self.tree_widget.setHeaderLabels(["Name", "Type", "Size", "Date"])
-                self.tree_widget.itemExpanded.connect(self.add_files_to_tree)
-                self.tree_widget.selectionModel().selectionChanged.connect(self.handle_selection)
-
-                self.tree_widget_wrapper_lay.addWidget(self.tree_widget)
+                if self.tree_view:
+                    self.tree_view.deleteLater()
+                if self.tree_model:
+                    self.tree_model.clear()
+                    self.tree_model.deleteLater()
+                if self.listing_cache is None:
+                    # Folders are listed without the cache if its database can't be opened
+                    self.listing_cache = ListingCache.open()
+                if self.search_index is None:
+                    # Searches list every bucket if the index database can't be opened
+                    self.search_index = SearchIndex.open()
+                if self.inventory_locations is None:
+                    self.inventory_locations = InventoryLocations()
+                if self.size_aggregator:
+                    self.size_aggregator.clear()
+                    self.size_aggregator.deleteLater()
+                cache_scope = (cred['name'], cred['endpoint'])
+                self.size_aggregator = PrefixSizeAggregator(cache=self.listing_cache, cache_scope=cache_scope,
+                                                            parent=self)
+                self.size_aggregator.failed.connect(functools.partial(show_error_dialog, show_traceback=True))
+                self.tree_model = S3ObjectTreeModel(self.icon_type, cache=self.listing_cache, cache_scope=cache_scope,
+                                                    sizes=self.size_aggregator, search_index=self.search_index,
+                                                    parent=self)
+                self.tree_model.fetch_failed.connect(functools.partial(show_error_dialog, show_traceback=True))
+                self.tree_view = QTreeView()
+                self.tree_view.setModel(self.tree_model)
+                self.tree_prefetcher = TreePrefetcher(self.tree_view)
+                self.tree_view.setUniformRowHeights(True)
+                self.tree_view.setContextMenuPolicy(Qt.CustomContextMenu)
+                self.tree_view.customContextMenuRequested.connect(self.open_context_menu)
+                self.tree_view.setSelectionMode(QAbstractItemView.ExtendedSelection)
+                self.tree_view.setSelectionBehavior(QAbstractItemView.SelectRows)
+                set_column_widths(self.tree_view.header(), {1: 80, 2: 140, 3: 140})
+                self.tree_view.selectionModel().selectionChanged.connect(self.handle_selection)
+
+                self.tree_widget_wrapper_lay.addWidget(self.tree_view)
 
                 self.add_buckets_to_tree()
 
             except Exception as e:
                 show_error_dialog(e, show_traceback=True)
 
+    def get_active_view(self):
+        """ Get flat view if it is shown, otherwise the treeview """
+        if self.flat_view_widget is not None:
+            return self.flat_view_widget.view
+        return self.tree_view
+
+    def get_selected_indexes(self):
+        """ Get first column indexes of selected rows in treeview or flat view """
+        view = self.get_active_view()
+        if view is None:
+            return []
+        return view.selectionModel().selectedRows()
+
     def get_bucket_name_from_selected_item(self):
         """ Get bucket name data from bucket or file/folder item in treeview """
-        indexes = self.tree_widget.selectedIndexes()
+        indexes = self.get_selected_indexes()
         if indexes:
-            index = indexes[0]
-            if self.tree_widget.itemFromIndex(index).data(4, Qt.UserRole):
-                return self.tree_widget.itemFromIndex(index).data(4, Qt.UserRole)
-            else:
-                return index.data(Qt.DisplayRole)
+            return indexes[0].data(S3ObjectTreeModel.BucketRole)
         else:
             return None
 
     def get_object_key_from_selected_item(self):
         """ Get object key data from selected file/folder item in treeview """
-        indexes = self.tree_widget.selectedIndexes()
+        indexes = self.get_selected_indexes()
+        if indexes:
+            return indexes[0].data(S3ObjectTreeModel.KeyRole)
+        else:
+            return None
+
+    def get_object_type_from_selected_item(self):
+        """ Get object type of first selected item in treeview """
+        indexes = self.get_selected_indexes()
         if indexes:
-            index = indexes[0]
-            return self.tree_widget.itemFromIndex(index).data(5, Qt.UserRole)
+            return indexes[0].data(S3ObjectTreeModel.ObjectTypeRole)
         else:
             return None
 
@@ -253,56 +317,20 @@ class MainWindow(QMainWindow):
         """ Adds bucket items to treeview """
         try:
             buckets_obj = s3_session.resource.meta.client.list_buckets()
-            buckets = [bucket for bucket in buckets_obj['Buckets']]
-            for bucket in buckets:
-                bucket_item = QTreeWidgetItem(self.tree_widget)
-                bucket_item.setText(0, bucket['Name'])
-                bucket_item.setIcon(0, self.icon_type[ObjectType.BUCKET])
-                bucket_item.setText(1, ObjectType.BUCKET)
-                bucket_item.setText(2, StringUtils.format_size(0))
-                bucket_item.setText(3, StringUtils.format_datetime(bucket['CreationDate']))
-                bucket_item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+            s3_session.clients.resolve_regions(buckets_obj['Buckets'])
+            self.tree_model.set_buckets(buckets_obj['Buckets'])
         except Exception as e:
             self.removeToolBar(self.file_toolbar)
             show_error_dialog(e, show_traceback=True)
 
-    def add_files_to_tree(self, item):
-        """ Runs `S3FileListFetchThread` """
-        if item.childCount() == 0:
-            bucket_or_folder = item.data(5, Qt.UserRole) if item.data(5, Qt.UserRole) else item.text(0)
-            self.s3_file_list_fetch_thread = S3FileListFetchThread(bucket_or_folder, item)
-            self.s3_file_list_fetch_thread.file_list_fetched.connect(self.add_file_item_to_tree)
-            self.s3_file_list_fetch_thread.start()
-
-    def add_file_item_to_tree(self, file, item):
-        """ Adds file/folder items to treeview """
-        file = json.loads(file)
-        file_item = QTreeWidgetItem(item)
-        file_item.setText(0, StringUtils.format_object_name(file["name"]))
-        file_item.setIcon(0, self.icon_type[file["type"]])
-        file_item.setText(1, file["type"])
-        file_item.setText(2, file["file_size"])
-        file_item.setText(3, file["last_modified"])
-        file_item.setData(4, Qt.UserRole, file["bucket"])
-        file_item.setData(5, Qt.UserRole, file["name"])
-        if file["type"] == ObjectType.FOLDER:
-            file_item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)  # Make folders expandable
-
     # ############### Fill Context Menu ############################
 
     def open_context_menu(self, position):
         """ Initializes context menu on treeview """
-        indexes = self.tree_widget.selectedIndexes()
-        if indexes:
-            if len(indexes) > 0:
-                level = 0
-                index = indexes[0]
-                while index.parent().isValid():
-                    index = index.parent()
-                    level += 1
-
+        object_type = self.get_object_type_from_selected_item()
+        if object_type:
             menu = QMenu()
-            if indexes[1].data() == ObjectType.BUCKET:
+            if object_type == ObjectType.BUCKET:
                 delete_bucket_action = QAction("Delete Bucket")
                 delete_bucket_action.setIcon(QIcon(resource_path('img/trash.svg')))
                 delete_bucket_action.triggered.connect(self.delete_bucket)
@@ -313,6 +341,18 @@ class MainWindow(QMainWindow):
                 create_folder_action.triggered.connect(self.create_folder)
                 menu.addAction(create_folder_action)
 
+                download_bucket_action = QAction("Download Bucket")
+                download_bucket_action.setIcon(QIcon(resource_path('img/save.svg')))
+                download_bucket_action.triggered.connect(functools.partial(self.download_files, False))
+                menu.addAction(download_bucket_action)
+
+                sync_bucket_action = QAction("Sync Bucket to Local Folder")
+                sync_bucket_action.setIcon(QIcon(resource_path('img/save.svg')))
+                sync_bucket_action.triggered.connect(self.sync_files)
+                menu.addAction(sync_bucket_action)
+
+                self.add_size_actions(menu)
+
                 tools_menu = menu.addMenu("Tools")
                 tools_menu.setIcon(QIcon(resource_path('img/tools.svg')))
 
@@ -328,7 +368,13 @@ class MainWindow(QMainWindow):
                 acl_action.triggered.connect(self.show_acl_window)
                 tools_menu.addAction(acl_action)
 
-            elif indexes[1].data() == ObjectType.FOLDER:
+                inventory_action = QAction(self)
+                inventory_action.setText("Inventory Report Location")
+                inventory_action.setIcon(QIcon(resource_path('img/tools.svg')))
+                inventory_action.triggered.connect(self.set_inventory_location)
+                tools_menu.addAction(inventory_action)
+
+            elif object_type == ObjectType.FOLDER:
                 delete_folder_action = QAction("Delete Folder")
                 delete_folder_action.setIcon(QIcon(resource_path('img/trash.svg')))
                 delete_folder_action.triggered.connect(self.delete_folder)
@@ -339,10 +385,22 @@ class MainWindow(QMainWindow):
                 create_folder_action.triggered.connect(self.create_folder)
                 menu.addAction(create_folder_action)
 
-            elif indexes[1].data() == ObjectType.FILE:
+                download_folder_action = QAction("Download Folder")
+                download_folder_action.setIcon(QIcon(resource_path('img/save.svg')))
+                download_folder_action.triggered.connect(functools.partial(self.download_files, False))
+                menu.addAction(download_folder_action)
+
+                sync_folder_action = QAction("Sync Folder to Local Folder")
+                sync_folder_action.setIcon(QIcon(resource_path('img/save.svg')))
+                sync_folder_action.triggered.connect(self.sync_files)
+                menu.addAction(sync_folder_action)
+
+                self.add_size_actions(menu)
+
+            elif object_type == ObjectType.FILE:
                 download_file_action = QAction("Download File(s)")
                 download_file_action.setIcon(QIcon(resource_path('img/save.svg')))
-                download_file_action.triggered.connect(self.download_files)
+                download_file_action.triggered.connect(functools.partial(self.download_files, False))
                 menu.addAction(download_file_action)
 
                 delete_file_action = QAction("Delete File")
@@ -360,7 +418,26 @@ class MainWindow(QMainWindow):
                 tools_menu.addAction(presigned_url_action)
                 menu.addMenu(tools_menu)
 
-            menu.exec_(self.tree_widget.viewport().mapToGlobal(position))
+            if object_type != ObjectType.FILE:
+                flat_view_action = QAction("Flat View", menu)
+                flat_view_action.triggered.connect(self.show_flat_view)
+                menu.addAction(flat_view_action)
+            if self.flat_view_widget is not None:
+                close_flat_view_action = QAction("Back to Tree View", menu)
+                close_flat_view_action.triggered.connect(self.close_flat_view)
+                menu.addAction(close_flat_view_action)
+
+            menu.exec_(self.get_active_view().viewport().mapToGlobal(position))
+
+    def add_size_actions(self, menu: QMenu) -> None:
+        """ Adds actions to calculate and cancel calculating sizes of selected buckets and folders """
+        calculate_size_action = QAction("Calculate Size", menu)
+        calculate_size_action.triggered.connect(self.calculate_sizes)
+        menu.addAction(calculate_size_action)
+        if self.size_aggregator.is_running():
+            cancel_size_action = QAction("Cancel Size Calculations", menu)
+            cancel_size_action.triggered.connect(lambda: self.size_aggregator.cancel())
+            menu.addAction(cancel_size_action)
 
     # ############### Actions ############################
 
@@ -372,7 +449,7 @@ class MainWindow(QMainWindow):
                 s3_session.resource.create_bucket(Bucket=bucket_name)
             except Exception as e:
                 show_error_dialog(e, show_traceback=True)
-            self.refresh_ui()
+            self.refresh_prefix()
 
     def create_folder(self) -> None:
         """ Create new folder in a S3 bucket or folder in any depth. """
@@ -386,17 +463,17 @@ class MainWindow(QMainWindow):
                 folder_path = f"{folder_name}/"
 
             try:
-                s3_session.resource.meta.client.put_object(Bucket=bucket_name, Body=b'',
-                                                           Key=folder_path)
+                s3_session.clients.client(bucket_name).put_object(Bucket=bucket_name, Body=b'',
+                                                                  Key=folder_path)
             except Exception as e:
                 show_error_dialog(e, show_traceback=True)
 
-            self.refresh_ui()
+            self.refresh_prefix(bucket_name, parent_folder_name)
 
     def delete_bucket(self) -> None:
         """ Deletes selected S3 bucket. It deletes all objects and versions recursively before deleting the bucket."""
         bucket_name = self.get_bucket_name_from_selected_item()
-        objects = s3_session.resource.meta.client.list_objects_v2(Bucket=bucket_name)
+        objects = s3_session.clients.client(bucket_name).list_objects_v2(Bucket=bucket_name)
         if 'Contents' not in objects or len(objects['Contents']) == 0:
             dlg = QMessageBox(self)
             dlg.setIcon(QMessageBox.Warning)
@@ -406,9 +483,11 @@ class MainWindow(QMainWindow):
             status = dlg.exec()
             if status == QMessageBox.Yes:
                 try:
-                    s3_session.resource.Bucket(bucket_name).delete()
+                    s3_session.clients.resource(bucket_name).Bucket(bucket_name).delete()
+                    s3_session.clients.forget(bucket_name)
                 except Exception as e:
                     show_error_dialog(e, show_traceback=True)
+                self.refresh_prefix()
         else:
             dlg = QMessageBox(self)
             dlg.setIcon(QMessageBox.Warning)
@@ -419,21 +498,23 @@ class MainWindow(QMainWindow):
             status = dlg.exec()
             if status == QMessageBox.Yes:
                 try:
-                    bucket_versioning = s3_session.resource.BucketVersioning(bucket_name)
+                    resource = s3_session.clients.resource(bucket_name)
+                    bucket_versioning = resource.BucketVersioning(bucket_name)
                     if bucket_versioning.status == 'Enabled':
-                        s3_session.resource.Bucket(bucket_name).object_versions.delete()
+                        resource.Bucket(bucket_name).object_versions.delete()
                     else:
-                        s3_session.resource.Bucket(bucket_name).objects.all().delete()
-                    s3_session.resource.Bucket(bucket_name).delete()
+                        delete_prefix(bucket_name)
+                    resource.Bucket(bucket_name).delete()
+                    s3_session.clients.forget(bucket_name)
                 except Exception as e:
                     show_error_dialog(e, show_traceback=True)
-            self.refresh_ui()
+            self.refresh_prefix()
 
     def delete_folder(self) -> None:
         """ Deletes selected folder recursively """
         bucket_name = self.get_bucket_name_from_selected_item()
         folder_name = self.get_object_key_from_selected_item()
-        bucket = s3_session.resource.Bucket(bucket_name)
+        bucket = s3_session.clients.resource(bucket_name).Bucket(bucket_name)
         folder_objects = bucket.objects.filter(Prefix=folder_name)
         if list(folder_objects.limit(1)):
             dlg = QMessageBox(self)
@@ -443,8 +524,21 @@ class MainWindow(QMainWindow):
             dlg.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
             status = dlg.exec()
             if status == QMessageBox.Yes:
-                folder_objects.delete()
-                self.refresh_ui()
+                try:
+                    delete_prefix(bucket_name, folder_name)
+                except Exception as e:
+                    show_error_dialog(e, show_traceback=True)
+                self.refresh_prefix(bucket_name, StringUtils.parent_prefix(folder_name))
+
+    def calculate_sizes(self) -> None:
+        """ Calculates total size and object count of selected buckets and folders in background """
+        for index in self.get_selected_indexes():
+            object_type = index.data(S3ObjectTreeModel.ObjectTypeRole)
+            if object_type == ObjectType.BUCKET:
+                self.size_aggregator.start(index.data(S3ObjectTreeModel.BucketRole))
+            elif object_type == ObjectType.FOLDER:
+                self.size_aggregator.start(index.data(S3ObjectTreeModel.BucketRole),
+                                           index.data(S3ObjectTreeModel.KeyRole))
 
     def delete_file(self) -> None:
         """ Deletes selected file """
@@ -457,16 +551,15 @@ class MainWindow(QMainWindow):
         dlg.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
         status = dlg.exec()
         if status == QMessageBox.Yes:
-            s3_session.resource.Object(bucket_name, object_key).delete()
-            self.refresh_ui()
+            s3_session.clients.resource(bucket_name).Object(bucket_name, object_key).delete()
+            self.refresh_prefix(bucket_name, StringUtils.parent_prefix(object_key))
 
     def global_create(self) -> None:
         """ Creates bucket or folder. It triggers after clicking 'Create' button in toolbox. """
-        indexes = self.tree_widget.selectedIndexes()
-        if len(indexes) == 0:
+        object_type = self.get_object_type_from_selected_item()
+        if object_type is None:
             self.create_bucket()
         else:
-            object_type = indexes[1].data()
             if object_type == ObjectType.BUCKET:
                 self.create_folder()
             elif object_type == ObjectType.FOLDER:
@@ -474,8 +567,7 @@ class MainWindow(QMainWindow):
 
     def global_delete(self) -> None:
         """ Deletes selected bucket, folder or file recursively. It triggers after clicking 'Delete' button in toolbox. """
-        indexes = self.tree_widget.selectedIndexes()
-        object_type = indexes[1].data()
+        object_type = self.get_object_type_from_selected_item()
         if object_type == ObjectType.BUCKET:
             self.delete_bucket()
         elif object_type == ObjectType.FOLDER:
@@ -492,26 +584,37 @@ class MainWindow(QMainWindow):
         file_dialog.setFileMode(QFileDialog.ExistingFiles)
         if file_dialog.exec_():
             filenames = file_dialog.selectedFiles()
-            for file in filenames:
-                self.upload_dialog = UploadDialog(file, bucket_name, folder_name)
-                self.upload_dialog.exec_()
-                self.upload_dialog.cleanup()
-            self.refresh_ui()
+            upload_dialog = UploadDialog(filenames, bucket_name, folder_name)
+            upload_dialog.uploads_finished.connect(functools.partial(self.refresh_prefix, bucket_name, folder_name))
+            self.show_transfer_dialog(upload_dialog)
 
 
-    def download_files(self) -> None:
-        """Downloads multiple files to selected local folder path"""
-        selected_items = self.tree_widget.selectedItems()
+    def download_files(self, sync: bool = False) -> None:
+        """
+        Downloads selected files, folders and buckets to selected local folder path. With sync, files whose local
+        copy is up to date are skipped and local files missing from S3 can be deleted.
+        """
+        selected_items = self.get_selected_indexes()
         if not selected_items:
             return
         
-        # Get all selected file keys with their bucket names
+        # Get object records of all selected items
+        selected = [index.model().object_at(index) for index in selected_items]
+        # Folders and buckets are listed recursively, items inside another selected item would be downloaded twice
+        prefixes = {(obj.key, "") if obj.type == ObjectType.BUCKET else (obj.bucket, obj.key)
+                    for obj in selected if obj is not None and obj.type != ObjectType.FILE}
         file_list = []
-        for item in selected_items:
-            if item.text(1) == ObjectType.FILE:
-                bucket_name = item.data(4, Qt.UserRole)
-                file_key = item.data(5, Qt.UserRole)
-                file_list.append((bucket_name, file_key))
+        for obj in selected:
+            if obj is None:
+                continue
+            if obj.type == ObjectType.BUCKET:
+                file_list.append(obj)
+                continue
+            parent = StringUtils.parent_prefix(obj.key)
+            while parent and (obj.bucket, parent) not in prefixes:
+                parent = StringUtils.parent_prefix(parent)
+            if (obj.bucket, parent) not in prefixes:
+                file_list.append(obj)
         
         if not file_list:
             return
@@ -520,9 +623,33 @@ class MainWindow(QMainWindow):
         file_dialog = QFileDialog()
         file_dialog.setWindowTitle("Select folder to download")
         local_path = file_dialog.getExistingDirectory()
-        if local_path:
-            self.download_dialog = MultiDownloadProgressDialog(file_list, local_path)
-            self.download_dialog.exec_()
+        if not local_path:
+            return
+        delete_missing = False
+        if sync:
+            dlg = QMessageBox(self)
+            dlg.setIcon(QMessageBox.Question)
+            dlg.setWindowTitle("Sync")
+            dlg.setText("Delete local files that are not in S3 anymore? This operation cannot be undone.")
+            dlg.setStandardButtons(QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
+            dlg.setDefaultButton(QMessageBox.No)
+            status = dlg.exec()
+            if status == QMessageBox.Cancel:
+                return
+            delete_missing = status == QMessageBox.Yes
+        self.show_transfer_dialog(MultiDownloadProgressDialog(file_list, local_path, sync=sync,
+                                                              delete_missing=delete_missing))
+
+    def sync_files(self) -> None:
+        """ Downloads only new and changed files of selected folders and buckets """
+        self.download_files(sync=True)
+
+    def show_transfer_dialog(self, dialog: QDialog) -> None:
+        """ Shows an upload or download dialog without blocking other transfers """
+        # Closed dialogs have finished their transfers
+        self.transfer_dialogs = [x for x in self.transfer_dialogs if x.isVisible()]
+        self.transfer_dialogs.append(dialog)
+        dialog.show()
 
     def show_manage_credential_window(self) -> None:
         """ Open credential management window """
@@ -531,10 +658,73 @@ class MainWindow(QMainWindow):
             functools.partial(self.fill_credentials, self.credential_selector.currentIndex()))
         self.manage_credential_window.show()
 
+    def show_flat_view(self) -> None:
+        """ Shows every key under selected bucket or folder as one flat list in place of the treeview """
+        bucket_name = self.get_bucket_name_from_selected_item()
+        prefix = self.get_object_key_from_selected_item() or ""
+        self.close_flat_view()
+        self.flat_view_widget = FlatViewWidget(main_widget=self, bucket=bucket_name, prefix=prefix)
+        self.flat_view_widget.model.fetch_failed.connect(functools.partial(show_error_dialog, show_traceback=True))
+        self.flat_view_widget.view.customContextMenuRequested.connect(self.open_context_menu)
+        self.flat_view_widget.view.selectionModel().selectionChanged.connect(self.handle_selection)
+        self.tree_view.hide()
+        self.tree_widget_wrapper_lay.addWidget(self.flat_view_widget)
+        self.handle_selection(None, None)
+
+    def close_flat_view(self) -> None:
+        """ Closes flat view and shows the treeview again """
+        if self.flat_view_widget is None:
+            return
+        self.flat_view_widget.close()
+        self.tree_widget_wrapper_lay.removeWidget(self.flat_view_widget)
+        self.flat_view_widget.deleteLater()
+        self.flat_view_widget = None
+        if self.tree_view is not None:
+            self.tree_view.show()
+            self.handle_selection(None, None)
+
     def refresh_ui(self) -> None:
-        """ Refreshes the file treeview """
+        """ Refreshes bucket list and expanded folders in the file treeview, keeping expansion and selection """
+        if self.flat_view_widget is not None:
+            self.flat_view_widget.model.reload()
+        if self.tree_model is None or self.tree_model.static:
+            self.reload_ui()
+            return
+        try:
+            buckets = s3_session.resource.meta.client.list_buckets()['Buckets']
+            s3_session.clients.resolve_regions(buckets)
+        except Exception as e:
+            show_error_dialog(e, show_traceback=True)
+            return
+        self.tree_model.refresh(buckets, self.tree_view.isExpanded)
+
+    def refresh_prefix(self, bucket_name: str = None, prefix: str = None) -> None:
+        """ Refreshes only the bucket list, or only the bucket or folder an operation has changed """
+        if self.tree_model is None or self.tree_model.static:
+            self.reload_ui()
+            return
+        if self.flat_view_widget is not None and self.flat_view_widget.model.bucket == bucket_name:
+            self.flat_view_widget.model.reload()
+        try:
+            if bucket_name is None:
+                buckets = s3_session.resource.meta.client.list_buckets()['Buckets']
+                s3_session.clients.resolve_regions(buckets)
+                self.tree_model.refresh_buckets(buckets)
+                if self.flat_view_widget is not None and \
+                        self.flat_view_widget.model.bucket not in [bucket['Name'] for bucket in buckets]:
+                    self.close_flat_view()
+            else:
+                self.tree_model.refresh_prefix(bucket_name, prefix or "")
+        except Exception as e:
+            show_error_dialog(e, show_traceback=True)
+
+    def reload_ui(self) -> None:
+        """ Rebuilds toolbars and the file treeview from scratch """
         self.removeToolBar(self.file_toolbar)
         self.show_s3_files(self.credential_selector.currentIndex())
+        if self.tree_model:
+            # Keep rendering visited folders from cache but make sure they are listed again
+            self.tree_model.expire_cache()
         self.search_widget = SearchWidget(main_widget=self)
         if self.layout.itemAt(2):
             if isinstance(self.layout.itemAt(2).widget(), SearchWidget):
@@ -543,6 +733,7 @@ class MainWindow(QMainWindow):
                         action.setDisabled(True)
 
     def search(self):
+        self.close_flat_view()
         self.search_widget = SearchWidget(main_widget=self)
         for idx, action in enumerate(self.file_toolbar.actions()):
             if idx in [5]:
@@ -551,8 +742,7 @@ class MainWindow(QMainWindow):
 
     def show_cors_window(self) -> None:
         """ Open CORS configuration window """
-        indexes = self.tree_widget.selectedIndexes()
-        if indexes[1].data() == ObjectType.BUCKET:
+        if self.get_object_type_from_selected_item() == ObjectType.BUCKET:
             bucket_name = self.get_bucket_name_from_selected_item()
             # get bucket name and pass it to CORSWindow
             self.cors_window = CORSWindow(bucket_name=bucket_name)
@@ -560,8 +750,7 @@ class MainWindow(QMainWindow):
 
     def get_presigned_download_url(self):
         """ Opens a dialog to get presigned URL for a file """
-        indexes = self.tree_widget.selectedIndexes()
-        if indexes[1].data() == ObjectType.FILE:
+        if self.get_object_type_from_selected_item() == ObjectType.FILE:
             bucket_name = self.get_bucket_name_from_selected_item()
             file_key = self.get_object_key_from_selected_item()
             expires_dialog = TimeIntervalInputDialog(window_title="Expire Time ?",
@@ -570,21 +759,70 @@ class MainWindow(QMainWindow):
                                                      max_seconds=604800)
             if expires_dialog.exec():
                 print(expires_dialog.value)
-                url = s3_session.resource.meta.client.generate_presigned_url('get_object',
-                                                                         Params={'Bucket': bucket_name, 'Key': file_key},
-                                                                         ExpiresIn=expires_dialog.value_as_seconds)
+                url = s3_session.clients.client(bucket_name).generate_presigned_url(
+                    'get_object', Params={'Bucket': bucket_name, 'Key': file_key},
+                    ExpiresIn=expires_dialog.value_as_seconds)
                 QMessageBox.information(self, f"Presigned URL for {file_key}", url)
 
     def show_acl_window(self):
         """ Open Access Control List configuration window """
-        indexes = self.tree_widget.selectedIndexes()
-        if indexes[1].data() == ObjectType.BUCKET:
+        if self.get_object_type_from_selected_item() == ObjectType.BUCKET:
             bucket_name = self.get_bucket_name_from_selected_item()
             # get bucket name and pass it to ACLWindow
             # acl = s3_session.resource.meta.client.get_bucket_acl(Bucket=bucket_name)
             self.acl_window = ACLWindow(bucket_name=bucket_name)
             self.acl_window.show()
 
+    def set_inventory_location(self) -> None:
+        """ Set location of S3 Inventory reports searches of the selected bucket read """
+        bucket_name = self.get_bucket_name_from_selected_item()
+        credential = self.tree_model.cache_scope[0]
+        location, ok = QInputDialog.getText(
+            self, 'Inventory Report Location',
+            f'Please enter s3:// location of a manifest.json or of the folder inventory reports of {bucket_name} '
+            f'are delivered to.\nLeave empty to detect it from the inventory configuration of the bucket.',
+            text=self.inventory_locations.get(credential, bucket_name) or "")
+        if not ok:
+            return
+        try:
+            location = location.strip() or self._confirm_detected_inventory_location(bucket_name)
+            self.inventory_locations.set(credential, bucket_name, location)
+        except Exception as e:
+            show_error_dialog(e)
+
+    def _confirm_detected_inventory_location(self, bucket_name: str) -> Optional[str]:
+        """ Detects location of inventory reports of the bucket, returns it if the user confirms to search them """
+        location = detect_inventory_location(bucket_name)
+        if location is None:
+            QMessageBox.information(self, 'Inventory Report Location',
+                                    f'No enabled inventory configuration found for {bucket_name}.')
+            return None
+        manifest = load_manifest(location)
+        status = QMessageBox.question(
+            self, 'Inventory Report Location',
+            f'Inventory reports of {bucket_name} are delivered to {location}.\n'
+            f'The latest report was created at {StringUtils.format_datetime(manifest.created_at)}, keys changed '
+            f'after a report was created are not found by searches reading it.\n\nSearch {bucket_name} from its '
+            f'inventory reports?')
+        return location if status == QMessageBox.Yes else None
+
+    def show_transfer_settings_dialog(self) -> None:
+        """ Open transfer settings of the selected credential """
+        cred = self.credentials_manager.get_credential(self.credential_selector.currentText())
+        if not cred:
+            return
+        dialog = TransferSettingsDialog(cred['name'], s3_session.transfer_settings, parent=self)
+        if dialog.exec_():
+            try:
+                TransferSettingsStore().set(cred['name'], cred['endpoint'], dialog.settings)
+            except Exception as e:
+                show_error_dialog(e, show_traceback=True)
+                return
+            # Transfers started from now on use the new settings
+            s3_session.transfer_settings = dialog.settings
+            s3_session.clients.set_max_pool_connections(dialog.settings.max_pool_connections)
+            transfer_scheduler.set_limits(dialog.settings.max_files, dialog.settings.max_pool_connections)
+
     def open_about_window(self) -> None:
         """ Open about window """
         self.about_window = AboutWindow()
@@ -123,7 +123,7 @@ class ACLWindow(QWidget):
             self.fine_grained_permission_table.removeRow(selected_row)
 
     def load_acl_rules(self):
-        acl = s3_session.resource.meta.client.get_bucket_acl(Bucket=self.bucket_name)
+        acl = s3_session.clients.client(self.bucket_name).get_bucket_acl(Bucket=self.bucket_name)
         self.bucket_owner_input.setText(acl['Owner']['ID'])
         self.bucket_owner_displayname_label.setText(acl['Owner']['DisplayName'])
         if 'Grants' in acl:
@@ -189,7 +189,7 @@ class ACLWindow(QWidget):
         }
 
         try:
-            s3_session.resource.meta.client.put_bucket_acl(
+            s3_session.clients.client(self.bucket_name).put_bucket_acl(
                 Bucket=self.bucket_name,
                 AccessControlPolicy=acl
             )
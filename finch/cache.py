@@ -0,0 +1,188 @@
+import os
+import sqlite3
+import time
+import zlib
+from typing import NamedTuple, Optional, Tuple
+
+from finch.common import CONFIG_PATH
+from finch.listing import ObjectRows
+
+# Credential name and endpoint url, listings of different credentials never share entries
+CacheScope = Tuple[str, str]
+
+
+class CachedListing(NamedTuple):
+    rows: ObjectRows
+    fetched_at: float
+    complete: bool  # False when only the first pages of the folder were listed
+
+
+class PrefixSize(NamedTuple):
+    size: int  # Total bytes of every object under the prefix
+    count: int  # Number of objects under the prefix
+    computed_at: float
+
+
+class ListingCache:
+    """
+    SQLite backed cache of folder listings, keyed by credential, endpoint, bucket and prefix.
+
+    Entries older than `ttl` seconds are still returned but reported as stale so that callers can render
+    them and revalidate in background. The database is kept under `max_bytes` by evicting least recently
+    used entries. The cache is best effort, database errors are treated as cache misses.
+    """
+    DEFAULT_TTL = 5 * 60
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+    # Listings bigger than this are not cached, serializing them on every page would cost more than listing
+    MAX_ROWS = 100_000
+
+    def __init__(self, path: str = None, ttl: float = DEFAULT_TTL, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = path or os.path.join(CONFIG_PATH, "listing_cache.sqlite3")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(self.path, timeout=5)
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS listings (
+                    credential TEXT NOT NULL,
+                    endpoint TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    prefix TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    complete INTEGER NOT NULL,
+                    keys BLOB NOT NULL,
+                    sizes BLOB NOT NULL,
+                    mtimes BLOB NOT NULL,
+                    types BLOB NOT NULL,
+                    PRIMARY KEY (credential, endpoint, bucket, prefix)
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS sizes (
+                    credential TEXT NOT NULL,
+                    endpoint TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    prefix TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    computed_at REAL NOT NULL,
+                    PRIMARY KEY (credential, endpoint, bucket, prefix)
+                )""")
+
+    @classmethod
+    def open(cls, path: str = None) -> Optional["ListingCache"]:
+        """ Opens the cache, `None` if the database can't be opened, e.g. it is corrupt or not writable """
+        try:
+            return cls(path)
+        except sqlite3.Error:
+            return None
+
+    def is_stale(self, listing: CachedListing) -> bool:
+        return time.time() - listing.fetched_at > self.ttl
+
+    def get(self, scope: CacheScope, bucket: str, prefix: str) -> Optional[CachedListing]:
+        """ Returns cached listing of the prefix or `None` """
+        try:
+            row = self.connection.execute(
+                "SELECT fetched_at, complete, keys, sizes, mtimes, types FROM listings "
+                "WHERE credential = ? AND endpoint = ? AND bucket = ? AND prefix = ?",
+                (*scope, bucket, prefix)).fetchone()
+            if row is None:
+                return None
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE listings SET accessed_at = ? "
+                    "WHERE credential = ? AND endpoint = ? AND bucket = ? AND prefix = ?",
+                    (time.time(), *scope, bucket, prefix))
+        except sqlite3.Error:
+            return None
+        fetched_at, complete, keys, sizes, mtimes, types = row
+        try:
+            keys = zlib.decompress(keys).decode("utf-8")
+            rows = ObjectRows.from_columns(keys.split("\0") if keys else [], zlib.decompress(sizes),
+                                           zlib.decompress(mtimes), types)
+        except (zlib.error, UnicodeDecodeError, ValueError):
+            # Corrupt entry, it is listed again
+            self.invalidate(scope, bucket, prefix)
+            return None
+        return CachedListing(rows, fetched_at, bool(complete))
+
+    def put(self, scope: CacheScope, bucket: str, prefix: str, rows: ObjectRows, complete: bool) -> None:
+        """ Stores listing of the prefix and evicts old entries if the cache is over its size limit """
+        if len(rows) > self.MAX_ROWS:
+            self.invalidate(scope, bucket, prefix)
+            return
+        keys, sizes, mtimes, types = rows.to_columns()
+        now = time.time()
+        try:
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (*scope, bucket, prefix, now, now, int(complete),
+                     zlib.compress("\0".join(keys).encode("utf-8")), zlib.compress(sizes), zlib.compress(mtimes),
+                     types))
+            self._evict()
+        except sqlite3.Error:
+            pass
+
+    def invalidate(self, scope: CacheScope, bucket: str, prefix: str = None) -> None:
+        """ Removes cached listing of the prefix and its sub folders, or of the whole bucket.
+        Sizes of the prefix, its sub folders and the folders containing it are removed too. """
+        try:
+            with self.connection:
+                if prefix is None:
+                    for table in ("listings", "sizes"):
+                        self.connection.execute(
+                            f"DELETE FROM {table} WHERE credential = ? AND endpoint = ? AND bucket = ?",
+                            (*scope, bucket))
+                else:
+                    self.connection.execute(
+                        "DELETE FROM listings WHERE credential = ? AND endpoint = ? AND bucket = ? "
+                        "AND substr(prefix, 1, ?) = ?",
+                        (*scope, bucket, len(prefix), prefix))
+                    self.connection.execute(
+                        "DELETE FROM sizes WHERE credential = ? AND endpoint = ? AND bucket = ? "
+                        "AND (substr(prefix, 1, ?) = ? OR substr(?, 1, length(prefix)) = prefix)",
+                        (*scope, bucket, len(prefix), prefix, prefix))
+        except sqlite3.Error:
+            pass
+
+    def get_size(self, scope: CacheScope, bucket: str, prefix: str) -> Optional[PrefixSize]:
+        """ Returns aggregated size of the prefix or `None` """
+        try:
+            row = self.connection.execute(
+                "SELECT size, count, computed_at FROM sizes "
+                "WHERE credential = ? AND endpoint = ? AND bucket = ? AND prefix = ?",
+                (*scope, bucket, prefix)).fetchone()
+        except sqlite3.Error:
+            return None
+        return PrefixSize(*row) if row else None
+
+    def put_size(self, scope: CacheScope, bucket: str, prefix: str, size: PrefixSize) -> None:
+        try:
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO sizes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        (*scope, bucket, prefix, *size))
+        except sqlite3.Error:
+            pass
+
+    def _evict(self) -> None:
+        """ Deletes least recently used entries until the cache fits in `max_bytes` """
+        total, = self.connection.execute(
+            "SELECT COALESCE(SUM(length(keys) + length(sizes) + length(mtimes) + length(types)), 0) "
+            "FROM listings").fetchone()
+        if total <= self.max_bytes:
+            return
+        # Evict down to 3/4 of the limit so that eviction doesn't run after every put
+        target = total - self.max_bytes * 3 // 4
+        with self.connection:
+            for rowid, size in self.connection.execute(
+                    "SELECT rowid, length(keys) + length(sizes) + length(mtimes) + length(types) FROM listings "
+                    "ORDER BY accessed_at").fetchall():
+                if target <= 0:
+                    break
+                self.connection.execute("DELETE FROM listings WHERE rowid = ?", (rowid,))
+                target -= size
+
+    def close(self) -> None:
+        self.connection.close()
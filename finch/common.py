@@ -1,25 +1,140 @@
 import os.path
 import pathlib
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from typing import Union
+from typing import Union, Dict, List, Optional
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QPalette, QColor
 from PyQt5.QtWidgets import QDesktopWidget, QDialog, QVBoxLayout, QDialogButtonBox, QHBoxLayout, QComboBox, QWidget, \
-    QDoubleSpinBox
+    QDoubleSpinBox, QHeaderView
 
 from finch.error import show_error_dialog
 
 s3_session = boto3.session.Session()
+s3_session.clients = None  # S3ClientPool of the selected credential
+s3_session.transfer_settings = None  # TransferSettings of the selected credential
 
 CONFIG_PATH = os.path.join(Path.home(), ".config/finch")
 DATETIME_FORMAT = "%d %b %Y %H:%M"
 
 
+class S3ClientPool:
+    """
+    S3 resources of a credential, one per region. Bucket regions are resolved concurrently in background
+    and cached, so that operations on a bucket use a client pinned to its region instead of being redirected.
+    The GUI thread never waits for a lookup, its requests use the credential's region and are redirected until
+    the bucket's region is known.
+    """
+    REGION_WORKERS = 8
+
+    def __init__(self, endpoint_url: Optional[str], access_key: str, secret_key: str, region_name: Optional[str],
+                 max_pool_connections: int = 10):
+        self.session = boto3.session.Session(aws_access_key_id=access_key, aws_secret_access_key=secret_key,
+                                             region_name=region_name or None)
+        self.endpoint_url = endpoint_url or None
+        self.default_region = region_name or None
+        # Other endpoints serve every bucket from the same place, only AWS buckets are pinned to their region
+        self.pin_regions = not endpoint_url or "amazonaws.com" in endpoint_url
+        self.max_pool_connections = max_pool_connections
+        self._resources = {}
+        self._regions: Dict[str, Union[str, Future]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.REGION_WORKERS)
+        self._closed = False
+
+    def resource(self, bucket_name: str = None):
+        """ Returns S3 resource for the region of the bucket, or for the credential's region """
+        region = self.region(bucket_name) if bucket_name and self.pin_regions else self.default_region
+        with self._lock:
+            if region not in self._resources:
+                # Regional clients use the regional AWS endpoint, a custom endpoint url is only used for its region
+                endpoint_url = self.endpoint_url if region == self.default_region else None
+                self._resources[region] = self.session.resource(
+                    's3', endpoint_url=endpoint_url, region_name=region,
+                    config=Config(max_pool_connections=self.max_pool_connections))
+            return self._resources[region]
+
+    def client(self, bucket_name: str = None):
+        """ Returns S3 client for the region of the bucket, or for the credential's region """
+        return self.resource(bucket_name).meta.client
+
+    def region(self, bucket_name: str) -> Optional[str]:
+        """
+        Returns region of the bucket. Worker threads wait for a pending lookup, or resolve it themselves after the
+        pool is closed, e.g. transfers that still use the pool of the previous credential. The GUI thread gets the
+        credential's region while the lookup goes on in background.
+        """
+        on_gui_thread = threading.current_thread() is threading.main_thread()
+        with self._lock:
+            known = bucket_name in self._regions
+            region = self._regions.get(bucket_name)
+            if not known and not self._closed:
+                region = self._regions[bucket_name] = self._executor.submit(self._resolve_region, bucket_name)
+        if isinstance(region, Future):
+            if on_gui_thread and not region.done():
+                return self.default_region
+            region = region.result()
+        elif known:
+            return region
+        elif on_gui_thread:
+            return self.default_region
+        else:
+            region = self._resolve_region(bucket_name)
+        with self._lock:
+            self._regions[bucket_name] = region
+        return region
+
+    def resolve_regions(self, buckets: List[dict]) -> None:
+        """ Starts resolving regions of buckets returned by `list_buckets` in background """
+        if not self.pin_regions:
+            return
+        with self._lock:
+            if self._closed:
+                return
+            for bucket in buckets:
+                name = bucket['Name']
+                if bucket.get('BucketRegion'):
+                    self._regions[name] = bucket['BucketRegion']
+                elif name not in self._regions:
+                    self._regions[name] = self._executor.submit(self._resolve_region, name)
+
+    def set_max_pool_connections(self, max_pool_connections: int) -> None:
+        """ Changes connection pool size of clients, clients already in use keep their pool """
+        with self._lock:
+            if max_pool_connections != self.max_pool_connections:
+                self.max_pool_connections = max_pool_connections
+                self._resources = {}
+
+    def forget(self, bucket_name: str) -> None:
+        """ Removes cached region of a deleted bucket """
+        with self._lock:
+            self._regions.pop(bucket_name, None)
+
+    def _resolve_region(self, bucket_name: str) -> Optional[str]:
+        # S3 reports the bucket region in a header, also on redirect and access denied errors
+        try:
+            headers = self.client().head_bucket(Bucket=bucket_name)['ResponseMetadata']['HTTPHeaders']
+        except ClientError as e:
+            headers = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        except Exception:
+            headers = {}
+        return headers.get('x-amz-bucket-region') or self.default_region
+
+    def close(self) -> None:
+        """ Stops background lookups, pending lookups still finish and later ones are resolved by their caller """
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=False)
+
+
 def apply_theme(app):
     """ Apply Dark Theme """
     # Use light theme by default in Windows due color incompatibilities.
@@ -54,6 +169,18 @@ def center_window(self):
     self.move(geometry.topLeft())
 
 
+def set_column_widths(header: QHeaderView, widths: Dict[int, int]) -> None:
+    """
+    Stretches the first column of a view and gives other columns a width the user can change. Resizing to contents
+    would format every row of the model, views of large listings would render slower the more rows they have.
+    """
+    header.setStretchLastSection(False)
+    header.setSectionResizeMode(0, QHeaderView.Stretch)
+    for column, width in widths.items():
+        header.setSectionResizeMode(column, QHeaderView.Interactive)
+        header.resizeSection(column, width)
+
+
 def resource_path(relative_path):
     try:
         base_path = sys._MEIPASS
@@ -78,6 +205,11 @@ class StringUtils:
         else:
             return arr[-2]
 
+    def parent_prefix(key: str) -> str:
+        """ Function for getting parent folder prefix of a file or folder key, empty string for bucket root """
+        head, _, _ = key.rstrip('/').rpartition('/')
+        return f"{head}/" if head else ''
+
     def format_datetime(dt: datetime) -> str:
         """ Function for format dates """
         if dt:
@@ -97,6 +229,15 @@ class StringUtils:
             file_size /= 1024.0
         return f'{StringUtils.remove_trailing_zeros(f"{file_size:.{decimal_places}f}"): >8} {unit}'
 
+    def format_duration(seconds: float) -> str:
+        """ Function for formatting durations like remaining transfer time, e.g. 1 h 5 min """
+        seconds = int(seconds)
+        if seconds >= 3600:
+            return f"{seconds // 3600} h {seconds % 3600 // 60} min"
+        if seconds >= 60:
+            return f"{seconds // 60} min {seconds % 60} s"
+        return f"{seconds} s"
+
     def format_list_with_conjunction(items: list, conjunction='and') -> str:
         """Format list items with proper punctuation and conjunction.
         Example: ['a', 'b', 'c'] -> 'a, b and c'"""
@@ -105,6 +246,51 @@ class StringUtils:
         return items[0] if items else ''
 
 
+class S3Object:
+    """
+    Bucket, folder or file as listed from S3. Listings, search results and downloads pass the same record around,
+    display strings are formatted only when they are first used.
+    """
+    __slots__ = ("bucket", "key", "type", "size", "last_modified", "storage_class", "etag", "_name", "_size_text",
+                 "_date_text")
+
+    def __init__(self, bucket: str, key: str, type: ObjectType, size: int = 0,
+                 last_modified: Optional[datetime] = None, storage_class: Optional[str] = None,
+                 etag: Optional[str] = None):
+        self.bucket = bucket
+        self.key = key  # Object key, bucket name for buckets
+        self.type = type
+        self.size = size
+        self.last_modified = last_modified
+        self.storage_class = storage_class  # Known for listed files only
+        self.etag = etag  # Known for files of live listings only
+        self._name = None
+        self._size_text = None
+        self._date_text = None
+
+    def __repr__(self):
+        return f"S3Object({self.bucket!r}, {self.key!r}, {self.type.value}, {self.size})"
+
+    @property
+    def name(self) -> str:
+        """ Last part of the key, or bucket name """
+        if self._name is None:
+            self._name = self.key if self.type == ObjectType.BUCKET else StringUtils.format_object_name(self.key)
+        return self._name
+
+    @property
+    def size_text(self) -> str:
+        if self._size_text is None:
+            self._size_text = StringUtils.format_size(self.size)
+        return self._size_text
+
+    @property
+    def date_text(self) -> str:
+        if self._date_text is None:
+            self._date_text = StringUtils.format_datetime(self.last_modified)
+        return self._date_text
+
+
 class TimeIntervalInputDialog(QDialog):
     """Dialog for entering time interval"""
 
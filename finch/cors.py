@@ -123,7 +123,7 @@ class CORSWindow(QWidget):
     def load_cors_config(self):
         """Load existing CORS configuration for the bucket"""
         try:
-            response = s3_session.resource.meta.client.get_bucket_cors(Bucket=self.bucket_name)
+            response = s3_session.clients.client(self.bucket_name).get_bucket_cors(Bucket=self.bucket_name)
             rules = response.get('CORSRules', [])
             
             for rule in rules:
@@ -299,14 +299,14 @@ class CORSWindow(QWidget):
                 rules.append(self.rules_list.item(i).data(Qt.UserRole))
 
             if rules:
-                s3_session.resource.meta.client.put_bucket_cors(
+                s3_session.clients.client(self.bucket_name).put_bucket_cors(
                     Bucket=self.bucket_name,
                     CORSConfiguration={
                         'CORSRules': rules
                     }
                 )
             else:
-                s3_session.resource.meta.client.delete_bucket_cors(Bucket=self.bucket_name)
+                s3_session.clients.client(self.bucket_name).delete_bucket_cors(Bucket=self.bucket_name)
             
             QMessageBox.information(self, "Success", "CORS configuration applied successfully")
             
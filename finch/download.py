@@ -1,222 +1,553 @@
+import functools
+import json
 import os
-import time
-from queue import Queue
-from threading import Thread
-from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from threading import Event, Lock, Semaphore, Thread
+from typing import Callable, List, Dict, Optional, Tuple
 from dataclasses import dataclass
 
-from PyQt5.QtCore import QObject, pyqtSignal, QMutex, Qt, QThread
-from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QProgressBar, 
-                            QLabel, QPushButton, QScrollArea, QWidget)
+from botocore.exceptions import BotoCoreError, ClientError
+from PyQt5.QtCore import QObject, pyqtSignal, QMutex, QThread
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QLabel, QPushButton
 
-from finch.common import s3_session, StringUtils, center_window
+from finch.common import s3_session, StringUtils, center_window, S3Object, ObjectType, S3ClientPool
 from finch.error import show_error_dialog
+from finch.listing import iter_sharded_object_pages
+from finch.progress import ProgressSnapshot, TransferProgress, TransferState
+from finch.scheduler import TransferJob, TransferJobControls, TransferPaused, transfer_scheduler
+from finch.sync import SyncState
+from finch.transfer import TransferSettings
+from finch.widgets.transfers import TransferListWidget
+
+# Number of HeadObject requests sent at the same time for files whose size is not known
+SIZE_RESOLVE_WORKERS = 8
+# Files found by listing folders and buckets that wait for a transfer worker, listing pauses while they wait
+LISTED_DOWNLOADS_QUEUED = 1000
+# Requests sent for one part, a broken connection continues the part from the last received byte
+PART_ATTEMPTS = 3
+# Files of unfinished downloads, they are kept when a sync deletes local files missing from S3
+PARTIAL_SUFFIXES = (".part", ".part.json", ".part.json.tmp")
+
+
+def local_path(key: str, base_prefix: str = "") -> str:
+    """
+    Returns path of a local file relative to the download folder, mirroring the part of key after base_prefix.
+    Empty, "." and ".." names are dropped, so keys can't point outside of the download folder.
+    """
+    names = [name for name in key[len(base_prefix):].split("/") if name not in ("", ".", "..")]
+    return os.path.join(*names) if names else ""
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class ResumableDownload:
+    """
+    Downloads an object into a `.part` file with parallel ranged GetObject requests. ETag, size and completed byte
+    ranges of the object are kept in a `.part.json` sidecar, so a cancelled or failed download goes on from the
+    completed ranges next time, as long as the ETag of the object is unchanged.
+    """
+
+    def __init__(self, client, bucket: str, key: str, temp_file_path: str, settings: TransferSettings):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.temp_file_path = temp_file_path
+        self.state_path = f"{temp_file_path}.json"
+        self.settings = settings
+        self.etag = None
+        self.size = None
+        self.last_modified = None
+        self.completed: List[List[int]] = []  # Sorted and merged [start, end) ranges written to the part file
+        self._lock = Lock()
+        self._progress_lock = Lock()
+
+    @property
+    def completed_bytes(self) -> int:
+        return sum(end - start for start, end in self.completed)
+
+    def start(self) -> int:
+        """ Reads current ETag and size of the object and continues a partial download of it, returns the size """
+        head = self.client.head_object(Bucket=self.bucket, Key=self.key)
+        self.etag, self.size, self.last_modified = head['ETag'], head['ContentLength'], head['LastModified']
+        state = self._load_state()
+        if state is not None and state.get('etag') == self.etag and state.get('size') == self.size and \
+                os.path.exists(self.temp_file_path) and os.path.getsize(self.temp_file_path) == self.size:
+            self.completed = state['completed']
+        else:
+            # Object was changed or never downloaded, bytes of another version can't be reused
+            self.completed = []
+            with open(self.temp_file_path, 'wb') as f:
+                f.truncate(self.size)
+            self._save_state()
+        return self.size
+
+    def run(self, progress: Callable[[int], None], max_concurrency: int = None) -> None:
+        """
+        Downloads missing ranges, at most `max_concurrency` of them at once, by default as many as the settings
+        allow. `progress` is called with the length of every written chunk, an exception raised by it stops the
+        download. Bytes written until then are recorded in the sidecar.
+        """
+        part_size = self.settings.part_size_for(self.size)
+        parts = [(start, min(start + part_size, gap_end))
+                 for gap_start, gap_end in self._missing_ranges()
+                 for start in range(gap_start, gap_end, part_size)]
+        if not parts:
+            return
+        stop = Event()
+        max_concurrency = max_concurrency or self.settings.max_concurrency
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(parts))) as executor:
+            futures = [executor.submit(self._download_part, start, end, progress, stop) for start, end in parts]
+            try:
+                for future in futures:
+                    future.result()
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'PreconditionFailed':
+                    raise
+                # Parts downloaded so far belong to the previous version
+                stop.set()
+                executor.shutdown(wait=True)
+                self.discard()
+                raise RuntimeError(f"{self.key} was changed during download, download it again") from e
+            finally:
+                stop.set()
+
+    def finish(self, file_path: str) -> None:
+        """ Moves the completed download to file_path """
+        os.replace(self.temp_file_path, file_path)
+        _remove_file(self.state_path)
+
+    def discard(self) -> None:
+        _remove_file(self.temp_file_path)
+        _remove_file(self.state_path)
+
+    def _missing_ranges(self):
+        position = 0
+        for start, end in self.completed:
+            if start > position:
+                yield position, start
+            position = max(position, end)
+        if position < self.size:
+            yield position, self.size
+
+    def _download_part(self, start: int, end: int, progress: Callable[[int], None], stop: Event) -> None:
+        if stop.is_set():
+            return
+        position = start
+        with open(self.temp_file_path, 'r+b') as f:
+            f.seek(start)
+            try:
+                for attempt in range(PART_ATTEMPTS):
+                    try:
+                        # Requests fail with PreconditionFailed if the object is replaced in the meantime
+                        resp = self.client.get_object(Bucket=self.bucket, Key=self.key, IfMatch=self.etag,
+                                                      Range=f"bytes={position}-{end - 1}")
+                        with closing(resp['Body']) as body:
+                            for chunk in body.iter_chunks(self.settings.io_chunk_size):
+                                if stop.is_set():
+                                    return
+                                f.write(chunk)
+                                position += len(chunk)
+                                with self._progress_lock:
+                                    progress(len(chunk))
+                    except BotoCoreError:
+                        if attempt == PART_ATTEMPTS - 1:
+                            raise
+                    if position >= end:
+                        return
+                raise IOError(f"Connection closed before bytes {position}-{end - 1} of {self.key} were received")
+            except Exception:
+                # Other parts stop too, the download is continued later
+                stop.set()
+                raise
+            finally:
+                if position > start:
+                    # Bytes are on the disk before the sidecar says so
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self._complete(start, position)
+
+    def _complete(self, start: int, end: int) -> None:
+        with self._lock:
+            merged = []
+            for range_start, range_end in sorted(self.completed + [[start, end]]):
+                if merged and range_start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], range_end)
+                else:
+                    merged.append([range_start, range_end])
+            self.completed = merged
+            self._save_state()
+
+    def _load_state(self) -> Optional[dict]:
+        try:
+            with open(self.state_path, 'r') as state_file:
+                return json.loads(state_file.read())
+        except (OSError, ValueError):
+            return None
+
+    def _save_state(self) -> None:
+        # Written aside and renamed, an interruption never leaves a truncated sidecar
+        with open(f"{self.state_path}.tmp", 'w') as state_file:
+            state_file.write(json.dumps({'bucket': self.bucket, 'key': self.key, 'etag': self.etag,
+                                         'size': self.size, 'completed': self.completed}))
+        os.replace(f"{self.state_path}.tmp", self.state_path)
+
 
 @dataclass
 class S3DownloadItem:
-    bucket_name: str
-    key: str
+    obj: S3Object
     destination: str
-    filename: str
+    filename: str  # Path relative to destination, see `local_path`
     total_size: Optional[int] = None
     downloaded: int = 0
-    status: str = 'pending'  # pending, downloading, completed, failed
-    start_time: float = 0.0
-    last_update_time: float = 0.0
-    last_downloaded: int = 0
-    speed: float = 0.0  # bytes per second
-    
-    def __post_init__(self):
-        # Create a unique filename that includes path structure
-        base_name = os.path.basename(self.key)
-        name, ext = os.path.splitext(base_name)
-        
-        if '/' in self.key:
-            # Use bucket and path for uniqueness, but keep the extension proper
-            path_hash = self.key.replace('/', '_').rsplit('.', 1)[0]
-            self.filename = f"{self.bucket_name}_{path_hash}{ext}"
-        else:
-            self.filename = f"{self.bucket_name}_{name}{ext}"
+    status: str = 'pending'  # pending, downloading, completed, skipped, failed
+    listed: bool = False  # Found by listing a folder or bucket, forgotten when it finishes
+
+    @property
+    def bucket_name(self) -> str:
+        return self.obj.bucket
+
+    @property
+    def key(self) -> str:
+        return self.obj.key
+
+    @property
+    def id(self) -> str:
+        """ Identifies the download in signals """
+        return f"{self.obj.bucket}/{self.obj.key}"
+
+    @property
+    def file_path(self) -> str:
+        return os.path.join(self.destination, self.filename)
+
 
 class MultiS3Downloader(QObject):
-    progress_updated = pyqtSignal(str, int, float)  # filename, percent, speed
-    download_completed = pyqtSignal(str)  # filename
-    download_failed = pyqtSignal(str, str)  # filename, error message
+    """
+    Downloads files as one job of the application's `TransferScheduler`. Files under added folders and buckets are
+    listed on another thread while files are downloaded, at most `LISTED_DOWNLOADS_QUEUED` of them wait for a worker
+    at once and they are forgotten when they finish, so memory doesn't grow with the number of listed files.
+    Signals identify files by `bucket/key`, progress is published by `progress` at a fixed rate.
 
-    def __init__(self, max_workers: int = 3):
+    In sync mode files whose local copy has the current version of the object are skipped, see `SyncState`, and
+    with `delete_missing` local files under added folders and buckets that are not in S3 anymore are deleted.
+    """
+    download_completed = pyqtSignal(str)  # id
+    download_skipped = pyqtSignal(str)  # id of a file whose local copy is up to date
+    local_files_deleted = pyqtSignal(int)  # number of local files deleted after listing a folder or bucket
+    download_failed = pyqtSignal(str, str)  # id, error message
+    size_resolved = pyqtSignal(str, object)  # id, size of a file whose size wasn't known when it was added
+    files_listed = pyqtSignal(list, list)  # ids and sizes of files listed under added folders and buckets
+    listing_failed = pyqtSignal(str, str)  # s3:// URL of the folder or bucket, error message
+    listing_finished = pyqtSignal()
+
+    def __init__(self, settings: TransferSettings = None, job: TransferJob = None, sync: bool = False,
+                 delete_missing: bool = False, clients: S3ClientPool = None):
         super().__init__()
-        self.download_queue = Queue()
         self.downloads: Dict[str, S3DownloadItem] = {}
-        self.max_workers = max_workers
-        self.workers: List[Thread] = []
+        # Credential and settings of when the download was created, switching credentials doesn't redirect it
+        self.clients = clients or s3_session.clients
+        self.settings = settings or s3_session.transfer_settings or TransferSettings()
+        self.job = job or TransferJob("Download")
+        self.job.set_limits(self.settings.max_files, self.settings.max_pool_connections)
+        self.scheduler = transfer_scheduler
+        self.started = False
         self.cleanup_mutex = QMutex()
         self.is_cancelled = False
+        self.size_resolver = None
+        self.prefixes: List[Tuple[str, str, str]] = []  # Bucket, prefix and destination of added folders
+        self.lister = None
+        self._listed_slots = Semaphore(LISTED_DOWNLOADS_QUEUED)
+        self.progress = TransferProgress()
+        self.sync_state = SyncState() if sync else None
+        self.delete_missing = sync and delete_missing
 
-    def add_download(self, bucket_name: str, key: str, destination: str) -> str:
-        """Add a download to the queue"""
+    def add_download(self, obj: S3Object, destination: str) -> str:
+        """
+        Add a download to the queue, the file is saved with its name in destination. Size of the object is taken
+        from its listing, `None` if it isn't known.
+        """
         download_item = S3DownloadItem(
-            bucket_name=bucket_name,
-            key=key,
+            obj=obj,
             destination=destination,
-            filename=os.path.basename(key)  # Initial filename
+            filename=local_path(obj.key, StringUtils.parent_prefix(obj.key)),
+            total_size=obj.size
         )
-        
-        # Get file size
-        try:
-            download_item.total_size = int(
-                s3_session.resource.meta.client.head_object(
-                    Bucket=bucket_name, 
-                    Key=key
-                )['ContentLength']
-            )
-        except Exception as e:
-            self.download_failed.emit(download_item.filename, str(e))
-            return None
 
-        # Store with unique ID
-        self.downloads[download_item.filename] = download_item
-        self.download_queue.put(download_item)
-        return download_item.filename
+        self.downloads[download_item.id] = download_item
+        if obj.size is not None:
+            self.progress.add_total(obj.size)
+        if self.started:
+            self._submit(download_item)
+        return download_item.id
+
+    def add_prefix(self, bucket: str, prefix: str, destination: str) -> None:
+        """
+        Add every file under prefix of bucket, empty prefix for the whole bucket. Files are listed after downloads
+        start, they are saved in a folder named like the folder or bucket in destination, mirroring their keys.
+        """
+        self.prefixes.append((bucket, prefix, destination))
 
     def start_downloads(self):
-        """Start the download workers"""
-        for _ in range(self.max_workers):
-            worker = Thread(target=self._download_worker, daemon=True)
-            worker.start()
-            self.workers.append(worker)
-
-    def _download_worker(self):
-        """Worker thread to process downloads"""
-        while True:
-            try:
-                download_item = self.download_queue.get()
-                if download_item is None:
-                    break
+        """Submit the downloads, start listing of folders and look up sizes that are not known in background"""
+        self.started = True
+        self.progress.start()
+        for item in list(self.downloads.values()):
+            self._submit(item)
+        if self.prefixes:
+            self.lister = Thread(target=self._list_prefixes, daemon=True)
+            self.lister.start()
+        unknown = [item for item in self.downloads.values() if item.total_size is None]
+        if unknown:
+            self.size_resolver = ThreadPoolExecutor(max_workers=SIZE_RESOLVE_WORKERS)
+            for item in unknown:
+                self.size_resolver.submit(self._resolve_size, item)
+
+    def _resolve_size(self, item: S3DownloadItem):
+        """Looks up size of a pending download, downloads that already started find it out themselves"""
+        if self.is_cancelled or item.status != 'pending' or item.total_size is not None:
+            return
+        try:
+            size = self.clients.client(item.bucket_name).head_object(
+                Bucket=item.bucket_name, Key=item.key)['ContentLength']
+        except Exception:
+            # Download reports the error, if the object really can't be read
+            return
+        self._set_size(item, size)
+
+    def _set_size(self, item: S3DownloadItem, size: int):
+        # Size from the listing is replaced too, it may be outdated
+        unknown = item.total_size is None
+        self.progress.add_total(size - (item.total_size or 0))
+        self.progress.set_size(item.id, size)
+        item.total_size = size
+        if unknown:
+            self.size_resolved.emit(item.id, size)
+
+    def _list_prefixes(self):
+        """Lists added folders and buckets and queues their files, pages of files are queued as they are listed"""
+        try:
+            for bucket, prefix, destination in self.prefixes:
+                if prefix:
+                    base_prefix = StringUtils.parent_prefix(prefix)
+                else:
+                    base_prefix = ""
+                    destination = os.path.join(destination, local_path(bucket))
+                # Local paths of listed files, files that are not among them are deleted after listing
+                listed_paths = set() if self.delete_missing else None
+                try:
+                    with closing(iter_sharded_object_pages(bucket, prefix, clients=self.clients)) as pages:
+                        for page in pages:
+                            files = [obj for obj in page.objects if obj.type == ObjectType.FILE]
+                            if listed_paths is not None:
+                                listed_paths.update(local_path(obj.key, base_prefix) for obj in files)
+                            self.progress.add_total(sum(obj.size for obj in files))
+                            self.files_listed.emit([f"{bucket}/{obj.key}" for obj in files],
+                                                   [obj.size for obj in files])
+                            for obj in page.objects:
+                                if self.is_cancelled:
+                                    return
+                                if obj.type != ObjectType.FILE:
+                                    # Folder placeholders are created, empty folders are mirrored too
+                                    os.makedirs(os.path.join(destination, local_path(obj.key, base_prefix)),
+                                                exist_ok=True)
+                                    continue
+                                item = S3DownloadItem(obj=obj, destination=destination,
+                                                      filename=local_path(obj.key, base_prefix),
+                                                      total_size=obj.size, listed=True)
+                                if not self._queue_listed(item):
+                                    return
+                except Exception as e:
+                    self.listing_failed.emit(f"s3://{bucket}/{prefix}", str(e))
+                    continue
+                if listed_paths is not None:
+                    self._delete_missing(destination, local_path(prefix, base_prefix), listed_paths)
+        finally:
+            self.listing_finished.emit()
+
+    def _delete_missing(self, destination: str, folder: str, listed_paths: set):
+        """Deletes local files under folder of destination that were not listed, files of unfinished downloads stay"""
+        deleted = 0
+        for directory, _, file_names in os.walk(os.path.join(destination, folder)):
+            if self.is_cancelled:
+                break
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                if file_name.endswith(PARTIAL_SUFFIXES) or os.path.relpath(path, destination) in listed_paths:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.sync_state.forget(path)
+                deleted += 1
+        if deleted:
+            self.local_files_deleted.emit(deleted)
+
+    def _queue_listed(self, item: S3DownloadItem) -> bool:
+        """Queues a listed file when a queued one is taken by a worker, returns False if downloads are cancelled"""
+        while not self._listed_slots.acquire(timeout=0.1):
+            if self.is_cancelled:
+                return False
+        if self.is_cancelled:
+            self._listed_slots.release()
+            return False
+        self.downloads[item.id] = item
+        self._submit(item)
+        return True
 
-                self._process_download(download_item)
-                self.download_queue.task_done()
-            except Exception as e:
-                if download_item:
-                    self.download_failed.emit(download_item.filename, str(e))
-                print(f"Error in download worker: {e}")
+    def _submit(self, item: S3DownloadItem):
+        # Files read with one request need one connection, larger files one per part downloaded at once
+        small = item.total_size is not None and item.total_size < self.settings.multipart_threshold
+        self.scheduler.submit(self.job, functools.partial(self._run_download, item),
+                              connections=1 if small else self.settings.max_concurrency,
+                              on_error=lambda e: self.download_failed.emit(item.id, str(e)))
+
+    def _run_download(self, item: S3DownloadItem, connections: int):
+        """Task run by the scheduler, `TransferPaused` queues it again"""
+        try:
+            self._process_download(item, connections)
+        except TransferPaused:
+            raise
+        except Exception as e:
+            self.download_failed.emit(item.id, str(e))
+            print(f"Error in download worker: {e}")
+        if item.listed:
+            self.downloads.pop(item.id, None)
+            self._listed_slots.release()
 
     def cancel(self):
         """Cancel all downloads"""
         self.is_cancelled = True
-        # Clear the queue
-        while not self.download_queue.empty():
-            try:
-                self.download_queue.get_nowait()
-            except:
-                pass
-        # Mark remaining downloads as cancelled
-        for item in self.downloads.values():
+        # Drop downloads waiting for a worker
+        self.scheduler.cancel(self.job)
+        # Mark remaining downloads as cancelled, listing adds downloads in the meantime
+        for item in list(self.downloads.values()):
             if item.status == 'pending' or item.status == 'downloading':
                 item.status = 'cancelled'
-                self.download_failed.emit(item.filename, "Download cancelled")
+                self.download_failed.emit(item.id, "Download cancelled")
 
-    def _process_download(self, item: S3DownloadItem):
-        """Process a single download"""
+    def _process_download(self, item: S3DownloadItem, connections: int = None):
+        """Process a single download, with at most `connections` parallel requests"""
+        file_path = item.file_path
+        temp_file_path = f"{file_path}.part"
+        resumable = None
         try:
             if self.is_cancelled:
                 return
 
+            if self.sync_state is not None and self._is_unchanged(item):
+                item.status = 'skipped'
+                # Counts as transferred, but not into the speed
+                self.progress.start_item(item.id, item.total_size, item.total_size)
+                self.progress.finish_item(item.id)
+                self.download_skipped.emit(item.id)
+                return
+
             item.status = 'downloading'
-            item.start_time = time.time()
-            item.last_update_time = item.start_time
-            os.makedirs(item.destination, exist_ok=True)
-            file_path = os.path.join(item.destination, item.filename)
-            temp_file_path = f"{file_path}.part"
+            item.downloaded = 0
+            self.progress.start_item(item.id, item.total_size)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
             def update_progress(bytes_amount):
                 if self.is_cancelled:
                     raise InterruptedError("Download cancelled")
-                    
+                if self.job.paused:
+                    raise TransferPaused()
                 item.downloaded += bytes_amount
-                current_time = time.time()
-                time_diff = current_time - item.last_update_time
-                
-                # Update speed every 0.5 seconds
-                if time_diff >= 0.5:
-                    bytes_diff = item.downloaded - item.last_downloaded
-                    item.speed = bytes_diff / time_diff
-                    item.last_downloaded = item.downloaded
-                    item.last_update_time = current_time
-                
-                if item.total_size:
-                    percent = int((item.downloaded / item.total_size) * 100)
-                    self.progress_updated.emit(item.filename, percent, item.speed)
-
-            with open(temp_file_path, 'wb') as f:
-                s3_session.resource.meta.client.download_fileobj(
-                    item.bucket_name,
-                    item.key,
-                    f,
-                    Callback=update_progress
-                )
+                # Only counted here, progress is published on the GUI thread at a fixed rate
+                self.progress.add(item.id, bytes_amount)
+
+            config = self.settings.transfer_config(item.total_size)
+            client = self.clients.client(item.bucket_name)
+            # Files smaller than a part are read with one GetObject, no HeadObject is needed before it and an
+            # outdated size from the listing doesn't matter. Larger files are downloaded in ranges that are kept
+            # when the download stops, the current size and ETag are read with a HeadObject.
+            if item.total_size is not None and item.total_size < config.multipart_threshold:
+                with open(temp_file_path, 'wb') as f:
+                    resp = client.get_object(Bucket=item.bucket_name, Key=item.key)
+                    self._set_size(item, resp['ContentLength'])
+                    etag, last_modified = resp.get('ETag'), resp.get('LastModified')
+                    with closing(resp['Body']) as body:
+                        for chunk in body.iter_chunks(config.io_chunksize):
+                            f.write(chunk)
+                            update_progress(len(chunk))
+            else:
+                resumable = ResumableDownload(client, item.bucket_name, item.key, temp_file_path, self.settings)
+                self._set_size(item, resumable.start())
+                # Bytes of an earlier attempt count as downloaded, but not into the speed
+                item.downloaded = resumable.completed_bytes
+                self.progress.start_item(item.id, item.total_size, item.downloaded)
+                update_progress(0)
+                resumable.run(update_progress, connections)
+                etag, last_modified = resumable.etag, resumable.last_modified
 
             if not self.is_cancelled:
                 # Only rename the file if download wasn't cancelled
-                os.replace(temp_file_path, file_path)
+                if resumable is not None:
+                    resumable.finish(file_path)
+                else:
+                    os.replace(temp_file_path, file_path)
+                if self.sync_state is not None:
+                    # Version the file was downloaded from, the next sync skips it while it is current
+                    self.sync_state.record(file_path, item.bucket_name, item.key, etag, item.total_size, last_modified)
                 item.status = 'completed'
-                self.download_completed.emit(item.filename)
+                # Finished files leave progress snapshots before the dialog hears of them
+                self.progress.finish_item(item.id)
+                self.download_completed.emit(item.id)
             else:
-                # Clean up partial download
-                try:
-                    os.remove(temp_file_path)
-                except:
-                    pass
+                self.progress.finish_item(item.id)
+                if resumable is None:
+                    # Clean up partial download, ranged downloads are continued next time
+                    _remove_file(temp_file_path)
 
+        except TransferPaused:
+            # Started again when the job is resumed, ranged downloads continue from the completed ranges
+            item.status = 'pending'
+            if resumable is None:
+                _remove_file(temp_file_path)
+            raise
         except InterruptedError:
             item.status = 'cancelled'
-            try:
-                os.remove(temp_file_path)
-            except:
-                pass
-            self.download_failed.emit(item.filename, "Download cancelled")
+            self.progress.finish_item(item.id)
+            if resumable is None:
+                _remove_file(temp_file_path)
+            self.download_failed.emit(item.id, "Download cancelled")
         except Exception as e:
             item.status = 'failed'
-            try:
-                os.remove(temp_file_path)
-            except:
-                pass
-            self.download_failed.emit(item.filename, str(e))
+            self.progress.finish_item(item.id)
+            if resumable is None:
+                _remove_file(temp_file_path)
+            self.download_failed.emit(item.id, str(e))
             show_error_dialog(e, show_traceback=True)
 
+    def _is_unchanged(self, item: S3DownloadItem) -> bool:
+        """Returns whether the local file of a download has the current version of its object"""
+        etag, last_modified = item.obj.etag, item.obj.last_modified
+        if etag is None:
+            # Files selected in the file list have no ETag, listed files have
+            head = self.clients.client(item.bucket_name).head_object(Bucket=item.bucket_name, Key=item.key)
+            self._set_size(item, head['ContentLength'])
+            etag, last_modified = head['ETag'], head['LastModified']
+        return self.sync_state.is_unchanged(item.file_path, item.bucket_name, item.key, etag, item.total_size,
+                                            last_modified, self.settings.part_size_for(item.total_size))
+
     def cleanup(self):
         """Cleanup resources"""
         self.cleanup_mutex.lock()
         self.cancel()  # Cancel any ongoing downloads
-        for _ in self.workers:
-            self.download_queue.put(None)
-        for worker in self.workers:
-            worker.join()
+        if self.size_resolver is not None:
+            self.size_resolver.shutdown(wait=True)
+        if self.lister is not None:
+            self.lister.join()
+        # Running downloads stop at their next chunk
+        self.scheduler.wait(self.job)
         self.cleanup_mutex.unlock()
 
-class DownloadProgressWidget(QWidget):
-    def __init__(self, filename: str, full_path: str):
-        super().__init__()
-        self.layout = QVBoxLayout()
-        self.layout.setContentsMargins(0, 0, 0, 10)
-        self.setLayout(self.layout)
-        
-        # Show the actual file path in the label
-        self.label = QLabel(full_path)
-        self.progress_bar = QProgressBar()
-        self.progress_bar.setMinimum(0)
-        self.progress_bar.setMaximum(100)
-        
-        self.layout.addWidget(self.label)
-        self.layout.addWidget(self.progress_bar)
-    
-    def update_progress(self, percent: int, speed: float = 0):
-        speed_str = f" - {StringUtils.format_size(speed)}/s" if speed > 0 else ""
-        self.label.setText(f"{self.label.text().split('...')[0]}... {percent}%{speed_str}")
-        self.progress_bar.setValue(percent)
-
-    def mark_cancelled(self):
-        self.label.setText(f"{self.label.text().split('...')[0]} - Cancelled")
-        self.progress_bar.setEnabled(False)
 
 class CleanupThread(QThread):
     def __init__(self, downloader):
@@ -226,17 +557,25 @@ class CleanupThread(QThread):
     def run(self):
         self.downloader.cleanup()
 
+
 class MultiDownloadProgressDialog(QDialog):
-    def __init__(self, file_list: List[tuple[str, str]], local_file_path: str):
+    def __init__(self, file_list: List[S3Object], local_file_path: str, sync: bool = False,
+                 delete_missing: bool = False):
         """
         Initialize multi-file download dialog
         
         Args:
-            file_list: List of tuples containing (bucket_name, key)
+            file_list: Object records of files, folders and buckets to download. Files under folders and buckets
+                are listed while downloading, they are added to the transfer list as they are listed.
             local_file_path: Local destination path
+            sync: Skip files whose local copy is up to date
+            delete_missing: Delete local files under folders and buckets that are not in S3 anymore, with sync
         """
         super().__init__()
-        self.setWindowTitle(f"Downloading {len(file_list)} files...")
+        files = [obj for obj in file_list if obj.type == ObjectType.FILE]
+        folders = [obj for obj in file_list if obj.type != ObjectType.FILE]
+        self.setWindowTitle(f"Downloading {len(file_list)} items..." if folders else
+                            f"Downloading {len(file_list)} files...")
         self.setMinimumWidth(400)
         self.setMinimumHeight(300)
         center_window(self)
@@ -245,18 +584,10 @@ class MultiDownloadProgressDialog(QDialog):
         layout = QVBoxLayout()
         self.setLayout(layout)
         
-        # Scroll area for progress bars
-        scroll = QScrollArea()
-        scroll.setWidgetResizable(True)
-        scroll.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
-        scroll.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        
-        # Container for progress bars
-        self.progress_container = QWidget()
-        self.progress_layout = QVBoxLayout()
-        self.progress_container.setLayout(self.progress_layout)
-        scroll.setWidget(self.progress_container)
-        
+        # Files and their progress, only rows in view are painted
+        self.transfer_list = TransferListWidget()
+        self.transfer_model = self.transfer_list.model
+
         # Status label
         self.status_label = QLabel("Initializing downloads...")
         
@@ -264,70 +595,133 @@ class MultiDownloadProgressDialog(QDialog):
         self.cancel_button = QPushButton("Cancel")
         self.cancel_button.clicked.connect(self.handle_cancel)
         
+        # Initialize downloader, it runs as one job of the transfer scheduler
+        self.downloader = MultiS3Downloader(job=TransferJob(self.windowTitle()), sync=sync,
+                                            delete_missing=delete_missing)
+        self.job_controls = TransferJobControls(self.downloader.job)
+
         # Add widgets to main layout
         layout.addWidget(self.status_label)
-        layout.addWidget(scroll)
+        layout.addWidget(self.transfer_list)
+        layout.addWidget(self.job_controls)
         layout.addWidget(self.cancel_button)
         
-        # Initialize downloader
-        self.downloader = MultiS3Downloader()
-        self.downloader.progress_updated.connect(self._update_progress)
+        self.downloader.progress.updated.connect(self._update_progress)
         self.downloader.download_completed.connect(self._handle_completion)
+        self.downloader.download_skipped.connect(self._handle_skipped)
+        self.downloader.local_files_deleted.connect(self._handle_local_files_deleted)
         self.downloader.download_failed.connect(self._handle_failure)
-        
-        self.total_files = len(file_list)
+        self.downloader.size_resolved.connect(self._handle_size_resolved)
+        self.downloader.files_listed.connect(self._handle_files_listed)
+        self.downloader.listing_failed.connect(self._handle_listing_failed)
+        self.downloader.listing_finished.connect(self._handle_listing_finished)
+
+        self.total_files = len(files)
         self.completed_files = 0
-        self.progress_widgets: Dict[str, DownloadProgressWidget] = {}
-        
-        # Create progress bars for each file
-        for bucket_name, key in file_list:
-            # Add download to queue and get the filename that will be used
-            filename = self.downloader.add_download(bucket_name, key, local_file_path)
-            if filename:  # Only create widget if download was added successfully
-                # Show the full path in the UI but use the unique filename for tracking
-                display_path = f"{bucket_name}/{key}"
-                progress_widget = DownloadProgressWidget(filename, display_path)
-                self.progress_widgets[filename] = progress_widget
-                self.progress_layout.addWidget(progress_widget)
-        
-        # Start downloads
-        self.downloader.start_downloads()
+        self.skipped_files = 0  # Files whose local copy was up to date, counted into completed files
+        self.deleted_files = 0  # Local files deleted because they are not in S3 anymore
+        self.listing = bool(folders)  # Set while files of folders are listed
+        # Number of files whose size is not known yet
+        self.unknown_sizes = sum(1 for obj in files if obj.size is None)
+        # Latest progress of the whole download
+        self.snapshot = ProgressSnapshot({}, 0, sum(obj.size for obj in files if obj.size is not None), 0.0, None)
+
+        # Add downloads to queue, they are listed by the id they are tracked with
+        self.transfer_model.add_items([self.downloader.add_download(obj, local_file_path) for obj in files],
+                                      [obj.size for obj in files])
+        for obj in folders:
+            if obj.type == ObjectType.BUCKET:
+                self.downloader.add_prefix(obj.key, "", local_file_path)
+            else:
+                self.downloader.add_prefix(obj.bucket, obj.key, local_file_path)
 
         # Add cleanup thread
         self.cleanup_thread = None
-        
-    def _update_progress(self, filename: str, percent: int, speed: float):
-        if filename in self.progress_widgets:
-            self.progress_widgets[filename].update_progress(percent, speed)
-            self.status_label.setText(f"Downloading files... ({self.completed_files}/{self.total_files} completed)")
 
-    def _handle_completion(self, filename: str):
-        self.completed_files += 1
-        if filename in self.progress_widgets:
-            self.progress_widgets[filename].label.setText(
-                f"{filename} - Completed"
-            )
-        
-        if self.completed_files == self.total_files:
-            self.status_label.setText("All downloads completed!")
+        # Start downloads
+        self.downloader.start_downloads()
+        self.status_label.setText(self._status_text())
+
+    def _status_text(self) -> str:
+        snapshot = self.snapshot
+        more = "+" if self.unknown_sizes or self.listing else ""
+        status = f"{self.completed_files}/{self.total_files}{'+' if self.listing else ''} completed, " \
+                 f"{StringUtils.format_size(snapshot.transferred).strip()} of " \
+                 f"{StringUtils.format_size(snapshot.total).strip()}{more}"
+        if snapshot.speed > 0:
+            status += f", {StringUtils.format_size(snapshot.speed).strip()}/s"
+        if self.downloader.job.paused:
+            status += ", paused"
+        elif snapshot.eta is not None and not more:
+            status += f", {StringUtils.format_duration(snapshot.eta)} left"
+        if self.listing:
+            status += ", listing folders"
+        return f"Downloading files... ({status}{self._sync_text()})"
+
+    def _sync_text(self) -> str:
+        text = f", {self.skipped_files} unchanged" if self.skipped_files else ""
+        if self.deleted_files:
+            text += f", {self.deleted_files} local files deleted"
+        return text
+
+    def _show_status(self):
+        if not self.listing and self.completed_files == self.total_files:
+            self.downloader.progress.stop()
+            sync_text = self._sync_text()
+            self.status_label.setText(f"All downloads completed! ({sync_text[2:]})" if sync_text else
+                                      "All downloads completed!")
             self.cancel_button.setText("Close")
-        else:
-            self.status_label.setText(f"Downloading files... ({self.completed_files}/{self.total_files} completed)")
+        elif self.cleanup_thread is None:
+            self.status_label.setText(self._status_text())
 
-    def _handle_failure(self, filename: str, error: str):
-        if filename in self.progress_widgets:
-            if error == "Download cancelled":
-                self.progress_widgets[filename].mark_cancelled()
-            else:
-                self.progress_widgets[filename].label.setText(
-                    f"{filename} - Failed: {error}"
-                )
-                show_error_dialog(f"Failed to download {filename}: {error}")
+    def _update_progress(self, snapshot: ProgressSnapshot):
+        self.snapshot = snapshot
+        self.transfer_model.update_progress(snapshot)
+        self.transfer_list.update_counts()
+        self._show_status()
+
+    def _handle_size_resolved(self, download_id: str, size: int):
+        self.unknown_sizes -= 1
+        self.transfer_model.set_size(download_id, size)
+
+    def _handle_files_listed(self, download_ids: List[str], sizes: List[int]):
+        self.total_files += len(download_ids)
+        self.transfer_model.add_items(download_ids, sizes)
+
+    def _handle_listing_failed(self, url: str, error: str):
+        show_error_dialog(f"Failed to list {url}: {error}")
+
+    def _handle_listing_finished(self):
+        self.listing = False
+        self._show_status()
+
+    def _handle_completion(self, download_id: str):
+        self.completed_files += 1
+        self.transfer_model.set_state(download_id, TransferState.COMPLETED)
+        self._show_status()
+
+    def _handle_skipped(self, download_id: str):
+        self.completed_files += 1
+        self.skipped_files += 1
+        self.transfer_model.set_state(download_id, TransferState.SKIPPED)
+        self._show_status()
+
+    def _handle_local_files_deleted(self, count: int):
+        self.deleted_files += count
+        self._show_status()
+
+    def _handle_failure(self, download_id: str, error: str):
+        if error == "Download cancelled":
+            self.transfer_model.set_state(download_id, TransferState.CANCELLED)
+        else:
+            self.transfer_model.set_state(download_id, TransferState.FAILED, error)
+            show_error_dialog(f"Failed to download {download_id}: {error}")
 
     def handle_cancel(self):
         """Handle cancel button click"""
         self.cancel_button.setEnabled(False)
         self.cancel_button.setText("Canceling...")
+        self.downloader.progress.stop()
         self.status_label.setText("Canceling downloads...")
         
         # Cancel downloads first
@@ -1,53 +1,925 @@
-import json
+import functools
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from enum import IntEnum
+from typing import Callable, Dict, Iterator, List, Optional
 
-from PyQt5.QtCore import QThread, pyqtSignal, Qt, QEventLoop
-from PyQt5.QtWidgets import QTreeWidgetItem
+from PyQt5.QtCore import pyqtSignal, Qt, QAbstractItemModel, QModelIndex, QTimer, QObject, QPoint, \
+    QAbstractTableModel, QItemSelection
+from PyQt5.QtWidgets import QTreeView
 
-from finch.common import StringUtils
-from finch.common import s3_session, ObjectType
+from finch.cache import ListingCache, CacheScope, PrefixSize
+from finch.common import StringUtils, ObjectType, S3Object
+from finch.jobs import BackgroundJob, JobPool
+from finch.listing import iter_object_pages, ObjectRows
+from finch.searchindex import SearchIndex
+from finch.sizes import PrefixSizeAggregator
 
+# Number of listing pages requested each time the view asks for more rows of a folder
+PAGES_PER_FETCH = 5
+# Maximum number of listing requests running at the same time
+MAX_CONCURRENT_LISTINGS = 4
+# Maximum number of folders being prefetched, running or waiting for a worker
+MAX_PREFETCHES = 16
 
-class S3FileListFetchThread(QThread):
-    file_list_fetched = pyqtSignal(str, QTreeWidgetItem)
+FETCH_PRIORITY = 1
+PREFETCH_PRIORITY = 0
+# Seconds a failed listing isn't fetched again by the view, scrolling or expanding after that retries it
+FETCH_RETRY_DELAY = 5
 
-    def __init__(self, bucket_or_folder, item):
+
+class S3FileListFetchJob(BackgroundJob):
+    """ Lists a bucket or folder on a thread pool worker and emits every fetched page as one batch """
+
+    class Signals(QObject):
+        page_fetched = pyqtSignal(list, object)  # objects, continuation token of the next page
+        fetch_failed = pyqtSignal(object)  # exception
+        finished = pyqtSignal()
+
+    def __init__(self, bucket: str, prefix: str = "", continuation_token: Optional[str] = None,
+                 start_after: Optional[str] = None, max_pages: Optional[int] = None, delimiter: Optional[str] = "/"):
         super().__init__()
-        self.bucket = item.data(4, Qt.UserRole) if item.data(4, Qt.UserRole) else bucket_or_folder
-        self.item = item
-        self.folder = "" if not item.data(4, Qt.UserRole) else bucket_or_folder
-
-    def get_files(self, bucket_name, prefix=""):
-        resp = s3_session.resource.meta.client.list_objects(Bucket=bucket_name, Prefix=prefix, Delimiter="/")
-        if 'CommonPrefixes' in resp:
-            files = []
-            folders = [{"name": x['Prefix'],  "file_size": StringUtils.format_size(0), "type": ObjectType.FOLDER, "last_modified": None, "bucket": bucket_name}
-                       for x in
-                       resp['CommonPrefixes']]
-            if 'Contents' in resp:
-                files = [{"name": f["Key"], "type": ObjectType.FILE,
-                          "file_size": StringUtils.format_size(f['Size']),
-                          "last_modified": StringUtils.format_datetime(f["LastModified"]),
-                          "bucket": bucket_name}
-                         for f in
-                         resp["Contents"]]
-
-            return folders + files
-        elif 'Contents' in resp:
-            return [{"name": f["Key"], "type": ObjectType.FILE,
-                     "file_size": StringUtils.format_size(f['Size']),
-                     "last_modified": StringUtils.format_datetime(f["LastModified"]),
-                     "bucket": bucket_name}
-                    for f in
-                    resp["Contents"]]
-        else:
-            return []
+        self.signals = self.Signals()
+        self.bucket = bucket
+        self.prefix = prefix
+        self.continuation_token = continuation_token
+        self.start_after = start_after
+        self.max_pages = max_pages
+        self.delimiter = delimiter
 
     def run(self):
-        _objs = self.get_files(bucket_name=self.bucket, prefix=self.folder)
-        for _obj in _objs:
-            if _obj["type"] == ObjectType.FILE:
-                if _obj["name"][-1] != "/":
-                    self.file_list_fetched.emit(json.dumps(_obj), self.item)
+        try:
+            for page in iter_object_pages(self.bucket, prefix=self.prefix,
+                                          continuation_token=self.continuation_token, start_after=self.start_after,
+                                          max_pages=self.max_pages, delimiter=self.delimiter):
+                if self.cancelled:
+                    break
+                self.signals.page_fetched.emit(page.objects, page.next_token)
+        except Exception as e:
+            self.error = e
+            self.signals.fetch_failed.emit(e)
+        finally:
+            self.signals.finished.emit()
+
+
+class FetchState(IntEnum):
+    NOT_LOADED = 0
+    LOADING = 1
+    PARTIAL = 2  # Some pages are loaded, more pages can be fetched with continuation token
+    LOADED = 3
+
+
+class _TreeNode:
+    """ Bucket or folder node of `S3ObjectTreeModel`. Child rows are stored in `rows`, child nodes
+    are created lazily for folder rows the view descends into. """
+    __slots__ = ("parent", "key", "bucket", "prefix", "rows", "children", "state", "continuation_token", "stale")
+
+    def __init__(self, parent: Optional["_TreeNode"], key: str, bucket: Optional[str], prefix: str = ""):
+        self.parent = parent
+        self.key = key
+        self.bucket = bucket
+        self.prefix = prefix
+        self.rows = ObjectRows()
+        self.children: Dict[str, _TreeNode] = {}
+        self.state = FetchState.NOT_LOADED
+        self.continuation_token = None
+        self.stale = False  # Listed rows may be outdated, revalidated when the view asks for more rows
+
+    def row(self) -> int:
+        return self.parent.rows.find(self.key)
+
+
+class S3ObjectTreeModel(QAbstractItemModel):
+    """
+    Lazy tree model of buckets, folders and files.
+
+    Folder contents are listed page by page only when the view asks for them through `canFetchMore`/`fetchMore`,
+    and display strings are formatted only for the rows the view actually paints. When a `ListingCache` is given,
+    previously visited folders are rendered from it immediately and stale ones are revalidated in background.
+    Sizes of buckets and folders are shown once they are computed by the `PrefixSizeAggregator`, if given.
+    """
+    COLUMNS = ["Name", "Type", "Size", "Date"]
+
+    BucketRole = Qt.UserRole + 1
+    KeyRole = Qt.UserRole + 2
+    ObjectTypeRole = Qt.UserRole + 3
+
+    fetch_failed = pyqtSignal(object)  # exception
+
+    def __init__(self, icon_type: dict, cache: ListingCache = None, cache_scope: CacheScope = None,
+                 sizes: PrefixSizeAggregator = None, search_index: SearchIndex = None, parent=None):
+        super().__init__(parent)
+        self.icon_type = icon_type
+        self.cache = cache
+        self.cache_scope = cache_scope
+        self.sizes = sizes
+        # Changes found when folders are listed again are applied to the search index of their bucket
+        self.search_index = search_index
+        if sizes is not None:
+            sizes.size_changed.connect(self._handle_size_changed)
+        # Cached listings fetched before this time are revalidated even if they are not expired yet
+        self.revalidate_before = 0.0
+        self._root = _TreeNode(None, "", None)
+        self._root.state = FetchState.LOADED
+        self.thread_pool = JobPool(MAX_CONCURRENT_LISTINGS, self)
+        self._fetch_jobs: Dict[_TreeNode, S3FileListFetchJob] = {}
+        # Nodes in `_fetch_jobs` that are only listed ahead of time, they can be cancelled
+        self._prefetching = set()
+        # Nodes whose prefetch failed, they are listed again only when the view asks for them
+        self._prefetch_failed = set()
+        # Time of the last failed listing of nodes, they are retried after `FETCH_RETRY_DELAY`
+        self._failed_at: Dict[_TreeNode, float] = {}
+        # Set when rows are added with `add_objects`, e.g. search results, instead of listings
+        self.static = False
+        # Folder nodes created by `add_matches` by bucket and prefix, bucket nodes have empty prefix
+        self._match_nodes: Dict[tuple, _TreeNode] = {}
+        # Revalidating nodes mapped to the last key revalidated so far, `None` before the first page
+        self._merge_bounds: Dict[_TreeNode, Optional[str]] = {}
+
+    # ############### Node helpers ############################
+
+    def node_from_index(self, index: QModelIndex) -> Optional[_TreeNode]:
+        """ Returns bucket/folder node of index, root node for invalid index and `None` for files """
+        if not index.isValid():
+            return self._root
+        container = index.internalPointer()
+        if index.row() >= len(container.rows):
+            return None
+        object_type = container.rows.type_at(index.row())
+        if object_type == ObjectType.FILE:
+            return None
+        key = container.rows.keys[index.row()]
+        node = container.children.get(key)
+        if node is None:
+            if object_type == ObjectType.BUCKET:
+                node = _TreeNode(container, key, key)
+            else:
+                node = _TreeNode(container, key, container.bucket, prefix=key)
+            container.children[key] = node
+        return node
+
+    def index_from_node(self, node: _TreeNode, column: int = 0) -> QModelIndex:
+        if node is self._root or node.parent is None:
+            return QModelIndex()
+        return self.createIndex(node.row(), column, node.parent)
+
+    def _is_attached(self, node: _TreeNode) -> bool:
+        while node.parent is not None:
+            if node.parent.children.get(node.key) is not node:
+                return False
+            node = node.parent
+        return node is self._root
+
+    # ############### QAbstractItemModel interface ############################
+
+    def index(self, row, column, parent=QModelIndex()):
+        node = self.node_from_index(parent)
+        if node is None or row < 0 or row >= len(node.rows) or column < 0 or column >= len(self.COLUMNS):
+            return QModelIndex()
+        return self.createIndex(row, column, node)
+
+    def parent(self, index=QModelIndex()):
+        if not index.isValid():
+            return QModelIndex()
+        return self.index_from_node(index.internalPointer())
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        node = self.node_from_index(parent)
+        return len(node.rows) if node else 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.COLUMNS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return False
+        node = self.node_from_index(parent)
+        if node is None:
+            return False
+        if node.state == FetchState.LOADED:
+            return len(node.rows) > 0
+        return True
+
+    def canFetchMore(self, parent):
+        node = self.node_from_index(parent)
+        if node is None or time.monotonic() - self._failed_at.get(node, -FETCH_RETRY_DELAY) < FETCH_RETRY_DELAY:
+            return False
+        return node.state in (FetchState.NOT_LOADED, FetchState.PARTIAL) or \
+            (node.stale and node.state != FetchState.LOADING)
+
+    def fetchMore(self, parent):
+        node = self.node_from_index(parent)
+        if node is None:
+            return
+        if node.stale and node.state != FetchState.LOADING:
+            self.revalidate(node)
+        elif node.state in (FetchState.NOT_LOADED, FetchState.PARTIAL):
+            self._fetch(node)
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        container = index.internalPointer()
+        rows = container.rows
+        row = index.row()
+        if row >= len(rows):
+            return None
+        column = index.column()
+        if role == Qt.DisplayRole:
+            object_type = rows.type_at(row)
+            if column == 0:
+                if row == len(rows) - 1 and container.state == FetchState.PARTIAL:
+                    # Last loaded row is painted, fetch next pages of the folder
+                    QTimer.singleShot(0, functools.partial(self._fetch_if_attached, container))
+                if object_type == ObjectType.BUCKET:
+                    return rows.keys[row]
+                return StringUtils.format_object_name(rows.keys[row])
+            elif column == 1:
+                return object_type.value
+            elif column == 2:
+                if object_type == ObjectType.FILE:
+                    return StringUtils.format_size(rows.sizes[row])
+                size = self._prefix_size(container, row)
+                if size is None:
+                    return ""
+                # Totals are not complete until the whole prefix is listed
+                return StringUtils.format_size(size.size) + ("" if size.computed_at else " …")
+            elif column == 3:
+                mtime = rows.mtimes[row]
+                return StringUtils.format_datetime(datetime.fromtimestamp(mtime, timezone.utc) if mtime else None)
+        elif role == Qt.DecorationRole and column == 0:
+            return self.icon_type[rows.type_at(row)]
+        elif role == Qt.ToolTipRole and column == 2 and rows.type_at(row) != ObjectType.FILE:
+            size = self._prefix_size(container, row)
+            if size is not None:
+                return f"{size.count} objects" + ("" if size.computed_at else ", calculating")
+        elif role == self.BucketRole:
+            return container.bucket if container.bucket else rows.keys[row]
+        elif role == self.KeyRole:
+            return rows.keys[row] if rows.type_at(row) != ObjectType.BUCKET else None
+        elif role == self.ObjectTypeRole:
+            return rows.type_at(row).value
+        return None
+
+    def object_at(self, index: QModelIndex) -> Optional[S3Object]:
+        """ Returns object record of the row """
+        if not index.isValid():
+            return None
+        container = index.internalPointer()
+        if index.row() >= len(container.rows):
+            return None
+        return container.rows.object_at(index.row(), container.bucket)
+
+    def _prefix_size(self, container: _TreeNode, row: int) -> Optional[PrefixSize]:
+        if self.sizes is None:
+            return None
+        if container is self._root:
+            return self.sizes.get(container.rows.keys[row], "")
+        return self.sizes.get(container.bucket, container.rows.keys[row])
+
+    def _handle_size_changed(self, bucket: str, prefix: str) -> None:
+        node = self._root if not prefix else self.find_node(bucket, StringUtils.parent_prefix(prefix))
+        if node is None or not self._is_attached(node):
+            return
+        row = node.rows.find(prefix or bucket)
+        if row != -1:
+            index = self.createIndex(row, 2, node)
+            self.dataChanged.emit(index, index)
+
+    # ############### Population ############################
+
+    def clear(self) -> None:
+        """ Removes all rows and stops running listings """
+        self.beginResetModel()
+        for node in list(self._fetch_jobs):
+            self._cancel_job(node)
+        self._prefetch_failed = set()
+        self._failed_at = {}
+        self._root = _TreeNode(None, "", None)
+        self._root.state = FetchState.LOADED
+        self.static = False
+        self._match_nodes = {}
+        self.endResetModel()
+
+    @staticmethod
+    def _bucket_objects(buckets: List[dict]) -> List[S3Object]:
+        return [S3Object(bucket["Name"], bucket["Name"], ObjectType.BUCKET, 0, bucket["CreationDate"])
+                for bucket in sorted(buckets, key=lambda x: x["Name"])]
+
+    def set_buckets(self, buckets: List[dict]) -> None:
+        """ Replaces top level rows with buckets from `list_buckets` response """
+        self.clear()
+        self.add_objects(QModelIndex(), self._bucket_objects(buckets))
+
+    def add_objects(self, parent: QModelIndex, objects: List[S3Object], complete: bool = True) -> None:
+        """
+        Adds objects as child rows of parent without listing it from the endpoint.
+
+        Args:
+            parent (QModelIndex): Bucket or folder index, invalid index for top level.
+            objects (list): Object records, e.g. as produced by `finch.listing`.
+            complete (bool): Marks the parent as fully listed so it will not be fetched on expand.
+        """
+        node = self.node_from_index(parent)
+        self._append_objects(node, sorted(objects, key=lambda x: x.key))
+        if complete:
+            node.state = FetchState.LOADED
+        if node is not self._root:
+            # Rows are not a listing of the folder anymore, they can't be refreshed incrementally
+            self.static = True
+
+    def add_matches(self, objects: List[S3Object]) -> None:
+        """
+        Adds objects, e.g. search results, under their bucket rows together with the folders containing them.
+
+        Only rows that are not in the tree yet are inserted, one insertion per folder. Objects of a bucket are
+        expected in key order like they are listed, rows are then only appended and every object costs the same.
+        """
+        pending: Dict[_TreeNode, List[S3Object]] = {}  # Rows to insert, parents are added before their folders
+        for obj in objects:
+            parent = self._match_node(obj.bucket, StringUtils.parent_prefix(obj.key), pending)
+            if parent is None:
+                continue
+            if obj.type == ObjectType.FOLDER:
+                # Matching folder placeholder object, it keeps its size and date
+                self._match_node(obj.bucket, obj.key, pending, obj)
+            else:
+                pending.setdefault(parent, []).append(obj)
+        for node, node_objects in pending.items():
+            self._insert_objects(node, node_objects)
+        self.static = True
+
+    def _match_node(self, bucket: str, prefix: str, pending: Dict[_TreeNode, List[S3Object]],
+                    obj: S3Object = None) -> Optional[_TreeNode]:
+        """ Returns node of a folder, creating its row in the parent folder and the parent's node if necessary """
+        node = self._match_nodes.get((bucket, prefix))
+        if node is not None:
+            return node
+        if not prefix:
+            row = self._root.rows.find(bucket)
+            if row == -1:
+                return None
+            node = self.node_from_index(self.createIndex(row, 0, self._root))
+        else:
+            parent = self._match_node(bucket, StringUtils.parent_prefix(prefix), pending)
+            if parent is None:
+                return None
+            node = parent.children.get(prefix)
+            if node is None:
+                node = parent.children[prefix] = _TreeNode(parent, prefix, bucket, prefix=prefix)
+                node.state = FetchState.LOADED
+                if parent.rows.find(prefix) == -1:
+                    pending.setdefault(parent, []).append(obj or S3Object(bucket, prefix, ObjectType.FOLDER))
+        self._match_nodes[(bucket, prefix)] = node
+        return node
+
+    def _insert_objects(self, node: _TreeNode, objects: List[S3Object]) -> None:
+        """ Inserts objects to rows of node in key order, skipping keys that already have a row """
+        rows = node.rows
+        if not rows.keys or objects[0].key > rows.keys[-1]:
+            if all(objects[i].key < objects[i + 1].key for i in range(len(objects) - 1)):
+                self._append_objects(node, objects)
+                return
+        # Objects are grouped by the row they are inserted before, groups are inserted from the last one so that
+        # rows of the earlier groups don't move
+        groups = []
+        for obj in sorted(objects, key=lambda x: x.key):
+            row = bisect_left(rows.keys, obj.key)
+            if row < len(rows) and rows.keys[row] == obj.key:
+                continue
+            if groups and groups[-1][0] == row:
+                if groups[-1][1][-1].key != obj.key:
+                    groups[-1][1].append(obj)
+            else:
+                groups.append((row, [obj]))
+        parent = self.index_from_node(node)
+        for row, group in reversed(groups):
+            self.beginInsertRows(parent, row, row + len(group) - 1)
+            rows.insert(row, group)
+            self.endInsertRows()
+
+    def match_selection(self, objects: List[S3Object]) -> QItemSelection:
+        """ Returns selection of rows of objects added with `add_matches`, adjacent rows are merged to ranges """
+        rows_by_node: Dict[_TreeNode, List[int]] = {}
+        for obj in objects:
+            node = self._match_nodes.get((obj.bucket, StringUtils.parent_prefix(obj.key)))
+            row = node.rows.find(obj.key) if node is not None else -1
+            if row != -1:
+                rows_by_node.setdefault(node, []).append(row)
+        selection = QItemSelection()
+        last_column = len(self.COLUMNS) - 1
+        for node, rows in rows_by_node.items():
+            rows.sort()
+            first = previous = rows[0]
+            for row in rows[1:] + [None]:
+                if row is not None and row <= previous + 1:
+                    previous = row
+                    continue
+                selection.select(self.createIndex(first, 0, node), self.createIndex(previous, last_column, node))
+                first = previous = row
+        return selection
+
+    def _append_objects(self, node: _TreeNode, objects: List[S3Object]) -> None:
+        rows = node.rows
+        if rows.keys:
+            # Skip objects that are already listed, pages are always in key order
+            last_key = rows.keys[-1]
+            objects = [obj for obj in objects if obj.key > last_key]
+        if not objects:
+            return
+        first = len(rows)
+        self.beginInsertRows(self.index_from_node(node), first, first + len(objects) - 1)
+        for obj in objects:
+            rows.append(obj)
+        self.endInsertRows()
+
+    def _append_rows(self, node: _TreeNode, rows: ObjectRows) -> None:
+        """ Sets rows of a node that has no rows yet """
+        if not rows:
+            return
+        self.beginInsertRows(self.index_from_node(node), 0, len(rows) - 1)
+        node.rows = rows
+        self.endInsertRows()
+
+    def _remove_rows(self, node: _TreeNode, parent: QModelIndex, first: int, last: int) -> None:
+        self.beginRemoveRows(parent, first, last)
+        for key in node.rows.keys[first:last + 1]:
+            node.children.pop(key, None)
+        node.rows.remove(first, last)
+        self.endRemoveRows()
+
+    def _merge_objects(self, node: _TreeNode, objects: List[S3Object], lower: Optional[str],
+                       upper: Optional[str]) -> None:
+        """
+        Replaces rows of node with keys in `(lower, upper]` by objects, applying only the difference.
+
+        Args:
+            node (_TreeNode): Node to merge objects into.
+            objects (list): Fresh listing of the key range in key order.
+            lower (str, optional): Exclusive lower bound of the range, `None` for the start of the listing.
+            upper (str, optional): Inclusive upper bound of the range, `None` for the end of the listing.
+        """
+        rows = node.rows
+        parent = self.index_from_node(node)
+        row = bisect_right(rows.keys, lower) if lower is not None else 0
+        end = bisect_right(rows.keys, upper) if upper is not None else len(rows)
+        pending = []  # New objects to be inserted before `row`
+        changed = []  # New and updated objects
+        removed = []  # Keys of removed rows
+
+        def flush_pending():
+            nonlocal row, end
+            if pending:
+                self.beginInsertRows(parent, row, row + len(pending) - 1)
+                rows.insert(row, pending)
+                self.endInsertRows()
+                row += len(pending)
+                end += len(pending)
+                pending.clear()
+
+        for obj in objects:
+            key = obj.key
+            if row < end and rows.keys[row] <= key:
+                flush_pending()
+                stale_end = row
+                while stale_end < end and rows.keys[stale_end] < key:
+                    stale_end += 1
+                if stale_end > row:
+                    removed.extend(rows.keys[row:stale_end])
+                    self._remove_rows(node, parent, row, stale_end - 1)
+                    end -= stale_end - row
+            if row < end and rows.keys[row] == key:
+                if rows.update(row, obj):
+                    changed.append(obj)
+                    self.dataChanged.emit(self.index(row, 0, parent), self.index(row, len(self.COLUMNS) - 1, parent))
+                    if rows.type_at(row) == ObjectType.FILE:
+                        node.children.pop(key, None)
+                row += 1
+            else:
+                pending.append(obj)
+                changed.append(obj)
+        flush_pending()
+        if row < end:
+            removed.extend(rows.keys[row:end])
+            self._remove_rows(node, parent, row, end - 1)
+        if self.search_index is not None and node is not self._root:
+            self.search_index.apply_changes(self.cache_scope, node.bucket, changed, removed)
+
+    # ############### Refresh ############################
+
+    def find_node(self, bucket: str, prefix: str = "") -> Optional[_TreeNode]:
+        """ Returns the node of a bucket or folder if the view has descended into it """
+        node = self._root.children.get(bucket)
+        if node is None or not prefix:
+            return node
+        parts = prefix.rstrip("/").split("/")
+        for depth in range(1, len(parts) + 1):
+            node = node.children.get("/".join(parts[:depth]) + "/")
+            if node is None:
+                return None
+        return node
+
+    def _loaded_nodes(self) -> Iterator[_TreeNode]:
+        stack = list(self._root.children.values())
+        while stack:
+            node = stack.pop()
+            if node.state != FetchState.NOT_LOADED:
+                yield node
+                stack.extend(node.children.values())
+
+    def refresh_buckets(self, buckets: List[dict]) -> None:
+        """ Applies added and removed buckets from `list_buckets` response """
+        self._merge_objects(self._root, self._bucket_objects(buckets), None, None)
+
+    def refresh(self, buckets: List[dict], is_expanded: Callable[[QModelIndex], bool]) -> None:
+        """
+        Refreshes the tree keeping expansion and selection state. Bucket list and expanded folders are listed
+        again now, collapsed folders are revalidated when they are expanded again.
+
+        Args:
+            buckets (list): Fresh `list_buckets` response.
+            is_expanded (callable): Returns whether the index is expanded in view.
+        """
+        self.expire_cache()
+        self.refresh_buckets(buckets)
+        for node in list(self._loaded_nodes()):
+            if is_expanded(self.index_from_node(node)):
+                self.revalidate(node)
             else:
-                self.file_list_fetched.emit(json.dumps(_obj), self.item)
+                node.stale = True
+
+    def refresh_prefix(self, bucket: str, prefix: str = "") -> None:
+        """ Revalidates a bucket or folder after an operation changed its contents """
+        if self.cache is not None:
+            self.cache.invalidate(self.cache_scope, bucket, prefix)
+        if self.sizes is not None:
+            self.sizes.invalidate(bucket, prefix)
+        node = self.find_node(bucket, prefix)
+        if node is not None:
+            self.revalidate(node)
+
+    def revalidate(self, node: _TreeNode) -> None:
+        """ Lists a node again and merges the changes into its rows, restarting any listing in progress """
+        node.stale = False
+        self._cancel_job(node)
+        if node.state == FetchState.NOT_LOADED:
+            # Nothing shown yet, it will be listed when the view asks for it
+            return
+        self._revalidate(node)
+
+    # ############### Fetching ############################
+
+    def expire_cache(self) -> None:
+        """ Makes cached listings stale, they are still rendered but revalidated when their folders are opened """
+        self.revalidate_before = time.time()
+
+    def _fetch_if_attached(self, node: _TreeNode) -> None:
+        if node.state == FetchState.PARTIAL and self._is_attached(node):
+            self._fetch(node)
+
+    def prefetch(self, indexes: List[QModelIndex]) -> None:
+        """
+        Lists the first page of given buckets and folders ahead of time, so that expanding them is instant.
+        Prefetches of folders that are not given anymore, e.g. scrolled away, are cancelled.
+        """
+        wanted = []
+        for index in indexes:
+            node = self.node_from_index(index)
+            if node is None or node in self._prefetch_failed:
+                continue
+            if node.state == FetchState.NOT_LOADED or node in self._prefetching:
+                wanted.append(node)
+        wanted_nodes = set(wanted)
+        for node in list(self._prefetching):
+            if node not in wanted_nodes:
+                self._cancel_job(node)
+        for node in wanted:
+            if len(self._prefetching) >= MAX_PREFETCHES:
+                break
+            if node.state == FetchState.NOT_LOADED:
+                self._fetch(node, prefetch=True)
+
+    def _fetch(self, node: _TreeNode, prefetch: bool = False) -> None:
+        """ Renders node from cache if possible and starts listing next pages of node in background """
+        if node in self._fetch_jobs:
+            if prefetch or node not in self._prefetching:
+                return
+            # The view needs the folder now, run it as a regular fetch unless it has already started
+            job = self._fetch_jobs[node]
+            if not self.thread_pool.tryTake(job):
+                self._prefetching.discard(node)
+                return
+            del self._fetch_jobs[node]
+            self._prefetching.discard(node)
+            node.state = FetchState.NOT_LOADED
+        if node.state == FetchState.NOT_LOADED and self.cache is not None:
+            cached = self.cache.get(self.cache_scope, node.bucket, node.prefix)
+            if cached is not None:
+                self._append_rows(node, cached.rows)
+                node.state = FetchState.LOADED if cached.complete else FetchState.PARTIAL
+                if self.cache.is_stale(cached) or cached.fetched_at < self.revalidate_before:
+                    if prefetch:
+                        node.stale = True
+                    else:
+                        self._revalidate(node)
+                return
+        token = node.continuation_token if node.state == FetchState.PARTIAL else None
+        # Listings resumed from cache have no continuation token, continue after the last known key
+        start_after = node.rows.keys[-1] if node.state == FetchState.PARTIAL and not token and node.rows else None
+        job = S3FileListFetchJob(node.bucket, node.prefix, continuation_token=token, start_after=start_after,
+                                 max_pages=1 if prefetch else PAGES_PER_FETCH)
+        self._start_job(node, job, self._handle_page, PREFETCH_PRIORITY if prefetch else FETCH_PRIORITY)
+        if prefetch:
+            self._prefetching.add(node)
+
+    def _revalidate(self, node: _TreeNode) -> None:
+        """ Lists node again from its first page and merges the fresh pages into the rows already shown """
+        self._merge_bounds[node] = None
+        self._start_job(node, S3FileListFetchJob(node.bucket, node.prefix), self._handle_revalidated_page,
+                        FETCH_PRIORITY)
+
+    def _start_job(self, node: _TreeNode, job: S3FileListFetchJob, page_handler, priority: int) -> None:
+        node.state = FetchState.LOADING
+        job.signals.page_fetched.connect(functools.partial(page_handler, node, job))
+        job.signals.fetch_failed.connect(functools.partial(self._handle_fetch_failure, node, job))
+        job.signals.finished.connect(functools.partial(self._handle_fetch_finished, node, job))
+        self._fetch_jobs[node] = job
+        self.thread_pool.start(job, priority)
+
+    def _cancel_job(self, node: _TreeNode) -> None:
+        """ Cancels listing of node, if any, and restores its fetch state from the rows listed so far """
+        job = self._fetch_jobs.pop(node, None)
+        if job is None:
+            return
+        self._prefetching.discard(node)
+        self._merge_bounds.pop(node, None)
+        self.thread_pool.cancel(job)
+        if not node.rows:
+            node.state = FetchState.NOT_LOADED
+        else:
+            node.state = FetchState.PARTIAL
+
+    def _handle_page(self, node: _TreeNode, job: S3FileListFetchJob, objects: List[S3Object],
+                     next_token: Optional[str]) -> None:
+        if self._fetch_jobs.get(node) is not job or not self._is_attached(node):
+            return
+        node.continuation_token = next_token
+        self._append_objects(node, objects)
+
+    def _handle_revalidated_page(self, node: _TreeNode, job: S3FileListFetchJob, objects: List[S3Object],
+                                 next_token: Optional[str]) -> None:
+        if self._fetch_jobs.get(node) is not job or node not in self._merge_bounds:
+            return
+        if not self._is_attached(node):
+            return
+        if next_token and not objects:
+            return
+        lower = self._merge_bounds[node]
+        upper = objects[-1].key if next_token else None
+        self._merge_objects(node, objects, lower, upper)
+        node.continuation_token = next_token
+        if upper is None or (node.rows and upper >= node.rows.keys[-1]):
+            # Every row shown before is revalidated, the rest of the folder is fetched on demand
+            del self._merge_bounds[node]
+            job.cancel()
+        else:
+            self._merge_bounds[node] = upper
+
+    def _handle_fetch_failure(self, node: _TreeNode, job: S3FileListFetchJob, error: Exception) -> None:
+        if self._fetch_jobs.get(node) is not job:
+            return
+        if node in self._prefetching:
+            # Folder is not open yet, the error is reported if it fails again when the user opens it
+            return
+        self.fetch_failed.emit(error)
+
+    def _handle_fetch_finished(self, node: _TreeNode, job: S3FileListFetchJob) -> None:
+        if self._fetch_jobs.get(node) is not job:
+            return
+        del self._fetch_jobs[node]
+        revalidating = self._merge_bounds.pop(node, False) is not False
+        prefetched = node in self._prefetching
+        self._prefetching.discard(node)
+        if prefetched and job.error is not None:
+            self._prefetch_failed.add(node)
+            node.state = FetchState.NOT_LOADED
+            return
+        if job.error is not None:
+            # Listing goes on from the failed page when the view asks for more rows again
+            self._failed_at[node] = time.monotonic()
+            if revalidating:
+                # Rows not revalidated yet are kept, later pages continue after them and revalidation is retried
+                node.continuation_token = None
+                node.stale = True
+            node.state = FetchState.PARTIAL if node.rows else FetchState.NOT_LOADED
+            return
+        self._failed_at.pop(node, None)
+        node.state = FetchState.PARTIAL if node.continuation_token else FetchState.LOADED
+        if node is not self._root and self._is_attached(node):
+            if self.cache is not None and job.error is None:
+                self.cache.put(self.cache_scope, node.bucket, node.prefix, node.rows,
+                               complete=node.state == FetchState.LOADED)
+            index = self.index_from_node(node)
+            # Refresh expand indicator of empty folders
+            self.dataChanged.emit(index, index)
+
 
+class TreePrefetcher(QObject):
+    """ Prefetches folders that are visible, or just below the visible area, of a `S3ObjectTreeModel` view """
+    DELAY = 150  # milliseconds of quiet scrolling before prefetches are scheduled
+
+    def __init__(self, tree_view: QTreeView):
+        super().__init__(tree_view)
+        self.tree_view = tree_view
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(self.DELAY)
+        self.timer.timeout.connect(self.prefetch_visible)
+        model = tree_view.model()
+        tree_view.verticalScrollBar().valueChanged.connect(self.schedule)
+        tree_view.expanded.connect(self.schedule)
+        tree_view.collapsed.connect(self.schedule)
+        model.rowsInserted.connect(self.schedule)
+        model.modelReset.connect(self.schedule)
+
+    def schedule(self, *args) -> None:
+        """ (Re)starts the delay, prefetching runs once the view stops changing """
+        self.timer.start()
+
+    def visible_folder_indexes(self) -> List[QModelIndex]:
+        """ Returns collapsed bucket and folder rows in viewport and in one more viewport height below it """
+        viewport_height = self.tree_view.viewport().height()
+        index = self.tree_view.indexAt(QPoint(0, 0))
+        indexes = []
+        while index.isValid() and self.tree_view.visualRect(index).top() < viewport_height * 2:
+            if (index.data(S3ObjectTreeModel.ObjectTypeRole) != ObjectType.FILE
+                    and not self.tree_view.isExpanded(index)):
+                indexes.append(index)
+            index = self.tree_view.indexBelow(index)
+        return indexes
+
+    def prefetch_visible(self) -> None:
+        self.tree_view.model().prefetch(self.visible_folder_indexes())
+
+
+class S3FlatListModel(QAbstractTableModel):
+    """
+    Flat list of every key under a bucket or folder, listed without delimiter.
+
+    Pages are listed only when the view scrolls to the last loaded rows, so sub trees of any size are
+    inspected in one paginated pass. Item roles are the same as `S3ObjectTreeModel`.
+    """
+    COLUMNS = ["Key", "Size", "Date"]
+
+    BucketRole = S3ObjectTreeModel.BucketRole
+    KeyRole = S3ObjectTreeModel.KeyRole
+    ObjectTypeRole = S3ObjectTreeModel.ObjectTypeRole
+
+    fetch_failed = pyqtSignal(object)  # exception
+    loading_changed = pyqtSignal(bool)
+
+    def __init__(self, icon_type: dict, bucket: str, prefix: str = "", parent=None):
+        super().__init__(parent)
+        self.icon_type = icon_type
+        self.bucket = bucket
+        self.prefix = prefix
+        self.rows = ObjectRows()
+        self.state = FetchState.NOT_LOADED
+        self.continuation_token = None
+        self.thread_pool = JobPool(1, self)
+        self._job: Optional[S3FileListFetchJob] = None
+        self._failed_at = None  # Time of the last failed listing, it is retried after `FETCH_RETRY_DELAY`
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.COLUMNS)
+
+    def canFetchMore(self, parent):
+        if self._failed_at is not None and time.monotonic() - self._failed_at < FETCH_RETRY_DELAY:
+            return False
+        return not parent.isValid() and self.state in (FetchState.NOT_LOADED, FetchState.PARTIAL)
+
+    def fetchMore(self, parent):
+        if self.canFetchMore(parent):
+            self._fetch()
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        rows = self.rows
+        row = index.row()
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == 0:
+                if row == len(rows) - 1 and self.state == FetchState.PARTIAL:
+                    # Last loaded row is painted, fetch next pages
+                    QTimer.singleShot(0, functools.partial(self.fetchMore, QModelIndex()))
+                return rows.keys[row]
+            elif column == 1:
+                return StringUtils.format_size(rows.sizes[row])
+            elif column == 2:
+                mtime = rows.mtimes[row]
+                return StringUtils.format_datetime(datetime.fromtimestamp(mtime, timezone.utc) if mtime else None)
+        elif role == Qt.DecorationRole and column == 0:
+            return self.icon_type[rows.type_at(row)]
+        elif role == self.BucketRole:
+            return self.bucket
+        elif role == self.KeyRole:
+            return rows.keys[row]
+        elif role == self.ObjectTypeRole:
+            return rows.type_at(row).value
+        return None
+
+    def object_at(self, index: QModelIndex) -> Optional[S3Object]:
+        """ Returns object record of the row """
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        return self.rows.object_at(index.row(), self.bucket)
+
+    def is_loading(self) -> bool:
+        return self.state == FetchState.LOADING
+
+    def reload(self) -> None:
+        """ Lists the prefix again from its first key """
+        self.cancel()
+        self.beginResetModel()
+        self.rows = ObjectRows()
+        self.state = FetchState.NOT_LOADED
+        self.continuation_token = None
+        self._failed_at = None
+        self.endResetModel()
+
+    def cancel(self) -> None:
+        """ Stops listing, rows listed so far are kept and the next pages are fetched on demand """
+        job, self._job = self._job, None
+        if job is None:
+            return
+        self.thread_pool.cancel(job)
+        self.state = FetchState.PARTIAL if self.rows else FetchState.NOT_LOADED
+        self.loading_changed.emit(False)
+
+    def _fetch(self) -> None:
+        job = S3FileListFetchJob(self.bucket, self.prefix, continuation_token=self.continuation_token,
+                                 max_pages=PAGES_PER_FETCH, delimiter=None)
+        if self.state == FetchState.PARTIAL and not self.continuation_token:
+            # Resume a cancelled listing after the last key listed
+            job.start_after = self.rows.keys[-1]
+        job.signals.page_fetched.connect(functools.partial(self._handle_page, job))
+        job.signals.fetch_failed.connect(functools.partial(self._handle_fetch_failure, job))
+        job.signals.finished.connect(functools.partial(self._handle_fetch_finished, job))
+        self._job = job
+        self.state = FetchState.LOADING
+        self.loading_changed.emit(True)
+        self.thread_pool.start(job)
+
+    def _handle_page(self, job: S3FileListFetchJob, objects: List[S3Object], next_token: Optional[str]) -> None:
+        if self._job is not job:
+            return
+        self.continuation_token = next_token
+        if objects:
+            first = len(self.rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(objects) - 1)
+            self.rows.insert(first, objects)
+            self.endInsertRows()
+
+    def _handle_fetch_failure(self, job: S3FileListFetchJob, error: Exception) -> None:
+        if self._job is job:
+            self.fetch_failed.emit(error)
+
+    def _handle_fetch_finished(self, job: S3FileListFetchJob) -> None:
+        if self._job is not job:
+            return
+        self._job = None
+        if job.error is not None:
+            # Listing goes on from the failed page when the view asks for more rows again
+            self._failed_at = time.monotonic()
+            self.state = FetchState.PARTIAL if self.rows else FetchState.NOT_LOADED
+        else:
+            self._failed_at = None
+            self.state = FetchState.PARTIAL if self.continuation_token else FetchState.LOADED
+        self.loading_changed.emit(False)
@@ -0,0 +1,210 @@
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from contextlib import closing
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, NamedTuple, Optional
+from urllib.parse import unquote_plus
+
+from finch.common import CONFIG_PATH, ObjectType, S3Object, s3_session
+from finch.listing import PAGE_SIZE
+
+# Formats of inventory data files, ORC and Parquet are read with the optional pyarrow package
+INVENTORY_FORMATS = ("CSV", "ORC", "Parquet")
+
+
+class InventoryManifest(NamedTuple):
+    """ `manifest.json` of one S3 Inventory report """
+    source_bucket: str
+    destination_bucket: str
+    file_format: str
+    schema: List[str]  # Column names of CSV files, empty for ORC and Parquet which carry their own schema
+    files: List[str]  # Keys of data files in the destination bucket
+    created_at: datetime
+
+
+def _split_location(location: str):
+    """ Splits `s3://bucket/key` into bucket and key """
+    if not location.startswith("s3://"):
+        raise ValueError(f"Inventory location {location!r} must start with s3://")
+    bucket, _, key = location[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def parse_manifest(manifest: dict) -> InventoryManifest:
+    file_format = manifest["fileFormat"]
+    if file_format not in INVENTORY_FORMATS:
+        raise ValueError(f"Unsupported inventory format {file_format}")
+    return InventoryManifest(
+        source_bucket=manifest["sourceBucket"],
+        # Destination is an ARN, e.g. arn:aws:s3:::inventory-bucket
+        destination_bucket=manifest["destinationBucket"].rpartition(":")[2],
+        file_format=file_format,
+        schema=[column.strip() for column in manifest.get("fileSchema", "").split(",")]
+        if file_format == "CSV" else [],
+        files=[file["key"] for file in manifest["files"]],
+        created_at=datetime.fromtimestamp(int(manifest["creationTimestamp"]) / 1000, timezone.utc))
+
+
+def load_manifest(location: str) -> InventoryManifest:
+    """
+    Reads the manifest of an inventory report.
+
+    Args:
+        location (str): `s3://` URL of a `manifest.json`, or of the folder reports of one inventory configuration
+            are delivered to, e.g. `s3://inventory-bucket/prefix/source-bucket/config-id/`. The latest complete
+            report in the folder is used then.
+    """
+    bucket, key = _split_location(location)
+    client = s3_session.clients.client(bucket)
+    if not key.endswith(".json"):
+        key = latest_manifest_key(bucket, key)
+        if key is None:
+            raise ValueError(f"No inventory report found at {location}")
+    body = client.get_object(Bucket=bucket, Key=key)["Body"]
+    with closing(body):
+        return parse_manifest(json.loads(body.read()))
+
+
+def latest_manifest_key(bucket: str, prefix: str) -> Optional[str]:
+    """ Returns key of the manifest of the latest report delivered under prefix, `None` if there is none """
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    client = s3_session.clients.client(bucket)
+    folders = []
+    for resp in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        folders.extend(x["Prefix"] for x in resp.get("CommonPrefixes", []))
+    # Report folders are named by delivery time, e.g. 2024-01-31T01-00Z/, other folders are data/ and hive/
+    reports = sorted((folder for folder in folders if folder[len(prefix):len(prefix) + 1].isdigit()), reverse=True)
+    for report in reports:
+        key = f"{report}manifest.json"
+        # Manifest is written last, reports being delivered don't have one yet
+        if client.list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1).get("KeyCount"):
+            return key
+    return None
+
+
+def detect_inventory_location(bucket: str, prefix: str = "") -> Optional[str]:
+    """
+    Returns location of reports of an enabled inventory configuration of the bucket covering prefix, or `None`.
+    Endpoints which don't support inventory configurations and missing permissions are treated as no inventory.
+    """
+    try:
+        resp = s3_session.clients.client(bucket).list_bucket_inventory_configurations(Bucket=bucket)
+    except Exception:
+        return None
+    configurations = [configuration for configuration in resp.get("InventoryConfigurationList", [])
+                      if configuration.get("IsEnabled") and
+                      prefix.startswith(configuration.get("Filter", {}).get("Prefix", ""))]
+    # Reports of current versions don't need to be filtered
+    configurations.sort(key=lambda x: x.get("IncludedObjectVersions") != "Current")
+    for configuration in configurations:
+        destination = configuration["Destination"]["S3BucketDestination"]
+        destination_prefix = destination.get("Prefix", "").strip("/")
+        path = f"{bucket}/{configuration['Id']}/"
+        return "s3://{}/{}".format(destination["Bucket"].rpartition(":")[2],
+                                   f"{destination_prefix}/{path}" if destination_prefix else path)
+    return None
+
+
+def _parse_datetime(value) -> Optional[datetime]:
+    if not value:
+        return None
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _iter_csv_file(manifest: InventoryManifest, key: str) -> Iterator[dict]:
+    """ Streams rows of a gzipped CSV data file as dicts of the manifest's columns """
+    body = s3_session.clients.client(manifest.destination_bucket).get_object(
+        Bucket=manifest.destination_bucket, Key=key)["Body"]
+    with closing(body):
+        stream = gzip.GzipFile(fileobj=body) if key.endswith(".gz") else body
+        for row in csv.reader(io.TextIOWrapper(stream, encoding="utf-8", newline="")):
+            record = dict(zip(manifest.schema, row))
+            # Keys of CSV reports are URL encoded
+            record["Key"] = unquote_plus(record.get("Key", ""))
+            yield record
+
+
+def _iter_arrow_file(manifest: InventoryManifest, key: str) -> Iterator[dict]:
+    """ Streams rows of an ORC or Parquet data file with pyarrow, as dicts of CSV column names """
+    try:
+        import pyarrow.orc
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError(f"Reading {manifest.file_format} inventory reports requires pyarrow, "
+                           f"install it with \"pip install pyarrow\"")
+    columns = {"key": "Key", "size": "Size", "last_modified_date": "LastModifiedDate",
+               "storage_class": "StorageClass", "is_latest": "IsLatest", "is_delete_marker": "IsDeleteMarker"}
+    # Both formats need random access, data file is downloaded to a temporary file instead of memory
+    with tempfile.TemporaryFile() as data_file:
+        s3_session.clients.client(manifest.destination_bucket).download_fileobj(
+            manifest.destination_bucket, key, data_file)
+        data_file.seek(0)
+        if manifest.file_format == "Parquet":
+            parquet_file = pyarrow.parquet.ParquetFile(data_file)
+            names = [name for name in columns if name in parquet_file.schema_arrow.names]
+            batches = (batch.to_pydict() for batch in parquet_file.iter_batches(batch_size=PAGE_SIZE, columns=names))
+        else:
+            orc_file = pyarrow.orc.ORCFile(data_file)
+            names = [name for name in columns if name in orc_file.schema.names]
+            batches = (orc_file.read_stripe(stripe, columns=names).to_pydict() for stripe in range(orc_file.nstripes))
+        for batch in batches:
+            for values in zip(*(batch[name] for name in names)):
+                yield {columns[name]: value for name, value in zip(names, values)}
+
+
+def _is_current(record: dict) -> bool:
+    """ Returns whether a row of a report is the current version of an object, reports may include all versions """
+    is_latest = record.get("IsLatest", True)
+    is_delete_marker = record.get("IsDeleteMarker", False)
+    return is_latest in (True, "true") and is_delete_marker not in (True, "true")
+
+
+def iter_inventory_file(manifest: InventoryManifest, key: str, batch_size: int = PAGE_SIZE) -> Iterator[List[S3Object]]:
+    """ Streams current objects listed in one data file of the report in batches """
+    records = _iter_csv_file(manifest, key) if manifest.file_format == "CSV" else _iter_arrow_file(manifest, key)
+    batch = []
+    for record in records:
+        if not _is_current(record):
+            continue
+        object_key = record["Key"]
+        batch.append(S3Object(manifest.source_bucket, object_key,
+                              ObjectType.FOLDER if object_key.endswith("/") else ObjectType.FILE,
+                              int(record.get("Size") or 0), _parse_datetime(record.get("LastModifiedDate")),
+                              record.get("StorageClass") or None))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class InventoryLocations:
+    """ Inventory report locations configured for buckets, stored per credential next to `credentials.json` """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(CONFIG_PATH, "inventory.json")
+        try:
+            with open(self.path, "r") as locations_file:
+                self.locations: Dict[str, Dict[str, str]] = json.loads(locations_file.read())
+        except (OSError, json.JSONDecodeError):
+            self.locations = {}
+
+    def get(self, credential: str, bucket: str) -> Optional[str]:
+        return self.locations.get(credential, {}).get(bucket)
+
+    def set(self, credential: str, bucket: str, location: Optional[str]) -> None:
+        """ Sets location of reports of the bucket, `None` removes it """
+        if location:
+            _split_location(location)
+            self.locations.setdefault(credential, {})[bucket] = location
+        else:
+            self.locations.get(credential, {}).pop(bucket, None)
+        with open(self.path, "w+") as locations_file:
+            locations_file.write(json.dumps(self.locations))
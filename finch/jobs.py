@@ -0,0 +1,44 @@
+import functools
+
+from PyQt5.QtCore import QRunnable, QThreadPool
+
+
+class BackgroundJob(QRunnable):
+    """
+    Job run on a `JobPool` worker. Subclasses define `signals`, a QObject with at least a `finished` signal that is
+    emitted when `run` returns, and check `cancelled` between requests.
+
+    Owner keeps a reference until `finished` is emitted, pool must not delete the job.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.cancelled = False
+        self.error = None
+
+    def cancel(self) -> None:
+        """ Stops the job after the request in progress, results after that are not emitted """
+        self.cancelled = True
+
+
+class JobPool(QThreadPool):
+    """
+    Thread pool of `BackgroundJob`s. Cancelled jobs still running on a worker are kept referenced until they finish,
+    so owners only need to ignore signals of jobs they cancelled.
+    """
+
+    def __init__(self, max_thread_count: int = 1, parent=None):
+        super().__init__(parent)
+        self.setMaxThreadCount(max_thread_count)
+        self._cancelled = set()
+
+    def start(self, job: BackgroundJob, priority: int = 0) -> None:
+        job.signals.finished.connect(functools.partial(self._cancelled.discard, job))
+        super().start(job, priority)
+
+    def cancel(self, job: BackgroundJob) -> None:
+        """ Removes the job if it is still waiting for a worker, otherwise stops it after the request in progress """
+        if not self.tryTake(job):
+            job.cancel()
+            self._cancelled.add(job)
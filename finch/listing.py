@@ -0,0 +1,331 @@
+import threading
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from queue import Queue, Full
+from typing import Iterator, List, NamedTuple, Optional
+
+from finch.common import s3_session, ObjectType, S3Object, S3ClientPool
+
+PAGE_SIZE = 1000
+# Number of shards listed at the same time by `iter_sharded_object_pages`
+SHARD_WORKERS = 8
+# Pages buffered per shard while earlier shards are consumed
+SHARD_QUEUE_PAGES = 4
+# Keys read from every folder split while shards are discovered, files among them are kept until they are yielded
+DISCOVERY_PAGE_SIZE = PAGE_SIZE
+
+
+class ListPage(NamedTuple):
+    """ One page of a `list_objects_v2` response, folders and files merged in key order """
+    bucket: str
+    prefix: str
+    objects: List[S3Object]
+    next_token: Optional[str]
+
+
+class ObjectRows:
+    """ Column oriented, array backed storage of listed objects. Rows are kept in key order. """
+    TYPES = (ObjectType.FILE, ObjectType.FOLDER, ObjectType.BUCKET)
+    TYPE_CODES = {object_type: code for code, object_type in enumerate(TYPES)}
+
+    __slots__ = ("keys", "sizes", "mtimes", "types")
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.sizes = array('q')
+        self.mtimes = array('d')  # POSIX timestamps, 0 when unknown
+        self.types = bytearray()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def append(self, obj: S3Object) -> None:
+        self.keys.append(obj.key)
+        self.sizes.append(obj.size)
+        self.mtimes.append(obj.last_modified.timestamp() if obj.last_modified else 0)
+        self.types.append(self.TYPE_CODES[obj.type])
+
+    @classmethod
+    def from_columns(cls, keys: List[str], sizes: bytes, mtimes: bytes, types: bytes) -> "ObjectRows":
+        """ Creates rows from serialized columns, see `to_columns` """
+        rows = cls()
+        rows.keys = keys
+        rows.sizes.frombytes(sizes)
+        rows.mtimes.frombytes(mtimes)
+        rows.types = bytearray(types)
+        return rows
+
+    def to_columns(self):
+        """ Returns columns as keys list and raw bytes of sizes, mtimes and types """
+        return self.keys, self.sizes.tobytes(), self.mtimes.tobytes(), bytes(self.types)
+
+    @staticmethod
+    def _columns(objects: List[S3Object]):
+        return ([obj.key for obj in objects],
+                array('q', [obj.size for obj in objects]),
+                array('d', [obj.last_modified.timestamp() if obj.last_modified else 0 for obj in objects]),
+                bytearray(ObjectRows.TYPE_CODES[obj.type] for obj in objects))
+
+    def insert(self, row: int, objects: List[S3Object]) -> None:
+        """ Inserts objects before row """
+        keys, sizes, mtimes, types = self._columns(objects)
+        self.keys[row:row] = keys
+        self.sizes[row:row] = sizes
+        self.mtimes[row:row] = mtimes
+        self.types[row:row] = types
+
+    def remove(self, first: int, last: int) -> None:
+        """ Removes rows between first and last, inclusive """
+        del self.keys[first:last + 1]
+        del self.sizes[first:last + 1]
+        del self.mtimes[first:last + 1]
+        del self.types[first:last + 1]
+
+    def update(self, row: int, obj: S3Object) -> bool:
+        """ Updates size, mtime and type of row from obj, returns whether anything changed """
+        mtime = obj.last_modified.timestamp() if obj.last_modified else 0
+        type_code = self.TYPE_CODES[obj.type]
+        if self.sizes[row] == obj.size and self.mtimes[row] == mtime and self.types[row] == type_code:
+            return False
+        self.sizes[row] = obj.size
+        self.mtimes[row] = mtime
+        self.types[row] = type_code
+        return True
+
+    def type_at(self, row: int) -> ObjectType:
+        return self.TYPES[self.types[row]]
+
+    def object_at(self, row: int, bucket: str) -> S3Object:
+        """ Returns row as object record, bucket is ignored for bucket rows """
+        object_type = self.type_at(row)
+        mtime = self.mtimes[row]
+        return S3Object(self.keys[row] if object_type == ObjectType.BUCKET else bucket, self.keys[row], object_type,
+                        self.sizes[row], datetime.fromtimestamp(mtime, timezone.utc) if mtime else None)
+
+    def find(self, key: str) -> int:
+        """ Returns row of the key or -1 """
+        row = bisect_left(self.keys, key)
+        return row if row < len(self.keys) and self.keys[row] == key else -1
+
+
+def object_from_content(bucket_name: str, content: dict) -> S3Object:
+    """ Converts an entry of `Contents` in a `list_objects_v2` response to an object record """
+    key = content["Key"]
+    return S3Object(bucket_name, key, ObjectType.FOLDER if key.endswith("/") else ObjectType.FILE,
+                    content["Size"], content["LastModified"], content.get("StorageClass"), content.get("ETag"))
+
+
+def build_page_objects(bucket_name: str, resp: dict, include_markers: bool = False) -> List[S3Object]:
+    """
+    Converts a raw `list_objects_v2` response to object records sorted by key.
+
+    Keys ending with "/" are folder placeholder objects. They are skipped unless `include_markers` is set,
+    because delimited listings represent folders with `CommonPrefixes`.
+    """
+    folders = [S3Object(bucket_name, x["Prefix"], ObjectType.FOLDER) for x in resp.get("CommonPrefixes", [])]
+    files = [object_from_content(bucket_name, f) for f in resp.get("Contents", [])
+             if include_markers or not f["Key"].endswith("/")]
+    if folders and files:
+        return sorted(folders + files, key=lambda x: x.key)
+    return folders or files
+
+
+def iter_object_pages(bucket_name: str, prefix: str = "", delimiter: Optional[str] = "/",
+                      continuation_token: Optional[str] = None, start_after: Optional[str] = None,
+                      max_pages: Optional[int] = None, page_size: int = PAGE_SIZE,
+                      clients: S3ClientPool = None) -> Iterator[ListPage]:
+    """
+    Lists objects under prefix page by page with `list_objects_v2`, following continuation tokens.
+
+    Args:
+        bucket_name (str): Bucket to list.
+        prefix (str, optional): Key prefix to list. Defaults to bucket root.
+        delimiter (str, optional): Delimiter to group keys by. `None` lists every key under the prefix,
+            including folder placeholder objects.
+        continuation_token (str, optional): Token returned by a previous page to resume from.
+        start_after (str, optional): List keys after this key, used to resume when no token is known.
+        max_pages (int, optional): Stop after this many pages. Defaults to no limit.
+        page_size (int, optional): Maximum keys requested per page.
+        clients (S3ClientPool, optional): Clients to list with, clients of the selected credential by default.
+    """
+    client = (clients or s3_session.clients).client(bucket_name)
+    params = {"Bucket": bucket_name, "Prefix": prefix, "MaxKeys": page_size}
+    if delimiter:
+        params["Delimiter"] = delimiter
+    if start_after and not continuation_token:
+        params["StartAfter"] = start_after
+    pages = 0
+    while True:
+        if continuation_token:
+            params["ContinuationToken"] = continuation_token
+        resp = client.list_objects_v2(**params)
+        continuation_token = resp.get("NextContinuationToken") if resp.get("IsTruncated") else None
+        yield ListPage(bucket_name, prefix, build_page_objects(bucket_name, resp, include_markers=not delimiter),
+                       continuation_token)
+        pages += 1
+        if not continuation_token or (max_pages and pages >= max_pages):
+            break
+
+
+class Shard(NamedTuple):
+    """
+    Contiguous part of a keyspace: keys under `prefix` after `start_after`, or `objects` already listed while the
+    keyspace was discovered. `flat` shards had no sub folders in their first keys and are not split further.
+    """
+    prefix: str
+    start_after: Optional[str] = None
+    objects: Optional[List[S3Object]] = None
+    flat: bool = False
+
+
+def _after_prefix(prefix: str) -> str:
+    """ Returns a key that sorts after every key under prefix, to list what follows with `StartAfter` """
+    return prefix + "\U0010ffff"
+
+
+def _split_shard(bucket_name: str, shard: Shard, clients: S3ClientPool) -> List[Shard]:
+    """
+    Splits a shard by the next delimiter level into shards in key order, from one delimiter page of its first keys.
+    Sub folders become shards of their own and files of the page are kept as a shard, keys after the page are the
+    last shard.
+    """
+    params = {"Bucket": bucket_name, "Prefix": shard.prefix, "Delimiter": "/", "MaxKeys": DISCOVERY_PAGE_SIZE}
+    if shard.start_after:
+        params["StartAfter"] = shard.start_after
+    resp = clients.client(bucket_name).list_objects_v2(**params)
+    folders = [x["Prefix"] for x in resp.get("CommonPrefixes", [])]
+    entries = [(folder, None) for folder in folders] + [(f["Key"], f) for f in resp.get("Contents", [])]
+    shards = []
+    files = []
+    last_key = None
+    for key, content in sorted(entries, key=lambda x: x[0]):
+        if content is None:
+            if files:
+                shards.append(Shard(shard.prefix, objects=files))
+                files = []
+            shards.append(Shard(key))
+            last_key = _after_prefix(key)
+        else:
+            files.append(object_from_content(bucket_name, content))
+            last_key = key
+    if files:
+        shards.append(Shard(shard.prefix, objects=files))
+    if resp.get("IsTruncated") and last_key is not None:
+        shards.append(Shard(shard.prefix, start_after=last_key, flat=not folders))
+    return shards
+
+
+def discover_shards(bucket_name: str, prefix: str = "", min_shards: int = SHARD_WORKERS * 2,
+                    max_depth: int = 3, clients: S3ClientPool = None) -> List[Shard]:
+    """
+    Splits the keyspace under prefix into shards in key order, descending delimiter levels until there are at
+    least `min_shards` shards to list or `max_depth` levels are split. Every split reads one delimiter page, keys
+    of it are never listed again, so a prefix without sub folders costs no more requests than listing it.
+    """
+    clients = clients or s3_session.clients
+    shards = [Shard(prefix)]
+    for _ in range(max_depth):
+        listed = [shard for shard in shards if shard.objects is None]
+        if len(listed) >= min_shards or not any(not shard.flat for shard in listed):
+            break
+        split = []
+        for shard in shards:
+            if shard.objects is None and not shard.flat:
+                split.extend(_split_shard(bucket_name, shard, clients))
+            else:
+                split.append(shard)
+        shards = split
+    return shards
+
+
+def iter_sharded_object_pages(bucket_name: str, prefix: str = "", max_workers: int = SHARD_WORKERS,
+                              shards: List[Shard] = None, clients: S3ClientPool = None) -> Iterator[ListPage]:
+    """
+    Lists every key under prefix by listing shards of the keyspace concurrently. Pages are yielded
+    in key order as one merged stream, so results are the same as `iter_object_pages` without delimiter.
+    Pages are not resumable, their `next_token` is always `None`.
+
+    Args:
+        bucket_name (str): Bucket to list.
+        prefix (str, optional): Key prefix to list. Defaults to the whole bucket.
+        max_workers (int, optional): Number of shards listed at the same time.
+        shards (list, optional): Shards to list, discovered from delimiter levels by default.
+        clients (S3ClientPool, optional): Clients to list with, clients of the selected credential by default.
+    """
+    clients = clients or s3_session.clients
+    if shards is None:
+        shards = discover_shards(bucket_name, prefix, min_shards=max_workers * 2, clients=clients)
+    if len(shards) == 1 and shards[0].objects is None:
+        yield from iter_object_pages(bucket_name, prefix=shards[0].prefix, delimiter=None,
+                                     start_after=shards[0].start_after, clients=clients)
+        return
+
+    stop = threading.Event()
+    done = object()
+
+    def put(queue: Queue, item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def list_shard(shard: Shard, queue: Queue) -> None:
+        try:
+            if stop.is_set():
+                return
+            for page in iter_object_pages(bucket_name, prefix=shard.prefix, delimiter=None,
+                                          start_after=shard.start_after, clients=clients):
+                if not put(queue, page):
+                    return
+        except Exception as e:
+            put(queue, e)
+        finally:
+            put(queue, done)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        queues = []
+        for shard in shards:
+            if shard.objects is None:
+                queue = Queue(maxsize=SHARD_QUEUE_PAGES)
+                executor.submit(list_shard, shard, queue)
+                queues.append(queue)
+            else:
+                queues.append(None)
+        for shard, queue in zip(shards, queues):
+            if queue is None:
+                yield ListPage(bucket_name, shard.prefix, shard.objects, None)
+                continue
+            while True:
+                item = queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
+def delete_prefix(bucket_name: str, prefix: str = "") -> int:
+    """ Deletes every key under prefix, deleting each listed page while the next shards are listed.
+    Returns number of deleted keys. """
+    client = s3_session.clients.client(bucket_name)
+    deleted = 0
+    for page in iter_sharded_object_pages(bucket_name, prefix):
+        for i in range(0, len(page.objects), PAGE_SIZE):
+            batch = page.objects[i:i + PAGE_SIZE]
+            resp = client.delete_objects(Bucket=bucket_name,
+                                         Delete={"Objects": [{"Key": obj.key} for obj in batch], "Quiet": True})
+            if resp.get("Errors"):
+                error = resp["Errors"][0]
+                raise RuntimeError(f"Could not delete {len(resp['Errors'])} objects, "
+                                   f"{error['Key']}: {error['Message']}")
+            deleted += len(batch)
+    return deleted
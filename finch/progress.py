@@ -0,0 +1,317 @@
+import threading
+import time
+from array import array
+from collections import deque
+from enum import IntEnum
+from typing import Deque, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from PyQt5.QtCore import QAbstractTableModel, QModelIndex, QObject, QTimer, Qt, pyqtSignal
+
+from finch.common import StringUtils
+
+# Interval of published progress snapshots, transfers add bytes at any rate in between
+PROGRESS_INTERVAL_MS = 250
+# Seconds the throughput of a job is averaged over, the ETA follows it
+THROUGHPUT_WINDOW = 5.0
+
+
+class ItemProgress(NamedTuple):
+    """ Progress of one file of a transfer job """
+    transferred: int
+    total: Optional[int]
+    speed: float  # Bytes per second since the previous snapshot
+
+    @property
+    def percent(self) -> int:
+        return int(self.transferred / self.total * 100) if self.total else 0
+
+
+class ProgressSnapshot(NamedTuple):
+    """ Progress of a transfer job at one moment """
+    items: Dict[str, ItemProgress]  # Files whose progress changed since the previous snapshot
+    transferred: int  # Bytes of all files, including bytes of resumed downloads
+    total: int  # Known size of all files
+    speed: float  # Bytes per second over `THROUGHPUT_WINDOW`
+    eta: Optional[float]  # Seconds until the job is transferred, `None` while nothing is moving
+
+
+class TransferProgress(QObject):
+    """
+    Collects transferred bytes of a transfer job from worker threads. Workers only add to counters under a lock,
+    the GUI thread publishes one `ProgressSnapshot` of the changed files and the whole job per interval, so the
+    number of transfers and chunks doesn't change how often the GUI is updated.
+    """
+    updated = pyqtSignal(object)  # ProgressSnapshot
+
+    def __init__(self, interval_ms: int = PROGRESS_INTERVAL_MS):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._items: Dict[str, List] = {}  # Transferred bytes and size of running files
+        self._published: Dict[str, int] = {}  # Transferred bytes of running files at the previous snapshot
+        self._changed = set()
+        self.transferred = 0
+        self.total = 0
+        self._moved = 0  # Bytes moved over the network, resumed bytes don't count into throughput
+        self._samples: Deque[Tuple[float, int]] = deque()  # Time and moved bytes of recent snapshots
+        self._last_publish = time.monotonic()
+        self._timer = QTimer(self)
+        self._timer.setInterval(interval_ms)
+        self._timer.timeout.connect(self.publish)
+
+    def start(self) -> None:
+        """ Starts publishing, must be called on the GUI thread """
+        self._last_publish = time.monotonic()
+        self._samples.append((self._last_publish, self._moved))
+        self._timer.start()
+
+    def stop(self) -> None:
+        """ Publishes the last snapshot and stops, must be called on the GUI thread """
+        if not self._timer.isActive():
+            return
+        self._timer.stop()
+        self.publish()
+
+    def add_total(self, size: int) -> None:
+        """ Adds to the size of the job, e.g. for listed files, negative for corrected sizes """
+        with self._lock:
+            self.total += size
+
+    def start_item(self, item_id: str, total: Optional[int], transferred: int = 0) -> None:
+        """ Starts tracking a file, or starts it over. `transferred` bytes are already there, e.g. resumed. """
+        with self._lock:
+            previous = self._items.get(item_id, (0, None))[0]
+            self.transferred += transferred - previous
+            self._items[item_id] = [transferred, total]
+            self._published[item_id] = transferred
+            self._changed.add(item_id)
+
+    def set_size(self, item_id: str, total: int) -> None:
+        with self._lock:
+            item = self._items.get(item_id)
+            if item is not None:
+                item[1] = total
+                self._changed.add(item_id)
+
+    def add(self, item_id: str, bytes_amount: int) -> None:
+        """ Counts bytes of a chunk, called from worker threads """
+        with self._lock:
+            item = self._items.get(item_id)
+            if item is None:
+                return
+            item[0] += bytes_amount
+            self.transferred += bytes_amount
+            self._moved += bytes_amount
+            self._changed.add(item_id)
+
+    def finish_item(self, item_id: str) -> None:
+        """ Stops tracking a file, its bytes still count into the job """
+        with self._lock:
+            self._items.pop(item_id, None)
+            self._published.pop(item_id, None)
+            self._changed.discard(item_id)
+
+    def publish(self) -> None:
+        now = time.monotonic()
+        elapsed = max(now - self._last_publish, 1e-6)
+        self._last_publish = now
+        with self._lock:
+            items = {}
+            for item_id in self._changed:
+                transferred, total = self._items[item_id]
+                speed = (transferred - self._published[item_id]) / elapsed
+                self._published[item_id] = transferred
+                items[item_id] = ItemProgress(transferred, total, max(speed, 0.0))
+            self._changed.clear()
+            transferred, total, moved = self.transferred, self.total, self._moved
+        self._samples.append((now, moved))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= THROUGHPUT_WINDOW:
+            self._samples.popleft()
+        first_time, first_moved = self._samples[0]
+        speed = (moved - first_moved) / (now - first_time) if now > first_time else 0.0
+        eta = max(total - transferred, 0) / speed if speed > 0 else None
+        self.updated.emit(ProgressSnapshot(items, transferred, total, speed, eta))
+
+
+class TransferState(IntEnum):
+    PENDING = 0
+    ACTIVE = 1
+    COMPLETED = 2
+    FAILED = 3
+    CANCELLED = 4
+    SKIPPED = 5  # Local copy was up to date
+
+
+class TransferListModel(QAbstractTableModel):
+    """
+    Files of a transfer job and their progress, one row per file. State of a row is kept in columns of arrays,
+    so jobs of many files don't need an object per file, and the view formats only rows it shows.
+
+    Rows can be limited to files in some states. Rows of a filter are looked up again at most once per progress
+    snapshot, files that change state in between stay in the view until then.
+    """
+    COLUMNS = ["File", "Size", "Progress", "Speed", "Status"]
+    # Progress column holds the percent for the progress bar delegate
+    PercentRole = Qt.UserRole + 1
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.ids: List[str] = []
+        self.sizes = array('q')  # -1 while the size is not known
+        self.transferred = array('q')
+        self.speeds = array('d')
+        self.states = bytearray()
+        self.errors: Dict[int, str] = {}  # Error messages of failed files by row
+        self.counts = [0] * len(TransferState)  # Files by state
+        self._rows: Dict[str, int] = {}
+        self._active = set()  # Rows of files with a speed, their speed drops when a snapshot leaves them out
+        self._filter: Optional[frozenset] = None
+        self._visible: Optional[array] = None  # Rows shown by the filter, `None` shows every row
+        self._filter_dirty = False
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.ids) if self._visible is None else len(self._visible)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.rowCount():
+            return None
+        row = index.row() if self._visible is None else self._visible[index.row()]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == 0:
+                return self.ids[row]
+            if column == 1:
+                return StringUtils.format_size(self.sizes[row]).strip() if self.sizes[row] >= 0 else ""
+            if column == 2:
+                return f"{self._percent(row)}%"
+            if column == 3:
+                speed = self.speeds[row]
+                return f"{StringUtils.format_size(speed).strip()}/s" if speed > 0 else ""
+            if column == 4:
+                state = TransferState(self.states[row])
+                if state == TransferState.FAILED:
+                    return f"Failed: {self.errors.get(row, '')}"
+                return state.name.capitalize()
+        elif role == self.PercentRole:
+            return self._percent(row)
+        elif role == Qt.ToolTipRole and column in (0, 4) and row in self.errors:
+            return self.errors[row]
+        return None
+
+    def _percent(self, row: int) -> int:
+        if self.states[row] in (TransferState.COMPLETED, TransferState.SKIPPED):
+            return 100
+        size = self.sizes[row]
+        return int(self.transferred[row] / size * 100) if size > 0 else 0
+
+    def add_items(self, ids: Iterable[str], sizes: Iterable[Optional[int]]) -> None:
+        """ Adds pending files, `None` size when it is not known """
+        items = [(item_id, -1 if size is None else size) for item_id, size in zip(ids, sizes)
+                 if item_id not in self._rows]
+        if not items:
+            return
+        first = len(self.ids)
+        shown = self._visible is None
+        if shown:
+            self.beginInsertRows(QModelIndex(), first, first + len(items) - 1)
+        for row, (item_id, size) in enumerate(items, first):
+            self._rows[item_id] = row
+            self.ids.append(item_id)
+            self.sizes.append(size)
+        # Zero bytes are zero transferred bytes, zero speed and the pending state
+        self.transferred.frombytes(bytes(8 * len(items)))
+        self.speeds.frombytes(bytes(8 * len(items)))
+        self.states.extend(bytes(len(items)))
+        self.counts[TransferState.PENDING] += len(items)
+        if shown:
+            self.endInsertRows()
+        elif TransferState.PENDING in self._filter:
+            self._filter_dirty = True
+
+    def set_filter(self, states: Optional[Iterable[TransferState]]) -> None:
+        """ Shows only files in states, `None` shows every file """
+        self.beginResetModel()
+        self._filter = frozenset(states) if states is not None else None
+        self._visible = self._filtered_rows()
+        self._filter_dirty = False
+        self.endResetModel()
+
+    def _filtered_rows(self) -> Optional[array]:
+        if self._filter is None:
+            return None
+        codes = bytes(int(state) for state in self._filter)
+        states = self.states
+        return array('l', (row for row in range(len(states)) if states[row] in codes))
+
+    def update_progress(self, snapshot: ProgressSnapshot) -> None:
+        """ Takes progress of the files in a snapshot, files missing from it have stopped moving """
+        rows = self._rows
+        stalled = self._active - {rows[item_id] for item_id in snapshot.items if item_id in rows}
+        for row in stalled:
+            self.speeds[row] = 0.0
+        self._active -= stalled
+        for item_id, item in snapshot.items.items():
+            row = rows.get(item_id)
+            if row is None:
+                continue
+            self.transferred[row] = item.transferred
+            if item.total is not None:
+                self.sizes[row] = item.total
+            self.speeds[row] = item.speed
+            self._active.add(row)
+            if self.states[row] == TransferState.PENDING:
+                self._set_state(row, TransferState.ACTIVE)
+        if self._filter_dirty:
+            self._refilter()
+        if self.rowCount():
+            # The view repaints only the rows it shows
+            self.dataChanged.emit(self.index(0, 1), self.index(self.rowCount() - 1, len(self.COLUMNS) - 1))
+
+    def set_state(self, item_id: str, state: TransferState, error: str = None) -> None:
+        row = self._rows.get(item_id)
+        if row is None:
+            return
+        self._set_state(row, state)
+        self.speeds[row] = 0.0
+        self._active.discard(row)
+        if state in (TransferState.COMPLETED, TransferState.SKIPPED) and self.sizes[row] >= 0:
+            self.transferred[row] = self.sizes[row]
+        if error is not None:
+            self.errors[row] = error
+        else:
+            self.errors.pop(row, None)
+        if self._visible is None:
+            self.dataChanged.emit(self.index(row, 1), self.index(row, len(self.COLUMNS) - 1))
+        elif self.rowCount():
+            self.dataChanged.emit(self.index(0, 1), self.index(self.rowCount() - 1, len(self.COLUMNS) - 1))
+
+    def set_size(self, item_id: str, size: int) -> None:
+        row = self._rows.get(item_id)
+        if row is not None:
+            self.sizes[row] = size
+
+    def _set_state(self, row: int, state: TransferState) -> None:
+        previous = self.states[row]
+        if previous == state:
+            return
+        self.counts[previous] -= 1
+        self.counts[state] += 1
+        self.states[row] = state
+        if self._filter is not None and (previous in self._filter) != (state in self._filter):
+            self._filter_dirty = True
+
+    def _refilter(self) -> None:
+        # Unlike a reset, the view keeps its scroll position
+        self.layoutAboutToBeChanged.emit()
+        self._visible = self._filtered_rows()
+        self._filter_dirty = False
+        self.layoutChanged.emit()
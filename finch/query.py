@@ -0,0 +1,183 @@
+import fnmatch
+import operator
+import re
+import time
+from datetime import datetime, timezone
+from typing import Callable, List
+
+from finch.common import ObjectType, S3Object
+
+# Multipliers of size units, like displayed sizes they are 1024 based
+SIZE_UNITS = {"": 1, "b": 1, "k": 1024, "kb": 1024, "kib": 1024, "m": 1024 ** 2, "mb": 1024 ** 2, "mib": 1024 ** 2,
+              "g": 1024 ** 3, "gb": 1024 ** 3, "gib": 1024 ** 3, "t": 1024 ** 4, "tb": 1024 ** 4, "tib": 1024 ** 4}
+# Seconds of age units, e.g. `modified<7d`
+AGE_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+
+OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge, "=": operator.eq,
+             ":": operator.eq, "!=": operator.ne}
+# Age is compared the other way around than the date, `modified<7d` means modified after 7 days ago
+AGE_OPERATORS = {"<": operator.gt, "<=": operator.ge, ">": operator.lt, ">=": operator.le}
+
+_TOKEN = re.compile(r'"([^"]*)"|(\S+)')
+_FILTER = re.compile(r"^(size|modified|class)(<=|>=|!=|<|>|=|:)(.*)$", re.IGNORECASE)
+_SIZE = re.compile(r"^(\d+(?:\.\d+)?)\s*([a-z]*)$", re.IGNORECASE)
+_AGE = re.compile(r"^(\d+(?:\.\d+)?)([smhdw])$", re.IGNORECASE)
+_WILDCARDS = "*?["
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+def _literal_prefix(pattern: str) -> str:
+    """ Returns part of a glob pattern before its first wildcard """
+    for i, char in enumerate(pattern):
+        if char in _WILDCARDS:
+            return pattern[:i]
+    return pattern
+
+
+def _parse_size(value: str) -> int:
+    match = _SIZE.match(value)
+    if match is None or match.group(2).lower() not in SIZE_UNITS:
+        raise QuerySyntaxError(f"Invalid size {value!r}, use e.g. 100MB")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def _parse_date(value: str) -> datetime:
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        raise QuerySyntaxError(f"Invalid date {value!r}, use an age like 7d or a date like 2024-01-31")
+    # Dates without time zone are local time like displayed dates
+    return date.astimezone(timezone.utc)
+
+
+class SearchQuery:
+    """
+    Search compiled from query text into a key prefix listed on the server and a predicate run on listed objects.
+
+    Query text is a list of space separated terms, all of which must match:
+
+    - `text` matches keys containing text. The first term containing "/" is a path relative to the searched folder,
+      e.g. `logs/2024/` lists only keys under it and `logs/2024/error` also matches "error" in the rest of the key.
+    - `*.log`, `report-??.csv` are glob patterns matched against the whole key under the searched folder. The part
+      of the first pattern before its first wildcard is listed as prefix.
+    - `s3://bucket/path` searches only the bucket, path is used like the first term.
+    - `re:pattern` matches keys under the searched folder with a regular expression.
+    - `size>100MB`, `size<=1k` compare object sizes, `modified<7d` matches objects modified in the last 7 days,
+      `modified>=2024-01-31` compares with a date, `class=GLACIER,DEEP_ARCHIVE` matches storage classes.
+      Size, date and storage class filters match files only.
+
+    Checks of the key run before checks of the object metadata, cheapest first.
+    """
+
+    def __init__(self, text: str, bucket: str = None, prefix: str = ""):
+        self.text = text
+        self.bucket = bucket
+        self.prefix = prefix
+        # Substrings every matching key contains after the prefix, a local index can narrow down keys with them
+        self.terms: List[str] = []
+        pattern_checks = []
+        object_checks = []
+        planned = False
+        for quoted, plain in _TOKEN.findall(text):
+            # Quoted terms are always matched as text
+            token, quoted = (plain, False) if plain else (quoted, True)
+            filter_match = _FILTER.match(token) if not quoted else None
+            if filter_match:
+                object_checks.append(self._compile_filter(*filter_match.groups()))
+            elif token.startswith("re:") and not quoted:
+                try:
+                    pattern = re.compile(token[len("re:"):])
+                except re.error as e:
+                    raise QuerySyntaxError(f"Invalid regular expression {token!r}: {e}")
+                pattern_checks.append(pattern.search)
+            else:
+                if not planned and token.startswith("s3://") and not quoted:
+                    self.bucket, _, token = token[len("s3://"):].partition("/")
+                    self.prefix = ""
+                    planned = True
+                    token = self._plan(token)
+                elif not planned and not quoted and ("/" in token or any(char in token for char in _WILDCARDS)):
+                    planned = True
+                    token = self._plan(token)
+                if not quoted and any(char in token for char in _WILDCARDS):
+                    pattern_checks.append(re.compile(fnmatch.translate(token), re.DOTALL).match)
+                elif token:
+                    self.terms.append(token)
+        # Substring checks are the cheapest, longest substrings reject most keys
+        self._key_checks: List[Callable[[str], bool]] = [
+            self._contains(term) for term in sorted(self.terms, key=len, reverse=True)] + pattern_checks
+        self._object_checks: List[Callable[[S3Object], bool]] = object_checks
+
+    @staticmethod
+    def _contains(term: str) -> Callable[[str], bool]:
+        return lambda rest: term in rest
+
+    def _plan(self, token: str) -> str:
+        """ Moves the literal leading part of a path or pattern to the listed prefix, returns the rest """
+        token = token.lstrip("/")
+        if any(char in token for char in _WILDCARDS):
+            literal = _literal_prefix(token)
+            self.prefix += literal
+            return token[len(literal):]
+        path, _, rest = token.rpartition("/")
+        if path:
+            self.prefix += f"{path}/"
+        return rest
+
+    @staticmethod
+    def _compile_filter(field: str, op: str, value: str) -> Callable[[S3Object], bool]:
+        field = field.lower()
+        value = value.strip()
+        if field == "class":
+            if op not in (":", "=", "!="):
+                raise QuerySyntaxError(f"Storage class can only be compared with = or !=, not {op}")
+            classes = {name.strip().upper() for name in value.split(",") if name.strip()}
+            if not classes:
+                raise QuerySyntaxError("Storage class is missing, use e.g. class=GLACIER")
+            negate = op == "!="
+            # Listings omit the storage class of some S3 compatible servers, it is STANDARD then
+            return lambda obj: ((obj.storage_class or "STANDARD") in classes) != negate
+        if field == "size":
+            size = _parse_size(value)
+            compare = OPERATORS[op]
+            return lambda obj: compare(obj.size, size)
+        if op not in AGE_OPERATORS:
+            raise QuerySyntaxError(f"Modification time can only be compared with <, <=, > or >=, not {op}")
+        age = _AGE.match(value)
+        if age is not None:
+            # Age is relative to when search started
+            since = datetime.fromtimestamp(time.time() - float(age.group(1)) * AGE_UNITS[age.group(2).lower()],
+                                           timezone.utc)
+            compare = AGE_OPERATORS[op]
+        else:
+            since = _parse_date(value)
+            compare = OPERATORS[op]
+        return lambda obj: obj.last_modified is not None and compare(obj.last_modified, since)
+
+    def matches(self, obj: S3Object) -> bool:
+        key = obj.key
+        if len(key) <= len(self.prefix) or not key.startswith(self.prefix):
+            return False
+        rest = key[len(self.prefix):]
+        for check in self._key_checks:
+            if not check(rest):
+                return False
+        if self._object_checks:
+            if obj.type != ObjectType.FILE:
+                return False
+            for check in self._object_checks:
+                if not check(obj):
+                    return False
+        return True
+
+    def describe(self) -> str:
+        """ Returns where the search looks, for status messages """
+        if self.bucket is None:
+            return f"all buckets under {self.prefix}" if self.prefix else "all buckets"
+        return f"{self.bucket}/{self.prefix}"
+
+    def __repr__(self):
+        return f"SearchQuery({self.text!r}, bucket={self.bucket!r}, prefix={self.prefix!r})"
@@ -0,0 +1,233 @@
+import itertools
+import threading
+from collections import deque
+from contextlib import suppress
+from enum import IntEnum
+from typing import Callable, Deque, List, NamedTuple, Optional
+
+from PyQt5.QtWidgets import QWidget, QHBoxLayout, QComboBox, QPushButton, QLabel
+
+# Workers and connections of the scheduler until a credential's transfer settings are applied
+DEFAULT_MAX_WORKERS = 3
+DEFAULT_MAX_CONNECTIONS = 30
+
+
+class TransferPriority(IntEnum):
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+
+
+class TransferPaused(Exception):
+    """ Raised by a running task when its job is paused, the task is queued again and started after resume """
+
+
+class _Task(NamedTuple):
+    run: Callable[[int], None]  # Called with the number of connections the task may use
+    connections: int  # Connections the task can use at most
+    on_error: Optional[Callable[[Exception], None]]  # Called on the worker with an error the task didn't handle
+
+
+class TransferJob:
+    """ Transfers submitted together, e.g. files of one download or upload, scheduled by `TransferScheduler` """
+
+    def __init__(self, name: str, priority: TransferPriority = TransferPriority.NORMAL):
+        self.name = name
+        self.priority = priority
+        # Budget the job's tasks start within, limits of the scheduler when the job is first submitted unless set
+        # before, so that changing the limits doesn't change jobs that are already running
+        self.max_workers: Optional[int] = None
+        self.max_connections: Optional[int] = None
+        self.paused = False
+        self.cancelled = False
+        self.running = 0  # Tasks on a worker
+        self.last_started = 0  # Order of the last task start, jobs started longer ago go first among equals
+        self._queue: Deque[_Task] = deque()
+
+    def set_limits(self, max_workers: int, max_connections: int) -> None:
+        """ Sets the budget of the job, before it is submitted """
+        self.max_workers = max_workers
+        self.max_connections = max_connections
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def __repr__(self):
+        return f"TransferJob({self.name!r}, {self.priority.name}, queued={self.queued}, running={self.running})"
+
+
+class TransferScheduler:
+    """
+    Runs tasks of every upload and download of the application on one set of worker threads.
+
+    Every job has a budget: a task of it starts while fewer than `max_workers` tasks run at once and running tasks
+    hold fewer than `max_connections` connections together. Jobs get the limits of the scheduler when they are first
+    submitted, so `set_limits` only changes jobs submitted after it. A task asks for the connections it can use and
+    gets what is left of its job's budget, at least one. The next task is taken from the job with the highest
+    priority, among jobs of the same priority from the one with the fewest running tasks, so concurrent jobs share
+    workers evenly. Paused jobs don't start tasks, their running tasks raise `TransferPaused` to stop and are queued
+    again.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, max_connections: int = DEFAULT_MAX_CONNECTIONS):
+        self.max_workers = max_workers
+        self.max_connections = max_connections
+        self.running = 0
+        self.connections_in_use = 0
+        self._jobs: List[TransferJob] = []
+        self._workers: List[threading.Thread] = []
+        self._condition = threading.Condition()
+        self._starts = itertools.count(1)
+
+    def set_limits(self, max_workers: int, max_connections: int) -> None:
+        """ Changes the budget of jobs submitted from now on, extra workers stop when no job needs them """
+        with self._condition:
+            self.max_workers = max_workers
+            self.max_connections = max_connections
+            self._start_workers()
+            self._condition.notify_all()
+
+    def submit(self, job: TransferJob, run: Callable[[int], None], connections: int = 1,
+               on_error: Callable[[Exception], None] = None) -> None:
+        """
+        Queues a task of the job. `run` is called on a worker with the number of connections it may use, errors it
+        raises are passed to `on_error`, e.g. to report the file as failed.
+        """
+        with self._condition:
+            if job.cancelled:
+                return
+            # Jobs are known to the scheduler while they have queued or running tasks
+            if job not in self._jobs:
+                self._jobs.append(job)
+            if job.max_workers is None:
+                job.set_limits(self.max_workers, self.max_connections)
+            job._queue.append(_Task(run, max(connections, 1), on_error))
+            self._start_workers()
+            self._condition.notify()
+
+    def set_priority(self, job: TransferJob, priority: TransferPriority) -> None:
+        with self._condition:
+            job.priority = priority
+            self._condition.notify_all()
+
+    def pause(self, job: TransferJob) -> None:
+        """ Stops starting tasks of the job, running tasks are expected to check `job.paused` and stop """
+        with self._condition:
+            job.paused = True
+
+    def resume(self, job: TransferJob) -> None:
+        with self._condition:
+            job.paused = False
+            self._condition.notify_all()
+
+    def cancel(self, job: TransferJob) -> None:
+        """ Drops queued tasks of the job, running tasks are expected to check `job.cancelled` """
+        with self._condition:
+            job.cancelled = True
+            job._queue.clear()
+            if job in self._jobs and not job.running:
+                self._jobs.remove(job)
+            self._condition.notify_all()
+
+    def wait(self, job: TransferJob) -> None:
+        """ Waits until no task of the job is running, e.g. after it is cancelled """
+        with self._condition:
+            while job.running:
+                self._condition.wait()
+
+    def _needed_workers(self) -> int:
+        return max([self.max_workers] + [job.max_workers for job in self._jobs])
+
+    def _start_workers(self) -> None:
+        self._workers = [worker for worker in self._workers if worker.is_alive()]
+        while len(self._workers) < self._needed_workers():
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _next_task(self):
+        """ Returns the next job, task and granted connections, or None if no task can start now """
+        jobs = [job for job in self._jobs if job._queue and not job.paused and self.running < job.max_workers and
+                self.connections_in_use < job.max_connections]
+        if not jobs:
+            return None
+        job = max(jobs, key=lambda x: (x.priority, -x.running, -x.last_started))
+        task = job._queue.popleft()
+        connections = min(task.connections, job.max_connections - self.connections_in_use)
+        return job, task, connections
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    if len(self._workers) > self._needed_workers():
+                        # Budget was lowered and jobs of the higher budget finished
+                        self._workers.remove(threading.current_thread())
+                        return
+                    picked = self._next_task()
+                    if picked is not None:
+                        break
+                    self._condition.wait()
+                job, task, connections = picked
+                job.running += 1
+                self.running += 1
+                job.last_started = next(self._starts)
+                self.connections_in_use += connections
+            try:
+                task.run(connections)
+            except TransferPaused:
+                with self._condition:
+                    if not job.cancelled:
+                        job._queue.appendleft(task)
+            except Exception as e:
+                if task.on_error is not None:
+                    # Worker keeps running whatever the error handler does
+                    with suppress(Exception):
+                        task.on_error(e)
+            finally:
+                with self._condition:
+                    job.running -= 1
+                    self.running -= 1
+                    self.connections_in_use -= connections
+                    if not job.running and not job._queue and job in self._jobs:
+                        self._jobs.remove(job)
+                    self._condition.notify_all()
+
+
+# Scheduler of every transfer, its limits follow transfer settings of the selected credential
+transfer_scheduler = TransferScheduler()
+
+
+class TransferJobControls(QWidget):
+    """ Priority selector and pause button of a transfer job """
+
+    def __init__(self, job: TransferJob, scheduler: TransferScheduler = None):
+        super().__init__()
+        self.job = job
+        self.scheduler = scheduler or transfer_scheduler
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.priority_selector = QComboBox()
+        for priority in TransferPriority:
+            self.priority_selector.addItem(priority.name.capitalize(), priority)
+        self.priority_selector.setCurrentIndex(self.priority_selector.findData(job.priority))
+        self.priority_selector.currentIndexChanged.connect(self.change_priority)
+        self.pause_button = QPushButton("Pause")
+        self.pause_button.clicked.connect(self.toggle_pause)
+        layout.addWidget(QLabel("Priority"))
+        layout.addWidget(self.priority_selector)
+        layout.addStretch()
+        layout.addWidget(self.pause_button)
+        self.setLayout(layout)
+
+    def change_priority(self, index: int) -> None:
+        self.scheduler.set_priority(self.job, self.priority_selector.itemData(index))
+
+    def toggle_pause(self) -> None:
+        if self.job.paused:
+            self.scheduler.resume(self.job)
+            self.pause_button.setText("Pause")
+        else:
+            self.scheduler.pause(self.job)
+            self.pause_button.setText("Resume")
@@ -0,0 +1,196 @@
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+from typing import Dict
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from finch.cache import CacheScope
+from finch.common import s3_session
+from finch.inventory import InventoryLocations, InventoryManifest, iter_inventory_file, load_manifest
+from finch.jobs import BackgroundJob
+from finch.listing import iter_sharded_object_pages
+from finch.query import SearchQuery
+from finch.searchindex import SearchIndex
+
+# Maximum number of matches kept, search stops when it is reached
+MAX_SEARCH_RESULTS = 10_000
+# Number of buckets searched at the same time
+SEARCH_BUCKET_WORKERS = 4
+# Shards listed at the same time in each searched bucket
+SEARCH_SHARD_WORKERS = 4
+# Data files of an inventory report read at the same time in each searched bucket
+INVENTORY_FILE_WORKERS = 4
+
+
+class S3SearchJob(BackgroundJob):
+    """
+    Searches keys of every bucket on a thread pool worker and emits matches of every listed page as one batch.
+    Buckets are searched concurrently, matches of different buckets are emitted as they are found. Only keys under
+    the prefix of the query are listed and filtered with its predicate, see `SearchQuery`.
+
+    When a `SearchIndex` is given, buckets with a fresh index are searched locally. When `InventoryLocations` are
+    given, buckets with a configured S3 Inventory report are searched by reading the report, `reports` tells when
+    each read report was created. Keys changed after that are only found with `include_newer`, which lists every
+    key under the prefix as well. Buckets whose report can't be read are listed instead, the error is kept in
+    `report_errors`. Other buckets are listed and their index is rebuilt from the listed pages when the whole
+    bucket is listed.
+    """
+
+    class Signals(QObject):
+        buckets_listed = pyqtSignal(list)  # `list_buckets` response
+        matches_found = pyqtSignal(list, object)  # matching objects, number of keys scanned so far
+        failed = pyqtSignal(object)  # exception
+        finished = pyqtSignal()
+
+    def __init__(self, query: SearchQuery, max_results: int = MAX_SEARCH_RESULTS,
+                 bucket_workers: int = SEARCH_BUCKET_WORKERS, index: SearchIndex = None,
+                 index_scope: CacheScope = None, inventory: InventoryLocations = None, include_newer: bool = False):
+        super().__init__()
+        self.signals = self.Signals()
+        self.query = query
+        self.max_results = max_results
+        self.bucket_workers = bucket_workers
+        self.index = index
+        self.index_scope = index_scope  # Credential and endpoint, inventory locations are looked up by credential
+        self.inventory = inventory
+        self.include_newer = include_newer
+        self.reports: Dict[str, datetime] = {}  # Creation time of inventory reports searched, by bucket
+        self.report_errors: Dict[str, str] = {}  # Errors of inventory reports that couldn't be read, by bucket
+        self.scanned = 0
+        self.matched = 0
+        self.capped = False  # Set when search stopped at `max_results`
+        self._lock = threading.Lock()
+
+    def run(self):
+        try:
+            buckets = s3_session.resource.meta.client.list_buckets()['Buckets']
+            s3_session.clients.resolve_regions(buckets)
+            if self.query.bucket is not None:
+                buckets = [bucket for bucket in buckets if bucket['Name'] == self.query.bucket]
+                if not buckets:
+                    raise ValueError(f"Bucket {self.query.bucket} does not exist")
+            self.signals.buckets_listed.emit(buckets)
+            with ThreadPoolExecutor(max_workers=self.bucket_workers) as executor:
+                for future in [executor.submit(self._search_bucket, bucket)
+                               for bucket in sorted(bucket['Name'] for bucket in buckets)]:
+                    try:
+                        future.result()
+                    except Exception:
+                        # Don't wait for buckets that are not searched yet
+                        self.cancelled = True
+                        raise
+        except Exception as e:
+            self.error = e
+            self.signals.failed.emit(e)
+        finally:
+            self.signals.finished.emit()
+
+    def _search_bucket(self, bucket: str) -> None:
+        """ Emits matches in bucket until the bucket is searched, or search is cancelled or capped """
+        if self.cancelled or self.capped:
+            return
+        if self.index is not None and self.index.is_fresh(self.index_scope, bucket):
+            self._search_index(bucket)
+            return
+        if self.inventory is not None:
+            location = self.inventory.get(self.index_scope[0], bucket)
+            if location is not None:
+                try:
+                    manifest = load_manifest(location)
+                    if manifest.source_bucket != bucket:
+                        raise ValueError(f"Inventory report of {manifest.source_bucket} is configured for {bucket}")
+                except Exception as e:
+                    # Report may be missing or expired, the bucket is listed instead
+                    with self._lock:
+                        self.report_errors[bucket] = str(e)
+                else:
+                    self._search_inventory(bucket, manifest)
+                    return
+        # Index holds every key of a bucket, it can only be rebuilt from a listing of the whole bucket
+        builder = None
+        if self.index is not None and not self.query.prefix:
+            builder = self.index.builder(self.index_scope, bucket)
+        try:
+            with closing(iter_sharded_object_pages(bucket, self.query.prefix,
+                                                   max_workers=SEARCH_SHARD_WORKERS)) as pages:
+                for page in pages:
+                    if builder is not None:
+                        try:
+                            builder.add(page.objects)
+                        except sqlite3.Error:
+                            # Index is best effort, search goes on without it
+                            builder.abort()
+                            builder = None
+                    matches = [obj for obj in page.objects if self.query.matches(obj)]
+                    if not self._emit(matches, len(page.objects)):
+                        return
+            if builder is not None:
+                builder.commit()
+                builder = None
+        finally:
+            if builder is not None:
+                builder.abort()
+
+    def _search_index(self, bucket: str) -> None:
+        """ Emits matches in bucket from the local index """
+        scanned = self.index.key_count(self.index_scope, bucket, self.query.prefix)
+        for objects in self.index.search(self.index_scope, bucket, self.query.terms, self.query.prefix):
+            # Index narrows down keys by prefix and substrings, the rest of the query is checked here
+            if not self._emit([obj for obj in objects if self.query.matches(obj)], 0):
+                return
+        self._emit([], scanned)
+
+    def _search_inventory(self, bucket: str, manifest: InventoryManifest) -> None:
+        """
+        Emits matches in bucket from its inventory report. With `include_newer` the prefix is listed first and keys
+        modified after the report was created are matched from the listing, only those keys are kept to skip their
+        outdated rows in the report.
+        """
+        with self._lock:
+            self.reports[bucket] = manifest.created_at
+        newer_keys = set()
+        if self.include_newer:
+            # Modification time can't be filtered on the server, every key under the prefix is listed
+            with closing(iter_sharded_object_pages(bucket, self.query.prefix,
+                                                   max_workers=SEARCH_SHARD_WORKERS)) as pages:
+                for page in pages:
+                    newer = [obj for obj in page.objects if obj.last_modified is not None and
+                             obj.last_modified >= manifest.created_at]
+                    newer_keys.update(obj.key for obj in newer)
+                    if not self._emit([obj for obj in newer if self.query.matches(obj)], len(newer)):
+                        return
+        stop = threading.Event()
+
+        def search_file(key: str) -> None:
+            for objects in iter_inventory_file(manifest, key):
+                if newer_keys:
+                    objects = [obj for obj in objects if obj.key not in newer_keys]
+                matches = [obj for obj in objects if self.query.matches(obj)]
+                if stop.is_set() or not self._emit(matches, len(objects)):
+                    stop.set()
+                    return
+
+        with ThreadPoolExecutor(max_workers=INVENTORY_FILE_WORKERS) as executor:
+            futures = [executor.submit(search_file, key) for key in manifest.files]
+            try:
+                for future in futures:
+                    future.result()
+            finally:
+                stop.set()
+
+    def _emit(self, matches: list, scanned: int) -> bool:
+        """ Counts and emits matches, returns whether the search should go on """
+        with self._lock:
+            if self.cancelled or self.capped:
+                return False
+            self.scanned += scanned
+            if self.matched + len(matches) >= self.max_results:
+                matches = matches[:self.max_results - self.matched]
+                self.capped = True
+            self.matched += len(matches)
+            # Emitted under the lock so that scanned counts arrive in order
+            self.signals.matches_found.emit(matches, self.scanned)
+            return not self.capped
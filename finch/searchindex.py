@@ -0,0 +1,244 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Sequence
+
+from finch.cache import CacheScope
+from finch.common import CONFIG_PATH, ObjectType, S3Object
+from finch.listing import PAGE_SIZE
+
+
+def _glob_escape(text: str) -> str:
+    return "".join(f"[{char}]" if char in "*?[" else char for char in text)
+
+
+def _glob_pattern(term: str, prefix: str = "") -> str:
+    """ Returns GLOB pattern matching keys starting with prefix and containing term after it, GLOB is case
+    sensitive like search """
+    return f"{_glob_escape(prefix)}*{_glob_escape(term)}*" if term else f"{_glob_escape(prefix)}*"
+
+
+class SearchIndexBuilder:
+    """ Writes listing pages of a bucket to a new key table, it replaces the bucket's index when committed """
+
+    def __init__(self, index: "SearchIndex", scope: CacheScope, bucket: str):
+        self.index = index
+        self.scope = scope
+        self.bucket = bucket
+        self.table = f"keys_{uuid.uuid4().hex}"
+        self.count = 0
+        index.create_table(self.table)
+
+    def add(self, objects: List[S3Object]) -> None:
+        connection = self.index.connection()
+        with connection:
+            connection.executemany(
+                f"INSERT INTO {self.table} (key, size, mtime, storage_class) VALUES (?, ?, ?, ?)",
+                [(obj.key, obj.size, obj.last_modified.timestamp() if obj.last_modified else 0, obj.storage_class)
+                 for obj in objects])
+        self.count += len(objects)
+
+    def commit(self) -> None:
+        """ Makes the new table the index of the bucket and drops the previous one """
+        self.index.replace_table(self.scope, self.bucket, self.table, self.count)
+
+    def abort(self) -> None:
+        self.index.drop_table(self.table)
+
+
+class SearchIndex:
+    """
+    Local index of the keys of buckets, keyed by credential, endpoint and bucket, so that repeated searches are
+    answered without listing the buckets again.
+
+    Each bucket's keys are stored in their own table, an FTS5 table with the trigram tokenizer when SQLite supports
+    it, which makes substring matching with GLOB use the index. A bucket's index is rebuilt from the pages of a live
+    listing and is used by searches only while it is fresh, until `ttl` seconds pass or it is invalidated. Changes
+    found by listings of the file tree in between are applied to it with `apply_changes`.
+    """
+    DEFAULT_TTL = 60 * 60
+    # Incremented when columns of key tables change, indexes of older versions are dropped
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path: str = None, ttl: float = DEFAULT_TTL):
+        self.path = path or os.path.join(CONFIG_PATH, "search_index.sqlite3")
+        self.ttl = ttl
+        # Index is used from search workers, every thread has its own connection
+        self._local = threading.local()
+        # Changes found by listings are written on one thread, in the order they were found
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        if connection.execute("PRAGMA user_version").fetchone()[0] < self.SCHEMA_VERSION:
+            with connection:
+                connection.execute("DROP TABLE IF EXISTS buckets")
+            connection.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    credential TEXT NOT NULL,
+                    endpoint TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    key_table TEXT NOT NULL,
+                    key_count INTEGER NOT NULL,
+                    indexed_at REAL NOT NULL,
+                    PRIMARY KEY (credential, endpoint, bucket)
+                )""")
+        try:
+            connection.execute("CREATE VIRTUAL TABLE temp.trigram_check USING fts5(key, tokenize='trigram')")
+            connection.execute("DROP TABLE temp.trigram_check")
+            self.trigram = True
+        except sqlite3.OperationalError:
+            # SQLite older than 3.34, keys are matched with a scan of the bucket's table
+            self.trigram = False
+        self._drop_orphan_tables()
+
+    @classmethod
+    def open(cls, path: str = None, ttl: float = DEFAULT_TTL) -> Optional["SearchIndex"]:
+        """ Opens the index, `None` if the database can't be opened, e.g. it is locked or corrupt """
+        try:
+            return cls(path, ttl)
+        except sqlite3.Error:
+            return None
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=30)
+        return connection
+
+    def create_table(self, table: str) -> None:
+        if self.trigram:
+            self.connection().execute(
+                f"CREATE VIRTUAL TABLE {table} USING fts5(key, size UNINDEXED, mtime UNINDEXED, storage_class UNINDEXED, "
+                f"tokenize='trigram')")
+        else:
+            self.connection().execute(
+                f"CREATE TABLE {table} (key TEXT NOT NULL, size INTEGER, mtime REAL, storage_class TEXT)")
+
+    def drop_table(self, table: str) -> None:
+        try:
+            self.connection().execute(f"DROP TABLE IF EXISTS {table}")
+        except sqlite3.Error:
+            pass
+
+    def _drop_orphan_tables(self) -> None:
+        """ Drops tables of builds that were never committed, e.g. when the app was closed during search """
+        connection = self.connection()
+        used = {row[0] for row in connection.execute("SELECT key_table FROM buckets")}
+        # FTS5 shadow tables are named keys_<id>_<suffix>, they are dropped with their table
+        for name, in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'keys_*' "
+                "AND name NOT GLOB 'keys_*_*'").fetchall():
+            if name not in used:
+                self.drop_table(name)
+
+    def builder(self, scope: CacheScope, bucket: str) -> SearchIndexBuilder:
+        return SearchIndexBuilder(self, scope, bucket)
+
+    def replace_table(self, scope: CacheScope, bucket: str, table: str, key_count: int) -> None:
+        connection = self.connection()
+        with connection:
+            row = connection.execute(
+                "SELECT key_table FROM buckets WHERE credential = ? AND endpoint = ? AND bucket = ?",
+                (*scope, bucket)).fetchone()
+            connection.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?, ?)",
+                               (*scope, bucket, table, key_count, time.time()))
+        if row is not None:
+            self.drop_table(row[0])
+
+    def apply_changes(self, scope: CacheScope, bucket: str, changed: List[S3Object], removed: List[str]) -> None:
+        """
+        Applies changes a listing of the bucket found to its index, e.g. when a folder is refreshed after an upload.
+        Changed files are written and removed keys are deleted, for folders with every key under them. Keys under
+        new folders are indexed when the bucket is indexed again, the index stays as fresh as it was. Changes are
+        written in order on a background thread, so that the GUI thread doesn't wait for the database.
+        """
+        files = [obj for obj in changed if obj.type == ObjectType.FILE]
+        if files or removed:
+            self._writer.submit(self._apply_changes, scope, bucket, files, removed)
+
+    def _apply_changes(self, scope: CacheScope, bucket: str, files: List[S3Object], removed: List[str]) -> None:
+        connection = self.connection()
+        try:
+            row = connection.execute(
+                "SELECT key_table FROM buckets WHERE credential = ? AND endpoint = ? AND bucket = ?",
+                (*scope, bucket)).fetchone()
+            if row is None:
+                return
+            table = row[0]
+            # Changed files are deleted first, so that they are never indexed twice
+            patterns = [_glob_escape(obj.key) for obj in files] + \
+                       [_glob_pattern("", key) if key.endswith("/") else _glob_escape(key) for key in removed]
+            with connection:
+                deleted = connection.executemany(f"DELETE FROM {table} WHERE key GLOB ?",
+                                                 [(pattern,) for pattern in patterns]).rowcount
+                connection.executemany(
+                    f"INSERT INTO {table} (key, size, mtime, storage_class) VALUES (?, ?, ?, ?)",
+                    [(obj.key, obj.size, obj.last_modified.timestamp() if obj.last_modified else 0, obj.storage_class)
+                     for obj in files])
+                connection.execute("UPDATE buckets SET key_count = max(key_count + ?, 0) "
+                                   "WHERE credential = ? AND endpoint = ? AND bucket = ?",
+                                   (len(files) - deleted, *scope, bucket))
+        except sqlite3.Error:
+            # Index is best effort, a bucket whose index can't be updated is listed by the next search
+            self.invalidate(scope, bucket)
+
+    def _fresh_table(self, scope: CacheScope, bucket: str) -> Optional[tuple]:
+        try:
+            row = self.connection().execute(
+                "SELECT key_table, key_count, indexed_at FROM buckets "
+                "WHERE credential = ? AND endpoint = ? AND bucket = ?", (*scope, bucket)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+        return row[0], row[1]
+
+    def is_fresh(self, scope: CacheScope, bucket: str) -> bool:
+        return self._fresh_table(scope, bucket) is not None
+
+    def key_count(self, scope: CacheScope, bucket: str, prefix: str = "") -> int:
+        """ Returns number of indexed keys of bucket, or of keys under prefix """
+        table = self._fresh_table(scope, bucket)
+        if table is None:
+            return 0
+        if not prefix:
+            return table[1]
+        return self.connection().execute(f"SELECT count(*) FROM {table[0]} WHERE key GLOB ?",
+                                         (_glob_pattern("", prefix),)).fetchone()[0]
+
+    def search(self, scope: CacheScope, bucket: str, terms: Sequence[str] = (), prefix: str = "",
+               batch_size: int = PAGE_SIZE) -> Iterator[List[S3Object]]:
+        """ Yields indexed keys of bucket under prefix containing every term after it, in key order and in batches """
+        table = self._fresh_table(scope, bucket)
+        if table is None:
+            return
+        patterns = [_glob_pattern(term, prefix) for term in terms] or [_glob_pattern("", prefix)]
+        cursor = self.connection().execute(
+            f"SELECT key, size, mtime, storage_class FROM {table[0]} "
+            f"WHERE {' AND '.join(['key GLOB ?'] * len(patterns))} ORDER BY key", patterns)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [S3Object(bucket, key, ObjectType.FOLDER if key.endswith("/") else ObjectType.FILE, size,
+                            datetime.fromtimestamp(mtime, timezone.utc) if mtime else None, storage_class)
+                   for key, size, mtime, storage_class in rows]
+
+    def invalidate(self, scope: CacheScope, bucket: str = None) -> None:
+        """ Makes index of the bucket, or of every bucket of the credential, stale """
+        try:
+            with self.connection() as connection:
+                if bucket is None:
+                    connection.execute("UPDATE buckets SET indexed_at = 0 WHERE credential = ? AND endpoint = ?",
+                                       scope)
+                else:
+                    connection.execute("UPDATE buckets SET indexed_at = 0 "
+                                       "WHERE credential = ? AND endpoint = ? AND bucket = ?", (*scope, bucket))
+        except sqlite3.Error:
+            pass
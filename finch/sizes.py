@@ -0,0 +1,150 @@
+import functools
+import time
+from typing import Dict, Optional, Tuple
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from finch.cache import ListingCache, CacheScope, PrefixSize
+from finch.jobs import BackgroundJob, JobPool
+from finch.listing import iter_sharded_object_pages
+
+# Maximum number of prefixes aggregated at the same time
+MAX_CONCURRENT_AGGREGATIONS = 2
+# Shards listed at the same time by each aggregation
+AGGREGATION_SHARD_WORKERS = 4
+
+
+class PrefixSizeJob(BackgroundJob):
+    """ Lists every key under a bucket or folder on a thread pool worker and emits running totals per page """
+
+    class Signals(QObject):
+        progress = pyqtSignal(object, object)  # total bytes, object count so far
+        failed = pyqtSignal(object)  # exception
+        finished = pyqtSignal()
+
+    def __init__(self, bucket: str, prefix: str = ""):
+        super().__init__()
+        self.signals = self.Signals()
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def run(self):
+        size = count = 0
+        try:
+            if self.cancelled:
+                return
+            for page in iter_sharded_object_pages(self.bucket, self.prefix, max_workers=AGGREGATION_SHARD_WORKERS):
+                if self.cancelled:
+                    break
+                size += sum(obj.size for obj in page.objects)
+                count += len(page.objects)
+                self.signals.progress.emit(size, count)
+        except Exception as e:
+            self.error = e
+            self.signals.failed.emit(e)
+        finally:
+            self.signals.finished.emit()
+
+
+class PrefixSizeAggregator(QObject):
+    """
+    Computes total size and object count of buckets and folders in background.
+
+    Running totals are available with `get` while the prefix is listed, `size_changed` is emitted after every
+    page. Completed totals are kept in the `ListingCache` until an operation under the prefix invalidates them.
+    """
+    size_changed = pyqtSignal(str, str)  # bucket, prefix
+    failed = pyqtSignal(object)  # exception
+    running_changed = pyqtSignal(int)  # number of running or queued aggregations
+
+    def __init__(self, cache: ListingCache = None, cache_scope: CacheScope = None,
+                 max_concurrent: int = MAX_CONCURRENT_AGGREGATIONS, parent=None):
+        super().__init__(parent)
+        self.cache = cache
+        self.cache_scope = cache_scope
+        self.thread_pool = JobPool(max_concurrent, self)
+        # Completed and running totals, `None` when the cache was checked and had nothing
+        self._sizes: Dict[Tuple[str, str], Optional[PrefixSize]] = {}
+        self._jobs: Dict[Tuple[str, str], PrefixSizeJob] = {}
+
+    def set_max_concurrent(self, max_concurrent: int) -> None:
+        self.thread_pool.setMaxThreadCount(max_concurrent)
+
+    def get(self, bucket: str, prefix: str = "") -> Optional[PrefixSize]:
+        """ Returns total size of the prefix, partial while it is computed, or `None` if it is not known """
+        key = (bucket, prefix)
+        if key not in self._sizes:
+            self._sizes[key] = self.cache.get_size(self.cache_scope, bucket, prefix) if self.cache else None
+        return self._sizes[key]
+
+    def is_running(self, bucket: str = None, prefix: str = "") -> bool:
+        """ Returns whether the prefix, or any prefix if no bucket is given, is being aggregated """
+        if bucket is None:
+            return bool(self._jobs)
+        return (bucket, prefix) in self._jobs
+
+    def start(self, bucket: str, prefix: str = "") -> None:
+        """ Starts computing total size of the prefix again, unless it is already being computed """
+        key = (bucket, prefix)
+        if key in self._jobs:
+            return
+        job = PrefixSizeJob(bucket, prefix)
+        job.signals.progress.connect(functools.partial(self._handle_progress, key, job))
+        job.signals.failed.connect(functools.partial(self._handle_failure, key, job))
+        job.signals.finished.connect(functools.partial(self._handle_finished, key, job))
+        self._jobs[key] = job
+        self._sizes[key] = PrefixSize(0, 0, 0.0)
+        self.thread_pool.start(job)
+        self.size_changed.emit(bucket, prefix)
+        self.running_changed.emit(len(self._jobs))
+
+    def cancel(self, bucket: str = None, prefix: str = "") -> None:
+        """ Cancels aggregation of the prefix, or every aggregation if no bucket is given """
+        keys = list(self._jobs) if bucket is None else [(bucket, prefix)]
+        for key in keys:
+            job = self._jobs.pop(key, None)
+            if job is None:
+                continue
+            self.thread_pool.cancel(job)
+            # Partial totals are not shown, the cached total is looked up again if any
+            self._sizes.pop(key, None)
+            self.size_changed.emit(*key)
+        self.running_changed.emit(len(self._jobs))
+
+    def invalidate(self, bucket: str, prefix: str = None) -> None:
+        """ Forgets totals of the prefix, its sub folders and the folders containing it, or of the whole bucket """
+        for key in list(self._sizes):
+            key_bucket, key_prefix = key
+            if key_bucket != bucket or key in self._jobs:
+                continue
+            if prefix is None or key_prefix.startswith(prefix) or prefix.startswith(key_prefix):
+                del self._sizes[key]
+                self.size_changed.emit(*key)
+
+    def clear(self) -> None:
+        self.cancel()
+        self._sizes = {}
+
+    def _handle_progress(self, key: Tuple[str, str], job: PrefixSizeJob, size: int, count: int) -> None:
+        if self._jobs.get(key) is not job:
+            return
+        self._sizes[key] = PrefixSize(size, count, 0.0)
+        self.size_changed.emit(*key)
+
+    def _handle_failure(self, key: Tuple[str, str], job: PrefixSizeJob, error: Exception) -> None:
+        if self._jobs.get(key) is job:
+            self.failed.emit(error)
+
+    def _handle_finished(self, key: Tuple[str, str], job: PrefixSizeJob) -> None:
+        if self._jobs.get(key) is not job:
+            return
+        del self._jobs[key]
+        if job.error is None:
+            size = self._sizes[key]
+            size = self._sizes[key] = PrefixSize(size.size, size.count, time.time())
+            if self.cache is not None:
+                self.cache.put_size(self.cache_scope, *key, size)
+        else:
+            self._sizes.pop(key, None)
+        self.size_changed.emit(*key)
+        self.running_changed.emit(len(self._jobs))
@@ -0,0 +1,170 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, NamedTuple, Optional
+
+from finch.common import CONFIG_PATH
+
+MB = 1024 * 1024
+# Bytes read from a local file at once while hashing it, part sizes are whole multiples of it
+HASH_BLOCK_SIZE = MB
+# Part size of AWS CLI and boto3 uploads, tried for ETags of multipart uploads
+DEFAULT_UPLOAD_PART_SIZE = 8 * MB
+
+
+class SyncedFile(NamedTuple):
+    """ Version of an object a local file has, and size and modification time of the file when it was recorded """
+    etag: Optional[str]
+    size: int
+    last_modified: float  # POSIX timestamp of the object, 0 when unknown
+    local_size: int
+    local_mtime_ns: int
+
+
+def normalize_etag(etag: Optional[str]) -> Optional[str]:
+    return etag.strip('"') if etag else None
+
+
+def file_etags(path: str, part_sizes: Iterable[int] = ()) -> Dict[int, str]:
+    """
+    Returns ETags S3 gives the file when it is uploaded with one request, by part size 0, and when it is uploaded in
+    parts of the part sizes. Every ETag is computed with one read of the file.
+    """
+    whole = hashlib.md5()
+    parts = {part_size: [[], hashlib.md5()] for part_size in part_sizes}
+    position = 0
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            whole.update(block)
+            position += len(block)
+            for part_size, (digests, part) in parts.items():
+                part.update(block)
+                if position % part_size == 0:
+                    digests.append(part.digest())
+                    parts[part_size][1] = hashlib.md5()
+    etags = {0: whole.hexdigest()}
+    for part_size, (digests, part) in parts.items():
+        if position % part_size:
+            digests.append(part.digest())
+        etags[part_size] = f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+    return etags
+
+
+def matches_etag(path: str, size: int, etag: str, part_size: int) -> bool:
+    """
+    Returns whether a local file has the content of an object by its ETag. ETags of single request uploads are MD5
+    hashes of the content. Multipart ETags are tried with the part size the application uploads with, the AWS CLI
+    default and the whole megabytes that give the number of parts in the ETag. ETags of encrypted objects never match.
+    """
+    if "-" not in etag:
+        return file_etags(path)[0] == etag
+    try:
+        parts = int(etag.rsplit("-", 1)[1])
+    except ValueError:
+        return False
+    if parts < 1:
+        return False
+    part_sizes = {part_size, DEFAULT_UPLOAD_PART_SIZE, -(-size // parts // MB) * MB}
+    # Only part sizes that split the file into as many parts as the ETag tells
+    part_sizes = {x for x in part_sizes if x > 0 and x % HASH_BLOCK_SIZE == 0 and -(-size // x) == parts}
+    if not part_sizes:
+        return False
+    return etag in file_etags(path, part_sizes).values()
+
+
+class SyncState:
+    """
+    Versions of objects that local files were downloaded from or were found to match, by local path. Downloads in
+    sync mode skip a file if its local copy has the current version of the object.
+
+    A record is trusted while size and modification time of the local file are the same as when it was recorded.
+    Files without a record, e.g. copies made by other tools, are hashed once and recorded if they match the ETag.
+    The state is best effort, database errors are treated as missing records.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(CONFIG_PATH, "sync_state.sqlite3")
+        # Files are checked from transfer workers, every thread has its own connection
+        self._local = threading.local()
+        with self.connection() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    bucket TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    etag TEXT,
+                    size INTEGER NOT NULL,
+                    last_modified REAL NOT NULL,
+                    local_size INTEGER NOT NULL,
+                    local_mtime_ns INTEGER NOT NULL
+                )""")
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=30)
+        return connection
+
+    def get(self, path: str) -> Optional[SyncedFile]:
+        try:
+            row = self.connection().execute(
+                "SELECT etag, size, last_modified, local_size, local_mtime_ns FROM files WHERE path = ?",
+                (os.path.abspath(path),)).fetchone()
+        except sqlite3.Error:
+            return None
+        return SyncedFile(*row) if row is not None else None
+
+    def record(self, path: str, bucket: str, key: str, etag: Optional[str], size: int,
+               last_modified: Optional[datetime]) -> None:
+        """ Records that the local file has the version of the object, e.g. after it is downloaded """
+        try:
+            stat = os.stat(path)
+            with self.connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (os.path.abspath(path), bucket, key, normalize_etag(etag), size,
+                     last_modified.timestamp() if last_modified else 0, stat.st_size, stat.st_mtime_ns))
+        except (OSError, sqlite3.Error):
+            pass
+
+    def forget(self, path: str) -> None:
+        try:
+            with self.connection() as connection:
+                connection.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(path),))
+        except sqlite3.Error:
+            pass
+
+    def is_unchanged(self, path: str, bucket: str, key: str, etag: Optional[str], size: int,
+                     last_modified: Optional[datetime], part_size: int) -> bool:
+        """
+        Returns whether the local file has the version of the object. Without a record of the file, the file is
+        compared by its hash with the ETag, `part_size` is the part size the object would be uploaded with.
+        """
+        etag = normalize_etag(etag)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != size:
+            return False
+        synced = self.get(path)
+        if synced is not None and synced.local_size == stat.st_size and synced.local_mtime_ns == stat.st_mtime_ns:
+            # Local file wasn't changed since it was recorded
+            if etag and synced.etag:
+                return synced.etag == etag
+            return synced.size == size and \
+                synced.last_modified == (last_modified.timestamp() if last_modified else 0)
+        if not etag:
+            return False
+        try:
+            matches = matches_etag(path, size, etag, part_size)
+        except OSError:
+            return False
+        if matches:
+            self.record(path, bucket, key, etag, size, last_modified)
+        return matches
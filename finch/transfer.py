@@ -0,0 +1,141 @@
+import json
+import os
+from dataclasses import dataclass, asdict, fields
+from typing import Dict, Optional
+
+from boto3.s3.transfer import TransferConfig
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QFormLayout, QSpinBox, QDialogButtonBox, QLabel
+
+from finch.common import CONFIG_PATH
+
+MB = 1024 * 1024
+# S3 limits of multipart uploads
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10_000
+# Bounds of automatically chosen part sizes, parts of large files are at most this big
+AUTO_PART_SIZE_MIN = 8 * MB
+AUTO_PART_SIZE_MAX = 512 * MB
+
+
+@dataclass
+class TransferSettings:
+    """ Multipart transfer settings of a credential and endpoint """
+    max_files: int = 3  # Files transferred at the same time, by all uploads and downloads together
+    max_concurrency: int = 10  # Parts of a file transferred at the same time
+    part_size: int = 0  # Bytes, 0 chooses part size by file size
+    multipart_threshold: int = 8 * MB  # Files from this size on are transferred in parts
+    io_chunk_size: int = 256 * 1024  # Bytes read from a network stream at once
+
+    def part_size_for(self, file_size: Optional[int]) -> int:
+        """
+        Returns part size for a file. By default every part transfer thread gets a few parts of the file, parts
+        are never smaller than S3 allows or more than S3 allows.
+        """
+        if self.part_size:
+            size = max(self.part_size, MIN_PART_SIZE)
+        elif file_size:
+            size = min(max(file_size // (self.max_concurrency * 4), AUTO_PART_SIZE_MIN), AUTO_PART_SIZE_MAX)
+        else:
+            size = AUTO_PART_SIZE_MIN
+        if file_size:
+            size = max(size, -(-file_size // MAX_PARTS))
+        # Whole megabytes
+        return -(-size // MB) * MB
+
+    def transfer_config(self, file_size: Optional[int] = None, max_concurrency: int = None) -> TransferConfig:
+        """
+        Returns boto3 transfer configuration for a file, `None` size when it is not known. `max_concurrency` limits
+        parallel parts below the settings, e.g. to the connections the transfer scheduler granted.
+        """
+        return TransferConfig(multipart_threshold=self.multipart_threshold,
+                              multipart_chunksize=self.part_size_for(file_size),
+                              max_concurrency=min(max_concurrency or self.max_concurrency, self.max_concurrency),
+                              io_chunksize=self.io_chunk_size)
+
+    @property
+    def max_pool_connections(self) -> int:
+        """ HTTP connections a client needs so that every part of every file has one """
+        return max(self.max_files * self.max_concurrency, 10)
+
+
+class TransferSettingsStore:
+    """ Transfer settings by credential and endpoint, stored next to `credentials.json` """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(CONFIG_PATH, "transfer_settings.json")
+        try:
+            with open(self.path, "r") as settings_file:
+                self.settings: Dict[str, Dict[str, dict]] = json.loads(settings_file.read())
+        except (OSError, json.JSONDecodeError):
+            self.settings = {}
+
+    def get(self, credential: str, endpoint: str) -> TransferSettings:
+        stored = self.settings.get(credential, {}).get(endpoint or "", {})
+        # Unknown keys are ignored, e.g. settings written by a newer version
+        names = {field.name for field in fields(TransferSettings)}
+        return TransferSettings(**{name: value for name, value in stored.items() if name in names})
+
+    def set(self, credential: str, endpoint: str, settings: TransferSettings) -> None:
+        self.settings.setdefault(credential, {})[endpoint or ""] = asdict(settings)
+        with open(self.path, "w+") as settings_file:
+            settings_file.write(json.dumps(self.settings))
+
+
+class TransferSettingsDialog(QDialog):
+    """ Dialog for editing transfer settings of a credential """
+
+    def __init__(self, credential: str, settings: TransferSettings, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(f"Transfer Settings of {credential}")
+        self.settings = settings
+        layout = QVBoxLayout()
+        form = QFormLayout()
+
+        self.max_files_input = self._spin_box(1, 64, settings.max_files)
+        self.max_concurrency_input = self._spin_box(1, 128, settings.max_concurrency)
+        self.part_size_input = self._spin_box(0, 5 * 1024, settings.part_size // MB, " MB")
+        self.part_size_input.setSpecialValueText("Automatic")
+        self.multipart_threshold_input = self._spin_box(MIN_PART_SIZE // MB, 5 * 1024,
+                                                        settings.multipart_threshold // MB, " MB")
+        self.io_chunk_size_input = self._spin_box(16, 16 * 1024, settings.io_chunk_size // 1024, " KB")
+        form.addRow("Parallel files", self.max_files_input)
+        form.addRow("Parallel parts per file", self.max_concurrency_input)
+        form.addRow("Part size", self.part_size_input)
+        form.addRow("Multipart threshold", self.multipart_threshold_input)
+        form.addRow("IO chunk size", self.io_chunk_size_input)
+
+        hint = QLabel("Automatic part size gives every parallel part a few parts of the file.\n"
+                      "Fast links benefit from more parallel parts and larger chunks.")
+        buttons = QDialogButtonBox(QDialogButtonBox.Save | QDialogButtonBox.Cancel |
+                                   QDialogButtonBox.RestoreDefaults)
+        buttons.accepted.connect(self.on_accept)
+        buttons.rejected.connect(self.reject)
+        buttons.button(QDialogButtonBox.RestoreDefaults).clicked.connect(self.restore_defaults)
+        layout.addLayout(form)
+        layout.addWidget(hint)
+        layout.addWidget(buttons)
+        self.setLayout(layout)
+
+    @staticmethod
+    def _spin_box(minimum: int, maximum: int, value: int, suffix: str = "") -> QSpinBox:
+        spin_box = QSpinBox()
+        spin_box.setRange(minimum, maximum)
+        spin_box.setValue(value)
+        spin_box.setSuffix(suffix)
+        return spin_box
+
+    def restore_defaults(self):
+        defaults = TransferSettings()
+        self.max_files_input.setValue(defaults.max_files)
+        self.max_concurrency_input.setValue(defaults.max_concurrency)
+        self.part_size_input.setValue(defaults.part_size // MB)
+        self.multipart_threshold_input.setValue(defaults.multipart_threshold // MB)
+        self.io_chunk_size_input.setValue(defaults.io_chunk_size // 1024)
+
+    def on_accept(self):
+        self.settings = TransferSettings(max_files=self.max_files_input.value(),
+                                         max_concurrency=self.max_concurrency_input.value(),
+                                         part_size=self.part_size_input.value() * MB,
+                                         multipart_threshold=self.multipart_threshold_input.value() * MB,
+                                         io_chunk_size=self.io_chunk_size_input.value() * 1024)
+        self.accept()
@@ -1,59 +1,183 @@
+import functools
 import os
+import threading
+from typing import List
 
-from PyQt5.QtCore import QObject, pyqtSignal, QThread, QMutex
-from PyQt5.QtWidgets import QProgressDialog
+from PyQt5.QtCore import QObject, pyqtSignal, QMutex
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QLabel, QProgressBar, QPushButton
 
-from finch.common import s3_session
+from finch.common import s3_session, center_window, StringUtils
+from finch.error import show_error_dialog
+from finch.progress import ProgressSnapshot, TransferProgress
+from finch.scheduler import TransferJob, TransferJobControls, TransferPaused, transfer_scheduler
+from finch.transfer import TransferSettings
 
 
 class S3Uploader(QObject):
-    progress_updated = pyqtSignal(int)
+    """
+    Uploads files to a folder as one job of the application's `TransferScheduler`, progress is published by
+    `progress` at a fixed rate.
+    """
+    file_uploaded = pyqtSignal(str)  # local path
+    upload_failed = pyqtSignal(str, str)  # local path, error message
+    finished = pyqtSignal()
 
-    def __init__(self, file_path, bucket_name, folder):
+    def __init__(self, file_paths: List[str], bucket_name, folder, job: TransferJob = None):
         super().__init__()
-        self.file_path = file_path
+        self.file_paths = file_paths
         self.bucket_name = bucket_name
         self.folder = folder
-        self.uploaded_size = 0
+        self.job = job or TransferJob("Upload")
+        self.scheduler = transfer_scheduler
+        # Credential and settings of when the upload was created, switching credentials doesn't redirect it
+        self.clients = s3_session.clients
+        self.settings = s3_session.transfer_settings or TransferSettings()
+        self.job.set_limits(self.settings.max_files, self.settings.max_pool_connections)
+        self.progress = TransferProgress()
+        self.progress.add_total(sum(os.path.getsize(file_path) for file_path in file_paths))
+        self.remaining = len(file_paths)
+        self.is_cancelled = False
+        self._lock = threading.Lock()
 
-    def run(self):
-        file_name = self.file_path.split('/')[-1]
-        total_size = os.path.getsize(self.file_path)
+    def start(self):
+        self.progress.start()
+        for file_path in self.file_paths:
+            size = os.path.getsize(file_path)
+            # Files sent with one request need one connection, larger files one per part sent at once
+            connections = 1 if size < self.settings.multipart_threshold else self.settings.max_concurrency
+            self.scheduler.submit(self.job, functools.partial(self._upload, file_path, size), connections=connections,
+                                  on_error=functools.partial(self._handle_error, file_path))
+
+    def cancel(self):
+        """ Drops uploads waiting for a worker, running uploads stop at their next chunk """
+        self.is_cancelled = True
+        self.scheduler.cancel(self.job)
+
+    def _upload(self, file_path, total_size, connections):
+        file_name = file_path.split('/')[-1]
         if self.folder:
             s3_path = f"{self.folder}/{file_name}"
         else:
             s3_path = file_name
-        with open(self.file_path, 'rb') as f:
-            s3_session.resource.meta.client.upload_fileobj(f, self.bucket_name, s3_path,
-                                                           Callback=lambda bytes_amount: self.update_progress(
-                                                               bytes_amount, total_size))
+        # An upload paused before starts over
+        self.progress.start_item(file_path, total_size)
+
+        def update_progress(bytes_amount):
+            if self.is_cancelled:
+                raise InterruptedError("Upload cancelled")
+            if self.job.paused:
+                raise TransferPaused()
+            self.progress.add(file_path, bytes_amount)
+
+        try:
+            with open(file_path, 'rb') as f:
+                self.clients.client(self.bucket_name).upload_fileobj(
+                    f, self.bucket_name, s3_path, Callback=update_progress,
+                    Config=self.settings.transfer_config(total_size, connections))
+        except Exception as e:
+            # Callbacks run while a request body is sent can arrive wrapped in a botocore error
+            if not self.is_cancelled and self.job.paused:
+                raise TransferPaused() from e
+            self.progress.finish_item(file_path)
+            if not self.is_cancelled:
+                self.upload_failed.emit(file_path, str(e))
+        else:
+            self.progress.finish_item(file_path)
+            self.file_uploaded.emit(file_path)
+        self._file_done()
+
+    def _handle_error(self, file_path: str, error: Exception) -> None:
+        """ Reports an error the upload task didn't handle itself, the file counts as done """
+        self.progress.finish_item(file_path)
+        self.upload_failed.emit(file_path, str(error))
+        self._file_done()
+
+    def _file_done(self) -> None:
+        with self._lock:
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.finished.emit()
 
-    def update_progress(self, bytes_amount, total_size):
-        self.uploaded_size += bytes_amount
-        percent = int((self.uploaded_size / total_size) * 100)
-        self.progress_updated.emit(percent)
 
+class UploadDialog(QDialog):
+    """ Progress of uploading files to a folder, uploads run on the transfer scheduler next to other transfers """
+    uploads_finished = pyqtSignal()
 
-class UploadDialog(QProgressDialog):
-    def __init__(self, file_path, bucket_name, folder=None):
-        super().__init__(f"Uploading file {os.path.basename(file_path)}...", "Cancel", 0, 100)
+    def __init__(self, file_paths: List[str], bucket_name, folder=None):
+        super().__init__()
         if folder:
             folder = folder[:-1]
-        self.uploader_thread = QThread(parent=self)
-        self.uploader = S3Uploader(file_path, bucket_name, folder)
-        self.uploader.moveToThread(self.uploader_thread)
-        self.uploader.progress_updated.connect(self.setValue)
-        self.uploader_thread.started.connect(self.uploader.run)
-        self.uploader_thread.start()
+        if len(file_paths) == 1:
+            title = f"Uploading file {os.path.basename(file_paths[0])}..."
+        else:
+            title = f"Uploading {len(file_paths)} files..."
+        self.setWindowTitle(title)
+        self.setMinimumWidth(400)
+        center_window(self)
+        self.failed = 0
+        self.is_finished = False
+        self.uploader = S3Uploader(file_paths, bucket_name, folder, job=TransferJob(title))
+        self.uploader.progress.updated.connect(self._update_progress)
+        self.uploader.upload_failed.connect(self._handle_failure)
+        self.uploader.finished.connect(self._handle_finished)
         self.cleanup_mutex = QMutex()
 
-    def show(self):
-        self.uploader_thread.start()
-        super().show()
+        layout = QVBoxLayout()
+        self.status_label = QLabel(title)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 100)
+        self.job_controls = TransferJobControls(self.uploader.job)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cleanup)
+        layout.addWidget(self.status_label)
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.job_controls)
+        layout.addWidget(self.cancel_button)
+        self.setLayout(layout)
+        self.uploader.start()
+
+    def _update_progress(self, snapshot: ProgressSnapshot):
+        if snapshot.total:
+            self.progress_bar.setValue(int(snapshot.transferred / snapshot.total * 100))
+        status = f"{StringUtils.format_size(snapshot.transferred).strip()} of " \
+                 f"{StringUtils.format_size(snapshot.total).strip()}"
+        if snapshot.speed > 0:
+            status += f", {StringUtils.format_size(snapshot.speed).strip()}/s"
+        if self.uploader.job.paused:
+            status += ", paused"
+        elif snapshot.eta is not None:
+            status += f", {StringUtils.format_duration(snapshot.eta)} left"
+        self.status_label.setText(f"{self.windowTitle()} ({status})")
+
+    def _handle_failure(self, file_path: str, error: str):
+        self.failed += 1
+        show_error_dialog(f"Failed to upload {file_path}: {error}")
+
+    def _handle_finished(self):
+        if self.is_finished:
+            # Cancelled, uploads that were running have stopped
+            return
+        self.is_finished = True
+        self.uploader.progress.stop()
+        self.uploads_finished.emit()
+        if self.failed:
+            self.status_label.setText(f"Upload finished, {self.failed} files failed")
+            self.cancel_button.setText("Close")
+        else:
+            self.accept()
 
     def cleanup(self):
         self.cleanup_mutex.lock()
-        self.uploader_thread.quit()
-        self.uploader_thread.wait()
+        if not self.is_finished:
+            self.uploader.progress.stop()
+            self.uploader.cancel()
+            # Files uploaded before cancelling are listed
+            self.is_finished = True
+            self.uploads_finished.emit()
         self.cleanup_mutex.unlock()
         self.close()
+
+    def closeEvent(self, event):
+        if not self.is_finished:
+            self.cleanup()
+        super().closeEvent(event)
@@ -0,0 +1,66 @@
+from PyQt5.QtCore import Qt, QModelIndex
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWidgets import (
+    QWidget, QHBoxLayout, QVBoxLayout, QLabel, QPushButton, QTreeView, QAbstractItemView
+)
+
+from finch.common import resource_path, set_column_widths
+from finch.filelist import S3FlatListModel
+
+
+class FlatViewWidget(QWidget):
+    """ Shows every key under a bucket or folder as one flat list, in place of the file treeview """
+
+    def __init__(self, main_widget: QWidget, bucket: str, prefix: str = ""):
+        super().__init__()
+        self.main_widget = main_widget
+        self.model = S3FlatListModel(main_widget.icon_type, bucket, prefix, parent=self)
+        self._init_ui()
+
+    def _init_ui(self):
+        """Initialize UI components."""
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        bar = QHBoxLayout()
+        self.title_label = QLabel(f"Flat view of {self.model.bucket}/{self.model.prefix}")
+        self.count_label = QLabel()
+        self.stop_button = QPushButton("Stop")
+        self.stop_button.clicked.connect(self.model.cancel)
+        self.close_button = QPushButton("")
+        self.close_button.setIcon(QIcon(resource_path('img/close.svg')))
+        self.close_button.setFlat(True)
+        self.close_button.setStyleSheet("QPushButton { background-color: transparent }")
+        self.close_button.clicked.connect(self.main_widget.close_flat_view)
+        bar.addWidget(self.title_label)
+        bar.addStretch()
+        bar.addWidget(self.count_label)
+        bar.addWidget(self.stop_button)
+        bar.addWidget(self.close_button)
+
+        self.view = QTreeView()
+        self.view.setRootIsDecorated(False)
+        self.view.setUniformRowHeights(True)
+        self.view.setModel(self.model)
+        self.view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.view.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.view.setSelectionBehavior(QAbstractItemView.SelectRows)
+        set_column_widths(self.view.header(), {1: 140, 2: 140})
+
+        self.model.rowsInserted.connect(self._update_count)
+        self.model.modelReset.connect(self._update_count)
+        self.model.loading_changed.connect(self._update_count)
+        self._update_count()
+
+        layout.addLayout(bar)
+        layout.addWidget(self.view)
+        self.setLayout(layout)
+
+    def _update_count(self, *args):
+        loading = self.model.is_loading()
+        more = "+" if self.model.canFetchMore(QModelIndex()) or loading else ""
+        self.count_label.setText(f"{self.model.rowCount()}{more} keys" + (", listing…" if loading else ""))
+        self.stop_button.setEnabled(loading)
+
+    def close(self):
+        self.model.cancel()
+        super().close()
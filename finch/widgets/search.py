@@ -1,18 +1,30 @@
-import json
+import functools
 
+from PyQt5.QtCore import QItemSelectionModel
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import (
-    QWidget, QHBoxLayout, QLineEdit, QPushButton, QTreeWidgetItem, QStyle
+    QWidget, QHBoxLayout, QLineEdit, QPushButton, QLabel, QCheckBox
 )
 
-from finch.common import s3_session, ObjectType, StringUtils, resource_path
+from finch.common import ObjectType, resource_path, StringUtils
+from finch.error import show_error_dialog
+from finch.filelist import S3ObjectTreeModel
+from finch.jobs import JobPool
+from finch.query import QuerySyntaxError, SearchQuery
+from finch.search import S3SearchJob
 
 
 class SearchWidget(QWidget):
     def __init__(self, main_widget: QWidget):
         super().__init__()
         self.main_widget = main_widget
-        self.icon_type = self._initialize_icons()
+        self.thread_pool = JobPool(1, self)
+        self.search_job = None
+        self._model = None  # Model results of the running search are added to
+        self._matches = []  # Matches of the running search, they are selected when it finishes
+        self._expanded_buckets = set()
+        # Bucket and folder selected when search was opened, searches can be limited to it
+        self.scope = self._selected_scope()
         self._init_ui()
 
     def showEvent(self, event):
@@ -21,29 +33,64 @@ class SearchWidget(QWidget):
         self.search_input.setFocus()
 
     def close(self):
+        self._cancel_search()
         super().close()
         for idx, action in enumerate(self.main_widget.file_toolbar.actions()):
             if idx in [5]:
                 action.setDisabled(False)
         self.main_widget.layout.removeWidget(self)
 
-
-    def _initialize_icons(self):
-        """Initialize icon mapping for different object types."""
-        style = self.style()
-        return {
-            ObjectType.FILE: style.standardIcon(QStyle.SP_FileIcon),
-            ObjectType.FOLDER: style.standardIcon(QStyle.SP_DirIcon),
-            ObjectType.BUCKET: style.standardIcon(QStyle.SP_DirIcon),
-        }
+    def _selected_scope(self):
+        """Returns bucket and folder of the selected item, folder containing it for files, or None."""
+        indexes = self.main_widget.get_selected_indexes()
+        if len(indexes) != 1:
+            return None
+        index = indexes[0]
+        object_type = index.data(S3ObjectTreeModel.ObjectTypeRole)
+        key = index.data(S3ObjectTreeModel.KeyRole)
+        if object_type == ObjectType.BUCKET:
+            prefix = ""
+        elif object_type == ObjectType.FOLDER:
+            prefix = key
+        else:
+            prefix = StringUtils.parent_prefix(key)
+        return index.data(S3ObjectTreeModel.BucketRole), prefix
 
     def _init_ui(self):
         """Initialize UI components."""
         layout = QHBoxLayout()
         self.search_input = QLineEdit(placeholderText="Search")
+        self.search_input.setToolTip("Text is matched anywhere in keys. Text with \"/\" is a path, e.g. "
+                                     "\"logs/2024/\" searches only keys under it.\n"
+                                     "\"s3://bucket/path\" searches only that bucket.\n"
+                                     "Glob patterns like *.log and re:regex are matched against whole keys.\n"
+                                     "Filters: size>100MB, modified<7d, modified>=2024-01-31, class=GLACIER")
         self.search_input.returnPressed.connect(self._on_search)
         self.search_button = QPushButton("Search")
         self.search_button.clicked.connect(self._on_search)
+        self.cancel_button = QPushButton("Stop")
+        self.cancel_button.clicked.connect(self._on_cancel)
+        self.cancel_button.setEnabled(False)
+        self.index_checkbox = QCheckBox("Use local index")
+        self.index_checkbox.setToolTip("Search buckets searched in the last hour from a local index of their keys")
+        self.index_checkbox.setChecked(True)
+        self.inventory_checkbox = QCheckBox("Use inventory reports")
+        self.inventory_checkbox.setToolTip("Search buckets with a configured S3 Inventory report location by reading "
+                                           "the latest report.\nKeys changed after the report was created are not "
+                                           "found unless newer keys are included.")
+        self.newer_checkbox = QCheckBox("Include newer keys (full listing)")
+        self.newer_checkbox.setToolTip("Also list every key of buckets searched from inventory reports, to find keys "
+                                       "changed after the report was created.\nThis takes as long as searching "
+                                       "without the report.")
+        self.newer_checkbox.setEnabled(False)
+        self.inventory_checkbox.toggled.connect(self.newer_checkbox.setEnabled)
+        self.scope_checkbox = QCheckBox()
+        if self.scope is not None:
+            self.scope_checkbox.setText("Only in {}/{}".format(*self.scope))
+            self.scope_checkbox.setChecked(True)
+        else:
+            self.scope_checkbox.setVisible(False)
+        self.status_label = QLabel()
         self.close_button = QPushButton("")
         self.close_button.setIcon(QIcon(resource_path('img/close.svg')))
         self.close_button.setFlat(True)
@@ -52,105 +99,114 @@ class SearchWidget(QWidget):
 
         layout.addWidget(self.search_input)
         layout.addWidget(self.search_button)
+        layout.addWidget(self.cancel_button)
+        layout.addWidget(self.scope_checkbox)
+        layout.addWidget(self.index_checkbox)
+        layout.addWidget(self.inventory_checkbox)
+        layout.addWidget(self.newer_checkbox)
+        layout.addWidget(self.status_label)
         layout.addWidget(self.close_button)
         self.setLayout(layout)
 
     def _on_search(self):
-        """Handle search button click."""
-        search_term = self.search_input.text()
-        self.main_widget.tree_widget.clear()
-        self._search_and_populate(search_term)
-
-        for i in range(self.main_widget.tree_widget.topLevelItemCount()):
-            self._expand_and_select(self.main_widget.tree_widget.topLevelItem(i), search_term)
-
-    def _search_and_populate(self, search_term):
-        """Search S3 and populate the tree widget."""
-        buckets = self._get_s3_buckets()
-        items = self._search_s3_objects(buckets, search_term)
-
-        for bucket in buckets:
-            bucket_item = self._create_tree_item(
-                name=bucket['Name'], object_type=ObjectType.BUCKET, date=bucket['CreationDate']
-            )
-
-            self.main_widget.tree_widget.addTopLevelItem(bucket_item)
-
-            bucket_objects = [
-                (item['Key'], item['Size'], item['LastModified'])
-                for name, item in items if name == bucket['Name']
-            ]
-            tree_structure = self._build_tree_structure(bucket_objects)
-            self._add_items_to_tree(bucket_item, tree_structure)
-
-    def _get_s3_buckets(self):
-        """Retrieve list of S3 buckets."""
-        return s3_session.resource.meta.client.list_buckets()['Buckets']
-
-    def _search_s3_objects(self, buckets, search_term):
-        """Search for objects in S3 matching the search term."""
-        items = []
-        for bucket in buckets:
-            paginator = s3_session.resource.meta.client.get_paginator('list_objects_v2')
-            for obj in paginator.paginate(Bucket=bucket['Name']).search(
-                f"Contents[?contains(Key, `{json.dumps(search_term)}`)][]"
-            ):
-                if obj:
-                    items.append((bucket['Name'], obj))
-        return items
-
-    def _build_tree_structure(self, objects):
-        """Build a nested dictionary representing the folder structure."""
-        tree = {}
-        for path, size, date in objects:
-            current = tree
-            parts = path.split('/')
-            
-            # Handle the case where path ends with '/' (folder)
-            if path.endswith('/'):
-                folders = parts[:-1]  # Last element is empty for folders ending in '/'
-                for folder in folders:
-                    current = current.setdefault(folder, {})
-            else:
-                *folders, filename = parts
-                # Add all intermediate folders
-                for folder in folders:
-                    current = current.setdefault(folder, {})
-                # Add file with its metadata
-                current[filename] = {"_info": (size, date)}
-        return tree
-
-    def _add_items_to_tree(self, parent_item, tree_dict):
-        """Recursively add items to the tree widget."""
-        # First add all folders
-        for key, value in sorted(tree_dict.items()):
-            if key != "_info" and not "_info" in value:
-                item = self._create_tree_item(name=key, object_type=ObjectType.FOLDER)
-                parent_item.addChild(item)
-                self._add_items_to_tree(item, value)
-        
-        # Then add all files
-        for key, value in sorted(tree_dict.items()):
-            if key != "_info" and "_info" in value:
-                size, date = value["_info"]
-                item = self._create_tree_item(name=key, object_type=ObjectType.FILE, size=size, date=date)
-                parent_item.addChild(item)
-
-    def _expand_and_select(self, item, search_term):
-        """Recursively expand and select matching items."""
-        if item.childCount():
-            item.setExpanded(True)
-        if search_term in item.text(0):
-            item.setSelected(True)
-        for i in range(item.childCount()):
-            self._expand_and_select(item.child(i), search_term)
-
-    def _create_tree_item(self, name, object_type, size=0, date=None):
-        """Create a QTreeWidgetItem with the given texts, type, icon, size, and date."""
-        item = QTreeWidgetItem()
-        item.setText(0, name)
-        item.setIcon(0, self.icon_type[object_type])
-        item.setText(1, object_type)
-        item.setText(2, StringUtils.format_size(size))
-        item.setText(3, StringUtils.format_datetime(date))
-        return item
\ No newline at end of file
+        """Start searching in background, matches are added to the tree as they are found."""
+        bucket, prefix = self.scope if self.scope is not None and self.scope_checkbox.isChecked() else (None, "")
+        try:
+            query = SearchQuery(self.search_input.text(), bucket, prefix)
+        except QuerySyntaxError as e:
+            show_error_dialog(e)
+            return
+        self._cancel_search()
+        self.main_widget.close_flat_view()
+        index = self.main_widget.search_index if self.index_checkbox.isChecked() else None
+        inventory = self.main_widget.inventory_locations if self.inventory_checkbox.isChecked() else None
+        job = S3SearchJob(query, index=index, index_scope=self.main_widget.tree_model.cache_scope,
+                          inventory=inventory, include_newer=self.newer_checkbox.isChecked())
+        job.signals.buckets_listed.connect(functools.partial(self._handle_buckets_listed, job))
+        job.signals.matches_found.connect(functools.partial(self._handle_matches_found, job))
+        job.signals.failed.connect(functools.partial(self._handle_search_failed, job))
+        job.signals.finished.connect(functools.partial(self._handle_search_finished, job))
+        self.search_job = job
+        self._model = self.main_widget.tree_model
+        self._matches = []
+        self._expanded_buckets = set()
+        self.cancel_button.setEnabled(True)
+        self.status_label.setText(f"Searching {query.describe()}...")
+        self.thread_pool.start(job)
+
+    def _on_cancel(self):
+        """Stop the running search, matches found so far are kept."""
+        job = self.search_job
+        self._cancel_search()
+        if job is not None:
+            self._show_status(job, "stopped")
+            if self.main_widget.tree_model is self._model:
+                self._reveal_matches()
+
+    def _cancel_search(self):
+        job, self.search_job = self.search_job, None
+        if job is None:
+            return
+        self.thread_pool.cancel(job)
+        self.cancel_button.setEnabled(False)
+
+    def _is_current(self, job):
+        return job is self.search_job and self.main_widget.tree_model is self._model
+
+    def _show_status(self, job, state=""):
+        status = f"{job.matched} matches in {job.scanned} keys"
+        if job.capped:
+            status += f", showing first {job.max_results}"
+        if job.reports:
+            status += ", " + ", ".join(f"{bucket} from inventory report of {StringUtils.format_datetime(created_at)}"
+                                       for bucket, created_at in sorted(job.reports.items()))
+        if job.report_errors:
+            status += ", " + ", ".join(f"{bucket} listed, its inventory report couldn't be read"
+                                       for bucket in sorted(job.report_errors))
+        self.status_label.setText(f"{status}, {state}" if state else status)
+
+    def _handle_buckets_listed(self, job, buckets):
+        if not self._is_current(job):
+            return
+        model = self._model
+        model.set_buckets(buckets)
+        # Buckets show only matches, they are not listed when expanded
+        for row in range(model.rowCount()):
+            model.add_objects(model.index(row, 0), [])
+
+    def _handle_matches_found(self, job, matches, scanned):
+        if not self._is_current(job):
+            return
+        model = self._model
+        model.add_matches(matches)
+        self._matches.extend(matches)
+        # Buckets with matches are expanded while searching, folders only when search finishes
+        for bucket in {obj.bucket for obj in matches} - self._expanded_buckets:
+            self._expanded_buckets.add(bucket)
+            node = model.find_node(bucket)
+            if node is not None:
+                self.main_widget.tree_view.expand(model.index_from_node(node))
+        self._show_status(job, "searching...")
+
+    def _handle_search_failed(self, job, error):
+        if self._is_current(job):
+            show_error_dialog(error, show_traceback=True)
+
+    def _handle_search_finished(self, job):
+        if job is not self.search_job:
+            return
+        self.search_job = None
+        self.cancel_button.setEnabled(False)
+        if self.main_widget.tree_model is not self._model:
+            return
+        self._show_status(job, "failed" if job.error is not None else "")
+        self._reveal_matches()
+
+    def _reveal_matches(self):
+        """Expand folders containing matches and select matches, in one pass over the result tree."""
+        tree_view = self.main_widget.tree_view
+        # Result tree has only matches and folders containing them, so every folder is expanded
+        tree_view.expandAll()
+        selection = self._model.match_selection(self._matches)
+        if not selection.isEmpty():
+            tree_view.selectionModel().select(selection, QItemSelectionModel.Select | QItemSelectionModel.Rows)
@@ -0,0 +1,72 @@
+from PyQt5.QtWidgets import (
+    QWidget, QHBoxLayout, QVBoxLayout, QLabel, QComboBox, QTreeView, QApplication, QStyle,
+    QStyledItemDelegate, QStyleOptionProgressBar
+)
+
+from finch.common import set_column_widths
+from finch.progress import TransferListModel, TransferState
+
+# Filters of the transfer list, shown with the number of files they match
+TRANSFER_FILTERS = [
+    ("All", None),
+    ("Active", (TransferState.PENDING, TransferState.ACTIVE)),
+    ("Failed", (TransferState.FAILED, TransferState.CANCELLED)),
+    ("Completed", (TransferState.COMPLETED, TransferState.SKIPPED)),
+]
+
+
+class ProgressBarDelegate(QStyledItemDelegate):
+    """ Paints a progress bar for the percent of a row, only for rows the view shows """
+
+    def paint(self, painter, option, index):
+        percent = index.data(TransferListModel.PercentRole)
+        if percent is None:
+            super().paint(painter, option, index)
+            return
+        bar = QStyleOptionProgressBar()
+        bar.rect = option.rect.adjusted(1, 2, -1, -2)
+        bar.minimum = 0
+        bar.maximum = 100
+        bar.progress = percent
+        bar.text = f"{percent}%"
+        bar.textVisible = True
+        QApplication.style().drawControl(QStyle.CE_ProgressBar, bar, painter)
+
+
+class TransferListWidget(QWidget):
+    """ Files of a transfer job with their progress, filtered by state """
+
+    def __init__(self, model: TransferListModel = None):
+        super().__init__()
+        self.model = model or TransferListModel(self)
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        bar = QHBoxLayout()
+        self.filter_selector = QComboBox()
+        for name, states in TRANSFER_FILTERS:
+            self.filter_selector.addItem(name, states)
+        self.filter_selector.currentIndexChanged.connect(self.change_filter)
+        bar.addWidget(QLabel("Show"))
+        bar.addWidget(self.filter_selector)
+        bar.addStretch()
+
+        self.view = QTreeView()
+        self.view.setRootIsDecorated(False)
+        self.view.setUniformRowHeights(True)
+        self.view.setModel(self.model)
+        self.view.setItemDelegateForColumn(2, ProgressBarDelegate(self.view))
+        set_column_widths(self.view.header(), {1: 80, 2: 120, 3: 90, 4: 120})
+
+        layout.addLayout(bar)
+        layout.addWidget(self.view)
+        self.setLayout(layout)
+
+    def change_filter(self, index: int) -> None:
+        self.model.set_filter(self.filter_selector.itemData(index))
+
+    def update_counts(self) -> None:
+        """ Shows the number of files of every filter, e.g. after a progress snapshot """
+        counts = self.model.counts
+        for index, (name, states) in enumerate(TRANSFER_FILTERS):
+            count = len(self.model.ids) if states is None else sum(counts[state] for state in states)
+            self.filter_selector.setItemText(index, f"{name} ({count})")